@@ -0,0 +1,209 @@
+#!/usr/bin/python
+'''
+Measures how fast the thrift stack decodes StreamItems, for each
+combination of transport and protocol in TRANSPORTS and PROTOCOLS,
+and reports throughput in MB of thrift data per second.
+
+The thrift data comes from chunk files, or with --synthetic, from
+StreamItems generated in memory with bodies of --body-bytes each,
+since large documents are where the cost of the transport shows:
+
+    python bench_thrift.py --synthetic 200 --body-bytes 1000000
+    python bench_thrift.py corpus/2012-04-23-08 --gpg-private trec-kba-rsa.secret-key
+
+With --zlib, the thrift data is first compressed in frames, as
+TZlibTransport writes it with a flush after every frame, e.g. for an
+RPC response, and each case reads it back through TZlibTransport
+with a different read_ahead:
+
+    python bench_thrift.py --synthetic 100000 --body-bytes 2000 --zlib
+
+With --spec-decoder, each case with a pure-python protocol is run
+again reading StreamItems with TSpecDecoder instead of their
+generated read() methods.
+
+With --compact, the data is instead compared with its conversion to
+the compact protocol, reporting the size of each before and after xz,
+and how fast kba_corpus.stream_items decodes each, to decide whether
+to convert a subcorpus with convert_chunks.py:
+
+    python bench_thrift.py corpus/2012-04-23-08/social.* --compact
+
+Each case decodes all of the data --repeat times, and the best time
+is reported.
+'''
+
+import sys
+import time
+import random
+import functools
+from cStringIO import StringIO
+
+from thrift.transport import TTransport
+from thrift.transport.TZlibTransport import TZlibTransport
+from thrift.protocol import TBinaryProtocol
+from thrift.protocol.TSpecDecoder import TSpecDecoder
+
+import kba_corpus
+from kba_thrift.ttypes import StreamItem, ContentItem, StreamTime
+
+def _buffered(thrift_data):
+    ## as stream_items used to, but with a transport underneath
+    ## that cstringio_refill can read from
+    return TTransport.TBufferedTransport(TTransport.TFileObjectTransport(StringIO(thrift_data)))
+
+## name --> function making a transport over a buffer of thrift data
+TRANSPORTS = [
+    ('TBufferedTransport', _buffered),
+    ('TMemoryBuffer', TTransport.TMemoryBuffer),
+    ('TSliceTransport', TTransport.TSliceTransport),
+    ]
+
+def _zlib(thrift_data, read_ahead):
+    return TZlibTransport(TTransport.TMemoryBuffer(thrift_data), read_ahead=read_ahead)
+
+## read_ahead of each TZlibTransport case for --zlib
+READ_AHEADS = [0, 4096, 65536, 2 ** 20]
+
+## name --> protocol class
+PROTOCOLS = [
+    ('TBinaryProtocol', TBinaryProtocol.TBinaryProtocol),
+    ('TBinaryProtocolFast', TBinaryProtocol.TBinaryProtocolFast),
+    ('TBinaryProtocolAccelerated', TBinaryProtocol.TBinaryProtocolAccelerated),
+    ]
+
+def synthetic_thrift_data(num_items, body_bytes, seed=0):
+    '''
+    Returns thrift data of num_items StreamItems, each with
+    body.raw and body.cleansed of about body_bytes
+    '''
+    rand = random.Random(seed)
+    ## text of random words, which compresses about as well as
+    ## English, to take the bodies from at random offsets
+    words = [''.join([chr(rand.randint(97, 122)) for i in xrange(rand.randint(1, 10))])
+             for idx in xrange(5000)]
+    text = ' '.join([rand.choice(words) for idx in xrange(max(body_bytes, 2 ** 20) // 5)])
+    o_transport = StringIO()
+    protocol = TBinaryProtocol.TBinaryProtocol(o_transport)
+    for idx in xrange(num_items):
+        begin = rand.randint(0, len(text) - body_bytes)
+        raw = text[begin:begin + body_bytes]
+        doc = StreamItem()
+        doc.stream_time = StreamTime(epoch_ticks=1335168000.0 + idx,
+                                     zulu_timestamp='2012-04-23T08:00:00.000000Z')
+        doc.doc_id = '%032x' % idx
+        doc.stream_id = '%d-%s' % (doc.stream_time.epoch_ticks, doc.doc_id)
+        doc.abs_url = 'http://example.com/%d' % idx
+        doc.source = 'news'
+        doc.body = ContentItem(raw=raw[:body_bytes], cleansed=raw[:body_bytes // 2],
+                               encoding='UTF-8')
+        doc.write(protocol)
+    return o_transport.getvalue()
+
+def zlib_framed(thrift_data, frame_bytes=65536):
+    'returns thrift_data as written by TZlibTransport, flushed every frame_bytes'
+    o_transport = TTransport.TMemoryBuffer()
+    transport = TZlibTransport(o_transport)
+    for begin in xrange(0, len(thrift_data), frame_bytes):
+        transport.write(thrift_data[begin:begin + frame_bytes])
+        transport.flush()
+    return o_transport.getvalue()
+
+def decode_all(thrift_data, make_transport, protocol_class, spec_decoder=False):
+    '''
+    decodes every StreamItem in thrift_data, with TSpecDecoder if
+    spec_decoder, and returns how many
+    '''
+    protocol = protocol_class(make_transport(thrift_data))
+    decoder = TSpecDecoder(protocol)
+    num_items = 0
+    while 1:
+        doc = StreamItem()
+        try:
+            if spec_decoder:
+                decoder.read(StreamItem, StreamItem.thrift_spec, doc)
+            else:
+                doc.read(protocol)
+        except EOFError:
+            break
+        num_items += 1
+    return num_items
+
+def run_case(thrift_data, make_transport, protocol_class, repeat=3, spec_decoder=False):
+    'returns (num_items, best seconds) for decoding thrift_data repeat times'
+    best = None
+    for idx in range(repeat):
+        start = time.time()
+        num_items = decode_all(thrift_data, make_transport, protocol_class, spec_decoder)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return num_items, best
+
+def compare_compact(thrift_data, repeat=3):
+    '''
+    prints the size before and after xz, and the best time of repeat
+    decodes with kba_corpus.stream_items, of thrift_data in the binary
+    protocol and converted to the compact protocol
+    '''
+    mbytes = len(thrift_data) / 2.0 ** 20
+    for name, compact in [('binary', False), ('compact', True)]:
+        data = kba_corpus.convert_thrift_data(thrift_data, compact)
+        xz_bytes = len(kba_corpus.compress_and_encrypt(data))
+        best = None
+        for idx in range(repeat):
+            start = time.time()
+            num_items = 0
+            for doc in kba_corpus.stream_items(data):
+                num_items += 1
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print '%8s %10d bytes %10d xz bytes %6d items %8.3f sec %8.1f MB/sec' % (
+            name, len(data), xz_bytes, num_items, best, mbytes / best)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='*', help='chunk files, or directories of chunk files')
+    parser.add_argument('--synthetic', type=int, default=None, help='generate this many StreamItems instead of reading chunk files')
+    parser.add_argument('--body-bytes', type=int, default=1000000, help='size of body.raw in each synthetic StreamItem')
+    parser.add_argument('--zlib', action='store_true', default=False, help='read the data through TZlibTransport')
+    parser.add_argument('--compact', action='store_true', default=False, help='compare the data in the binary and compact protocols instead')
+    parser.add_argument('--spec-decoder', action='store_true', default=False, help='also run the pure-python protocols with TSpecDecoder')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times to decode the data in each case')
+    parser.add_argument('--gpg-private', default=None, help='path to the private key for decrypting .gpg chunk files')
+    parser.add_argument('--gpg-dir', default='gnupg-dir', help='gnupg home dir for --gpg-private')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        thrift_data = synthetic_thrift_data(args.synthetic, args.body_bytes)
+    elif args.input:
+        thrift_data = ''.join([kba_corpus.read_chunk(path, args.gpg_private, args.gpg_dir)
+                               for path in kba_corpus.chunk_paths(args.input)])
+    else:
+        sys.exit('give chunk files or --synthetic')
+
+    mbytes = len(thrift_data) / 2.0 ** 20
+    print '%.1f MB of thrift data' % mbytes
+    if args.compact:
+        compare_compact(thrift_data, args.repeat)
+        sys.exit(0)
+
+    transports = TRANSPORTS
+    if args.zlib:
+        thrift_data = zlib_framed(thrift_data)
+        print '%.1f MB compressed' % (len(thrift_data) / 2.0 ** 20)
+        transports = [('read_ahead=%d' % read_ahead, functools.partial(_zlib, read_ahead=read_ahead))
+                      for read_ahead in READ_AHEADS]
+
+    for protocol_name, protocol_class in PROTOCOLS:
+        decoders = [('', False)]
+        if args.spec_decoder and protocol_class is not TBinaryProtocol.TBinaryProtocolAccelerated:
+            decoders.append((' TSpecDecoder', True))
+        for transport_name, make_transport in transports:
+            for decoder_name, spec_decoder in decoders:
+                num_items, seconds = run_case(thrift_data, make_transport, protocol_class,
+                                              args.repeat, spec_decoder)
+                print '%26s %-32s %6d items %8.3f sec %8.1f MB/sec' % (
+                    protocol_name, transport_name + decoder_name, num_items, seconds, mbytes / seconds)
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+'''
+Writes an input manifest for chunk-based map reduce jobs such as
+subcorpus_counter.py, packing chunk URLs into splits of balanced
+size, so that a few large 'social' chunks do not decide when a job
+finishes.
+
+Each line of the manifest is one split, i.e. the input of one map
+task, as a JSON dict with a list of chunks, each recording its URL,
+its compressed size in bytes, and its number of StreamItems, if
+known.  Chunks are packed largest first into the currently smallest
+split.  A chunk larger than --max-split-bytes is broken into
+sub-splits by ranges of StreamItems, each of which still fetches the
+whole chunk, but decodes only its range, starting at the byte offset
+recorded in the chunk's stats sidecar.
+
+Sizes come from the local file, or from an HTTP HEAD request, and
+item counts and offsets from the stats sidecar at <chunk>.stats.json
+(see chunk_stats.py), when there is one.
+
+With --simulate, reports the makespan predicted for the manifest
+against that of splitting the plain list of URLs into --num-splits
+contiguous pieces, as Hadoop does by default.
+'''
+
+import os
+import sys
+import json
+import heapq
+import urllib2
+import urlparse
+
+import kba_corpus
+
+## fraction of the work on a chunk that is fetching, decrypting, and
+## uncompressing it, which every sub-split of the chunk repeats
+FETCH_FRACTION = 0.25
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+def _is_url(path):
+    return urlparse.urlsplit(path).scheme in ('http', 'https')
+
+def chunk_info(path):
+    '''
+    Returns a dict describing the chunk file at path, which may be a
+    local path or an http(s) URL, with keys url, bytes, num_items,
+    and item_offsets.  num_items and item_offsets are None if the
+    chunk has no stats sidecar.
+    '''
+    info = {'url': path, 'bytes': None, 'num_items': None, 'item_offsets': None}
+    if _is_url(path):
+        response = urllib2.urlopen(HeadRequest(path))
+        info['bytes'] = int(response.info().getheader('Content-Length'))
+        response.close()
+        try:
+            stats = json.load(urllib2.urlopen(kba_corpus.chunk_stats_path(path)))
+        except urllib2.HTTPError:
+            stats = None
+    else:
+        info['bytes'] = os.path.getsize(path)
+        stats = kba_corpus.read_chunk_stats(path)
+
+    if stats is not None:
+        info['num_items'] = stats['num_items']
+        info['item_offsets'] = stats.get('item_offsets')
+    return info
+
+def work_units(infos, max_split_bytes=None):
+    '''
+    Returns a list of (cost, unit) for packing, where unit is a dict
+    for the manifest: a whole chunk, or an item range of a chunk
+    whose size exceeds max_split_bytes and whose item count is known.
+    The cost of a unit is in bytes of compressed chunk.
+    '''
+    units = []
+    for info in infos:
+        unit = {'url': info['url'], 'bytes': info['bytes'], 'num_items': info['num_items']}
+        if max_split_bytes is None or info['bytes'] <= max_split_bytes or not info['num_items']:
+            units.append((info['bytes'], unit))
+            continue
+
+        ## ceiling of bytes / max_split_bytes, and at most one item each
+        num_pieces = min(info['num_items'], -(-info['bytes'] // max_split_bytes))
+        for piece in range(num_pieces):
+            start_item = piece * info['num_items'] // num_pieces
+            end_item = (piece + 1) * info['num_items'] // num_pieces
+            sub_unit = dict(unit)
+            sub_unit['items'] = [start_item, end_item]
+            if info['item_offsets']:
+                sub_unit['offset'] = info['item_offsets'][start_item]
+            fraction = float(end_item - start_item) / info['num_items']
+            cost = info['bytes'] * (FETCH_FRACTION + (1 - FETCH_FRACTION) * fraction)
+            units.append((cost, sub_unit))
+    return units
+
+def pack_splits(units, num_splits):
+    '''
+    Packs the (cost, unit) pairs into num_splits splits, taking the
+    largest first and adding each to the split with the least total
+    cost so far, and returns a list of (cost, [unit, ...]), most
+    costly first.  Splits left empty are dropped.
+    '''
+    splits = [(0, idx, []) for idx in range(num_splits)]
+    heapq.heapify(splits)
+    for cost, unit in sorted(units, key=lambda pair: pair[0], reverse=True):
+        total, idx, split_units = heapq.heappop(splits)
+        split_units.append(unit)
+        heapq.heappush(splits, (total + cost, idx, split_units))
+
+    packed = []
+    for total, idx, split_units in splits:
+        if split_units:
+            packed.append(_coalesce(total, split_units))
+    packed.sort(key=lambda pair: pair[0], reverse=True)
+    return packed
+
+def _coalesce(total, units):
+    '''
+    merges item ranges of the same chunk that were packed into one
+    split and are adjacent, so that the chunk is fetched only once,
+    and returns (total, units) with total reduced accordingly
+    '''
+    merged = []
+    for unit in sorted(units, key=lambda unit: (unit['url'], unit.get('items'))):
+        last = merged and merged[-1] or None
+        if last is None or 'items' not in unit or last['url'] != unit['url'] \
+                or last['items'][1] != unit['items'][0]:
+            merged.append(unit)
+            continue
+        last['items'] = [last['items'][0], unit['items'][1]]
+        total -= unit['bytes'] * FETCH_FRACTION
+        if last['items'] == [0, last['num_items']]:
+            del last['items']
+            last.pop('offset', None)
+    return total, merged
+
+def simulate_makespan(costs, num_slots):
+    '''
+    Returns the time at which the last of a list of task costs
+    finishes, if each task in turn starts on the first of num_slots
+    map slots to become free, as Hadoop schedules map tasks.
+    '''
+    slots = [0] * num_slots
+    for cost in costs:
+        heapq.heapreplace(slots, slots[0] + cost)
+    return max(slots)
+
+def default_split_costs(infos, num_splits):
+    '''
+    Returns the cost of each split when the plain list of chunk URLs
+    is cut into num_splits contiguous pieces of nearly equal numbers
+    of lines, approximating Hadoop's default input splitting
+    '''
+    costs = []
+    for idx in range(num_splits):
+        begin = idx * len(infos) // num_splits
+        end = (idx + 1) * len(infos) // num_splits
+        if end > begin:
+            costs.append(sum([info['bytes'] for info in infos[begin:end]]))
+    return costs
+
+def write_manifest(splits, o_fh):
+    'writes one JSON line per split of pack_splits to o_fh'
+    for cost, units in splits:
+        o_fh.write(json.dumps({'cost': int(cost), 'chunks': units}) + '\n')
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input', nargs='+', help='chunk files, directories of chunk files, or files listing chunk URLs or paths one per line (with --list)')
+    parser.add_argument('--list', action='store_true', default=False, help='inputs are files listing chunk URLs or paths, e.g. public_urls-2012-04-23-08.txt')
+    parser.add_argument('--num-splits', type=int, default=40, help='number of splits, e.g. mapred.map.tasks')
+    parser.add_argument('--max-split-bytes', type=int, default=None, help='break chunks larger than this into item ranges; defaults to the mean split size')
+    parser.add_argument('--output', default=None, help='path for the manifest, defaults to stdout')
+    parser.add_argument('--simulate', action='store_true', default=False, help='report the predicted makespan instead of writing the manifest')
+    parser.add_argument('--num-slots', type=int, default=None, help='number of map slots for --simulate, defaults to --num-splits')
+    parser.add_argument('--bytes-per-second', type=float, default=None, help='processing rate of one map slot, to report --simulate in seconds')
+    args = parser.parse_args()
+
+    if args.list:
+        paths = []
+        for list_path in args.input:
+            paths += [line.strip() for line in open(list_path) if line.strip()]
+    else:
+        paths = kba_corpus.chunk_paths(args.input)
+
+    infos = [chunk_info(path) for path in paths]
+    max_split_bytes = args.max_split_bytes
+    if max_split_bytes is None:
+        max_split_bytes = sum([info['bytes'] for info in infos]) // args.num_splits or None
+    splits = pack_splits(work_units(infos, max_split_bytes), args.num_splits)
+
+    if not args.simulate:
+        if args.output:
+            o_fh = open(args.output, 'wb')
+            write_manifest(splits, o_fh)
+            o_fh.close()
+        else:
+            write_manifest(splits, sys.stdout)
+        sys.exit(0)
+
+    num_slots = args.num_slots or args.num_splits
+    total = sum([info['bytes'] for info in infos])
+    results = [
+        ('default splits', simulate_makespan(default_split_costs(infos, args.num_splits), num_slots)),
+        ('manifest splits', simulate_makespan([cost for cost, units in splits], num_slots)),
+        ('lower bound', float(total) / num_slots),
+        ]
+    print '%d chunks, %d bytes, %d splits, %d map slots' % (len(infos), total, len(splits), num_slots)
+    for name, makespan in results:
+        if args.bytes_per_second:
+            print '%16s: %.1f seconds' % (name, makespan / args.bytes_per_second)
+        else:
+            print '%16s: %d bytes' % (name, makespan)
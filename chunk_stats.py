@@ -0,0 +1,49 @@
+#!/usr/bin/python
+'''
+Writes a stats sidecar next to each chunk file, recording its item
+count, epoch_ticks range, sources, per-field byte totals, number of
+items with NER, and a Bloom filter over its stream_ids and doc_ids.
+Sidecars are not encrypted, so for encrypted (.gpg) chunks the Bloom
+filter is keyed with a secret kept in --gpgdir, see
+kba_corpus.ids_bloom_secret, and only readers with the secret can
+test it.
+
+Chunks written by kba_corpus and sort_chunks.py already get a
+sidecar; this backfills sidecars for existing chunk files, so that
+readers such as kba_corpus.merged_stream and filter_annotated_docs
+can skip chunks without decrypting them.
+'''
+
+import os
+import sys
+
+import kba_corpus
+
+def backfill_chunk_stats(paths, force=False, gpg_private=None, gpg_dir='gnupg-dir'):
+    '''
+    Writes a stats sidecar for every chunk file in paths, which may
+    include directories of chunk files.  Chunks that already have a
+    sidecar are skipped unless force is True.  Returns the number of
+    sidecars written.
+    '''
+    num_written = 0
+    for chunk_path in kba_corpus.chunk_paths(paths):
+        if not force and os.path.exists(kba_corpus.chunk_stats_path(chunk_path)):
+            continue
+        thrift_data = kba_corpus.read_chunk(chunk_path, gpg_private, gpg_dir)
+        kba_corpus.write_chunk_stats(chunk_path, thrift_data, gpg_dir)
+        num_written += 1
+    return num_written
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input', nargs='+', help='chunk files, or directories of chunk files such as date_hour dirs')
+    parser.add_argument('--force', action='store_true', default=False, help='rewrite sidecars that already exist')
+    parser.add_argument('--private', default=None, help='Provide GPG decryption (private) key for reading corpus')
+    parser.add_argument('--gpgdir', default='gnupg-dir', help='dir for storing gpg files, e.g. keys')
+    args = parser.parse_args()
+
+    num_written = backfill_chunk_stats(args.input, force=args.force,
+                                       gpg_private=args.private, gpg_dir=args.gpgdir)
+    kba_corpus.log('wrote %d stats sidecars' % num_written)
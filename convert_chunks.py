@@ -0,0 +1,62 @@
+#!/usr/bin/python
+'''
+Rewrites chunk files with their StreamItems in the thrift compact
+protocol, or with --binary, back in the binary protocol, into new
+chunk files in out_dir/<date_hour>/, named with the subcorpus of the
+input chunk and the md5 of the converted thrift data, each with its
+stats sidecar.
+
+Compact chunks are smaller before xz, and somewhat smaller after, but
+slower to decode in pure python; see bench_thrift.py --compact to
+decide per subcorpus.  The readers in kba_corpus and streamcorpus
+detect the protocol of each chunk, see kba_corpus.COMPACT_MAGIC.
+'''
+
+import os
+
+import kba_corpus
+
+def convert_chunks(i_paths, out_dir, compact=True,
+                   gpg_private=None, gpg_public=None, gpg_dir='gnupg-dir'):
+    '''
+    Converts all the chunk files in i_paths, which may include
+    date_hour directories of chunk files, and returns a dict of
+    counts, including the total bytes of thrift data before and after.
+    '''
+    counts = {'chunks': 0, 'unchanged': 0, 'i_bytes': 0, 'o_bytes': 0}
+    for i_path in kba_corpus.chunk_paths(i_paths):
+        thrift_data = kba_corpus.read_chunk(i_path, gpg_private, gpg_dir)
+        o_thrift_data = kba_corpus.convert_thrift_data(thrift_data, compact)
+        if o_thrift_data is thrift_data:
+            counts['unchanged'] += 1
+
+        ## mirror the date_hour dir and subcorpus of the input chunk
+        date_hour = os.path.basename(os.path.dirname(os.path.abspath(i_path)))
+        o_dir = os.path.join(out_dir, date_hour)
+        if not os.path.exists(o_dir):
+            os.makedirs(o_dir)
+        subcorpus = os.path.basename(i_path).split('.')[0]
+        kba_corpus.write_chunk(o_thrift_data, o_dir, subcorpus, gpg_public, gpg_dir)
+
+        counts['chunks'] += 1
+        counts['i_bytes'] += len(thrift_data)
+        counts['o_bytes'] += len(o_thrift_data)
+
+    kba_corpus.log('converted %(chunks)d chunks (%(unchanged)d already converted), '
+                   '%(i_bytes)d bytes of thrift data --> %(o_bytes)d' % counts)
+    return counts
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='path to directory for date_hour dirs of converted chunk files')
+    parser.add_argument('input', nargs='+', help='chunk files, or directories of chunk files such as date_hour dirs')
+    parser.add_argument('--binary', action='store_true', default=False, help='convert to the binary protocol instead of the compact protocol')
+    parser.add_argument('--private', default=None, help='Provide GPG decryption (private) key for reading corpus')
+    parser.add_argument('--public', default=None, help='Provide GPG encryption (public) key for re-saving corpus')
+    parser.add_argument('--gpgdir', default='gnupg-dir', help='dir for storing gpg files, e.g. keys')
+    args = parser.parse_args()
+
+    convert_chunks(args.input, args.out_dir, compact=not args.binary,
+                   gpg_private=args.private, gpg_public=args.public,
+                   gpg_dir=args.gpgdir)
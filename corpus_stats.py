@@ -0,0 +1,177 @@
+'''
+reads in paths to individual chunk files in the TREC KBA Stream Corpus
+2012, like subcorpus_counter.py, and computes per-subcorpus statistics
+in a single pass and bounded memory, using the mergeable sketches in
+kba_sketches:
+
+    distinct_hosts     -- estimated number of distinct schost values
+    body_bytes         -- quantiles of len(body.raw)
+    top_entities       -- most frequent entity names in body.ner
+
+Uses mrjob to run itself in hadoop on AWS EMR, with the same
+configuration as subcorpus_counter.py:
+
+    python corpus_stats.py -r emr -c subcorpus_counter.conf public_urls-2012-04-23-08.txt
+'''
+
+import re
+import os
+import tempfile
+import traceback
+
+import mrjob.protocol
+from mrjob.job import MRJob
+
+import kba_corpus
+import kba_fetch
+from kba_mrjob import BatchedCounters, SkipRecorder
+from kba_sketches import HyperLogLog, KLLSketch, CountMinTopK
+
+## quantiles of body length reported by the reducer
+QUANTILES = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+
+def entity_names(stream_item, content='body'):
+    '''
+    Iterator over the names of entities tagged by Stanford NER in a
+    ContentItem of stream_item, i.e. runs of consecutive tokens with
+    the same entity_type other than 'O', joined by spaces
+    '''
+    name = []
+    entity_type = None
+    for tok in kba_corpus.tokens(stream_item, content):
+        if name and (tok.entity_type != entity_type or tok.is_sentence_boundary):
+            yield ' '.join(name)
+            name = []
+        entity_type = tok.entity_type
+        if entity_type and entity_type != 'O' and not tok.is_sentence_boundary:
+            name.append(tok.token)
+    if name:
+        yield ' '.join(name)
+
+def new_sketches():
+    'a dict of empty sketches for one subcorpus'
+    return {'distinct_hosts': HyperLogLog(),
+            'body_bytes': KLLSketch(),
+            'top_entities': CountMinTopK()}
+
+## sketch class for each key of new_sketches, for from_dict
+SKETCH_TYPES = dict((name, sketch.__class__) for name, sketch in new_sketches().items())
+
+def sketches_to_dict(sketches):
+    return dict((name, sketch.to_dict()) for name, sketch in sketches.items())
+
+def sketches_from_dict(rec):
+    return dict((name, SKETCH_TYPES[name].from_dict(sketch_rec))
+                for name, sketch_rec in rec.items())
+
+def merge_sketches(recs):
+    '''
+    Merges an iterator over sketches_to_dict records into one dict of
+    sketches
+    '''
+    merged = None
+    for rec in recs:
+        sketches = sketches_from_dict(rec)
+        if merged is None:
+            merged = sketches
+        else:
+            for name, sketch in sketches.items():
+                merged[name].merge(sketch)
+    return merged
+
+class CorpusStats(MRJob):
+    INPUT_PROTOCOL  = mrjob.protocol.RawValueProtocol
+
+    def configure_options(self):
+        super(CorpusStats, self).configure_options()
+        self.add_passthrough_option(
+            '--chunk-cache-dir', default=os.path.join(tempfile.gettempdir(), 'kba-chunk-cache'),
+            help='local dir for caching fetched chunk files across jobs, or "" to disable')
+        self.add_passthrough_option(
+            '--chunk-cache-bytes', type='int', default=kba_fetch.DEFAULT_CACHE_BYTES,
+            help='size cap for --chunk-cache-dir')
+        self.add_passthrough_option(
+            '--prefetch', type='int', default=4,
+            help='number of chunk files to download ahead of the one being read')
+
+    def mapper_init(self):
+        '''
+        The sketches for each subcorpus handled by this map task
+        accumulate in self.sketches, and are emitted by mapper_final
+        '''
+        self.urls = []
+        self.sketches = {}
+        self.counters = BatchedCounters(self)
+        self.skipped = SkipRecorder(self.counters, 'CorpusStats')
+        self.cache = None
+        if self.options.chunk_cache_dir:
+            self.cache = kba_fetch.ChunkCache(self.options.chunk_cache_dir,
+                                              self.options.chunk_cache_bytes)
+
+    def mapper(self, empty, public_url):
+        'saves each chunk URL for mapper_final'
+        self.urls.append(public_url.strip())
+        self.increment_counter('SkippingTaskCounters','MapProcessedRecords',1)
+
+    def mapper_final(self):
+        '''
+        Adds every StreamItem in this task's chunk files to the
+        sketches for its subcorpus, and emits them.  StreamItems that
+        cannot be decoded or tokenized are skipped and counted.
+        '''
+        for fetched in kba_fetch.prefetch_chunks(
+                self.urls, max_in_flight=self.options.prefetch, cache=self.cache,
+                gpg_private='kba_corpus.tar.gz/trec-kba-rsa.secret-key'):
+            kba_corpus.log('sketching %r' % fetched.url)
+            try:
+                thrift_data = fetched.thrift_data()
+            except Exception, exc:
+                kba_corpus.log(traceback.format_exc(exc))
+                self.increment_counter('CorpusStats', 'FAILED-%s' % re.sub('\s+', '-', str(exc)), 1)
+                continue
+
+            self.skipped.url = fetched.url
+            for stream_item in kba_corpus.robust_stream_items(thrift_data, self.skipped):
+                try:
+                    ## tokenize before touching the sketches, so that
+                    ## a skipped StreamItem contributes nothing
+                    names = list(entity_names(stream_item))
+                except kba_corpus.TokenizationException, exc:
+                    self.skipped(stream_item.stream_id, str(exc))
+                    continue
+
+                if stream_item.source not in self.sketches:
+                    self.sketches[stream_item.source] = new_sketches()
+                sketches = self.sketches[stream_item.source]
+
+                if stream_item.schost:
+                    sketches['distinct_hosts'].add(stream_item.schost)
+                sketches['body_bytes'].add(len(stream_item.body.raw or ''))
+                for name in names:
+                    sketches['top_entities'].add(name)
+
+                self.counters.increment('CorpusStats', 'StreamItemsProcessed', 1)
+
+        self.counters.flush()
+        for source, sketches in self.sketches.iteritems():
+            yield source, sketches_to_dict(sketches)
+
+    def combiner(self, source, recs):
+        yield source, sketches_to_dict(merge_sketches(recs))
+
+    def reducer(self, source, recs):
+        '''
+        Merges all the sketches for a subcorpus, and emits the
+        statistics estimated from them
+        '''
+        sketches = merge_sketches(recs)
+        yield source, {
+            'distinct_hosts': sketches['distinct_hosts'].count(),
+            'num_items': sketches['body_bytes'].count,
+            'body_bytes': dict(('%g' % fraction, sketches['body_bytes'].quantile(fraction))
+                               for fraction in QUANTILES),
+            'top_entities': sketches['top_entities'].top(),
+            }
+
+if __name__ == '__main__':
+    CorpusStats.run()
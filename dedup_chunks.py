@@ -0,0 +1,217 @@
+#!/usr/bin/python
+'''
+Removes duplicate StreamItems from a slice of the corpus, so that
+downstream jobs such as NER and indexing do not spend CPU on them.
+
+A StreamItem is a duplicate if an earlier StreamItem had the same
+doc_id, which is the md5 of its abs_url, or the same md5 of its
+body.raw.  Chunks are processed in the order given, directories in
+file name order, and only first occurrences are written out, copied
+verbatim without decoding.
+
+By default, the ids seen so far are held exactly in a compact
+FingerprintSet, which refuses to grow past --max-bytes.  For
+corpus-wide runs, --bloom uses a ScalableBloomFilter instead, which
+grows slowly but wrongly drops roughly --error-rate of the unique
+StreamItems as false duplicates.
+'''
+
+import os
+import sys
+import hashlib
+import resource
+from array import array
+from struct import unpack_from
+from cStringIO import StringIO
+
+import kba_corpus
+
+## default bound on the memory used by a FingerprintSet
+DEFAULT_MAX_BYTES = 1024 * 2**20
+
+class FingerprintSet(object):
+    '''
+    An open-addressing hash set of fixed-width fingerprints of md5
+    digests, held in a single array, so that each key costs a few
+    machine words instead of a python str.  Fingerprints are the
+    leading bytes of the digest, so distinct keys collide with
+    probability about n / 2**64.
+    '''
+    ## fraction of slots that may be in use before the table doubles
+    MAX_LOAD = 0.5
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, initial_size=2**16):
+        self.max_bytes = max_bytes
+        self._table = array('L', [0]) * initial_size
+        self._mask = initial_size - 1
+        self._format = self._table.itemsize == 8 and '<Q' or '<I'
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return len(self._table) * self._table.itemsize
+
+    def _fingerprint(self, digest):
+        ## zero marks an empty slot
+        return unpack_from(self._format, digest)[0] or 1
+
+    def _slot(self, fingerprint):
+        idx = fingerprint & self._mask
+        while self._table[idx] and self._table[idx] != fingerprint:
+            idx = (idx + 1) & self._mask
+        return idx
+
+    def __contains__(self, digest):
+        fingerprint = self._fingerprint(digest)
+        return self._table[self._slot(fingerprint)] == fingerprint
+
+    def add(self, digest):
+        fingerprint = self._fingerprint(digest)
+        idx = self._slot(fingerprint)
+        if self._table[idx] == fingerprint:
+            return
+        if self.count + 1 > len(self._table) * self.MAX_LOAD:
+            self._grow()
+            idx = self._slot(fingerprint)
+        self._table[idx] = fingerprint
+        self.count += 1
+
+    def _grow(self):
+        if 2 * self.nbytes > self.max_bytes:
+            raise MemoryError(
+                'FingerprintSet of %d keys would exceed max_bytes=%d; '
+                'raise the limit or use a ScalableBloomFilter'
+                % (self.count, self.max_bytes))
+        old_table = self._table
+        self._table = array('L', [0]) * (2 * len(old_table))
+        self._mask = len(self._table) - 1
+        for fingerprint in old_table:
+            if fingerprint:
+                self._table[self._slot(fingerprint)] = fingerprint
+
+class ScalableBloomFilter(object):
+    '''
+    A Bloom filter that grows as keys are added, by stacking
+    kba_corpus.BloomFilter instances of geometrically increasing
+    capacity and decreasing error rate, so that the overall false
+    positive rate stays below error_rate however many keys are added.
+    '''
+    def __init__(self, initial_capacity=2**20, error_rate=0.001,
+                 growth=2, tightening=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+        self.count = 0
+        self._capacity = 0
+
+    @property
+    def nbytes(self):
+        return sum([len(bloom.bits) for bloom in self.filters])
+
+    def __contains__(self, key):
+        for bloom in self.filters:
+            if key in bloom:
+                return True
+        return False
+
+    def add(self, key):
+        if self.count >= self._capacity:
+            ## the error rates form a geometric series summing to
+            ## error_rate
+            idx = len(self.filters)
+            capacity = self.initial_capacity * self.growth ** idx
+            error_rate = self.error_rate * (1 - self.tightening) * self.tightening ** idx
+            self.filters.append(kba_corpus.BloomFilter.for_capacity(capacity, error_rate))
+            self._capacity += capacity
+        self.filters[-1].add(key)
+        self.count += 1
+
+def dedup_keys(thrift_data, fields):
+    '''
+    Returns a list of md5 digests identifying the StreamItem whose
+    field spans are fields: one for its doc_id and one for its
+    body.raw, when present and non-empty.
+    '''
+    keys = []
+    doc_id = kba_corpus.stream_item_field(thrift_data, fields, 'doc_id')
+    if doc_id:
+        keys.append(hashlib.md5('doc_id:' + str(doc_id)).digest())
+    body_raw = kba_corpus.stream_item_field(thrift_data, fields, 'body.raw')
+    if body_raw:
+        keys.append(hashlib.md5(body_raw).digest())
+    return keys
+
+def dedup_chunks(i_paths, out_dir, bloom=False, max_bytes=DEFAULT_MAX_BYTES,
+                 error_rate=0.001, gpg_private=None, gpg_public=None,
+                 gpg_dir='gnupg-dir'):
+    '''
+    Reads all the chunk files in i_paths, which may include date_hour
+    directories of chunk files, and writes the first occurrence of
+    every StreamItem to new chunk files in out_dir/<date_hour>/, named
+    with the subcorpus of the input chunk.  Returns a dict of counts.
+    '''
+    if bloom:
+        seen = ScalableBloomFilter(error_rate=error_rate)
+    else:
+        seen = FingerprintSet(max_bytes=max_bytes)
+
+    counts = {'items': 0, 'kept': 0, 'duplicates': 0, 'chunks_written': 0}
+    for i_path in kba_corpus.chunk_paths(i_paths):
+        thrift_data = kba_corpus.to_binary(
+            kba_corpus.read_chunk(i_path, gpg_private, gpg_dir))
+
+        o_buffer = StringIO()
+        num_kept = 0
+        for begin, end, fields in kba_corpus.stream_item_spans(thrift_data):
+            counts['items'] += 1
+            keys = dedup_keys(thrift_data, fields)
+            for key in keys:
+                if key in seen:
+                    break
+            else:
+                for key in keys:
+                    seen.add(key)
+                o_buffer.write(buffer(thrift_data, begin, end - begin))
+                num_kept += 1
+                continue
+            counts['duplicates'] += 1
+
+        counts['kept'] += num_kept
+        if num_kept == 0:
+            continue
+
+        ## mirror the date_hour dir and subcorpus of the input chunk
+        date_hour = os.path.basename(os.path.dirname(os.path.abspath(i_path)))
+        o_dir = os.path.join(out_dir, date_hour)
+        if not os.path.exists(o_dir):
+            os.makedirs(o_dir)
+        subcorpus = os.path.basename(i_path).split('.')[0]
+        kba_corpus.write_chunk(o_buffer.getvalue(), o_dir, subcorpus, gpg_public, gpg_dir)
+        counts['chunks_written'] += 1
+
+    counts['seen_bytes'] = seen.nbytes
+    counts['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kba_corpus.log('kept %(kept)d of %(items)d StreamItems, dropped %(duplicates)d '
+                   'duplicates, using %(seen_bytes)d bytes of id set '
+                   '(max rss %(max_rss_kb)d KB)' % counts)
+    return counts
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='path to directory for date_hour dirs of deduplicated chunk files')
+    parser.add_argument('input', nargs='+', help='chunk files, or directories of chunk files such as date_hour dirs')
+    parser.add_argument('--bloom', action='store_true', default=False, help='use a scalable Bloom filter instead of an exact fingerprint set')
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES, help='memory limit for the exact fingerprint set')
+    parser.add_argument('--error-rate', type=float, default=0.001, help='false duplicate rate for --bloom')
+    parser.add_argument('--private', default=None, help='Provide GPG decryption (private) key for reading corpus')
+    parser.add_argument('--public', default=None, help='Provide GPG encryption (public) key for re-saving corpus')
+    parser.add_argument('--gpgdir', default='gnupg-dir', help='dir for storing gpg files, e.g. keys')
+    args = parser.parse_args()
+
+    dedup_chunks(args.input, args.out_dir, bloom=args.bloom,
+                 max_bytes=args.max_bytes, error_rate=args.error_rate,
+                 gpg_private=args.private, gpg_public=args.public,
+                 gpg_dir=args.gpgdir)
@@ -14,36 +14,166 @@ try:
     import json
 except:
     import simplejson as json
+import hmac
+import math
 import time
+import heapq
+import base64
 import string
+import calendar
 import hashlib
 import traceback
 import itertools
 import subprocess
+from struct import unpack, unpack_from
 from cStringIO import StringIO
 
 def log(mesg):
     sys.stderr.write('%s\n' % mesg)
     sys.stderr.flush()
 
+class StageTimer(object):
+    '''
+    Accumulates wall-clock seconds, bytes, items, and calls for each
+    named stage of processing, e.g. 'read', 'xz_decompress', 'decode':
+
+        with timer.stage('read') as stage:
+            data = ...
+            stage.add(nbytes=len(data))
+
+    report() returns a JSON-compatible dict of stage name --> dict of
+    totals, and merge() adds in another StageTimer's totals, e.g. to
+    sum per-file timers into a per-run timer.
+
+    Functions that take a timer default to NULL_TIMER, which records
+    nothing and costs about one method call per stage.
+    '''
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds=0.0, nbytes=0, items=0, calls=1):
+        'adds totals to stage name directly'
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = {'seconds': 0.0, 'bytes': 0, 'items': 0, 'calls': 0}
+        totals['seconds'] += seconds
+        totals['bytes'] += nbytes
+        totals['items'] += items
+        totals['calls'] += calls
+
+    def stage(self, name):
+        'context manager that times one call of stage name'
+        return _Stage(self, name)
+
+    def timed_iter(self, name, iterator):
+        '''
+        Iterator over iterator that adds the time spent in each of its
+        next() calls to stage name, with one item each
+        '''
+        iterator = iter(iterator)
+        while 1:
+            start = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                self.add(name, time.time() - start, calls=0)
+                return
+            self.add(name, time.time() - start, items=1, calls=0)
+            yield item
+
+    def merge(self, other):
+        for name, totals in other.stages.items():
+            self.add(name, totals['seconds'], totals['bytes'], totals['items'], totals['calls'])
+
+    def report(self):
+        return dict((name, dict(totals)) for name, totals in self.stages.items())
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.nbytes = 0
+        self.items = 0
+
+    def add(self, nbytes=0, items=0):
+        self.nbytes += nbytes
+        self.items += items
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.timer.add(self.name, time.time() - self.start, self.nbytes, self.items)
+
+class _NullTimer(object):
+    'a StageTimer that records nothing, see NULL_TIMER'
+    def add(self, name, seconds=0.0, nbytes=0, items=0, calls=1):
+        pass
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def timed_iter(self, name, iterator):
+        return iterator
+
+    def merge(self, other):
+        pass
+
+    def report(self):
+        return {}
+
+class _NullStage(object):
+    def add(self, nbytes=0, items=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+NULL_TIMER = _NullTimer()
+_NULL_STAGE = _NullStage()
+
 try:
     ## import the thrift library
     from thrift import Thrift
     from thrift.transport import TTransport
+    from thrift.transport.TXzTransport import TXzTransport
     from thrift.protocol import TBinaryProtocol
+    from thrift.protocol.TCompactProtocol import TCompactProtocol
+    from thrift.protocol.TSpecDecoder import TSpecDecoder
 
     ## import the KBA-specific thrift types
-    from kba_thrift.ttypes import StreamItem
+    from kba_thrift.ttypes import StreamItem, StreamTime, ContentItem
+
+    ## __slots__ versions of the same types, which take a fifth of
+    ## the memory per object, for holding many StreamItems at once
+    from thrift.protocol.TBase import compact_types
+    CompactStreamItem = compact_types(StreamItem)['StreamItem']
+
+    ## field ids of StreamItem and StreamTime properties, by name
+    _stream_item_fids = dict((field[2], field[0])
+                             for field in StreamItem.thrift_spec if field)
+    _stream_time_fids = dict((field[2], field[0])
+                             for field in StreamTime.thrift_spec if field)
+    _content_item_fids = dict((field[2], field[0])
+                              for field in ContentItem.thrift_spec if field)
 
 except ImportError, exc:
     log(traceback.format_exc(exc))
 
-def decrypt_and_uncompress(data, gpg_private=None, gpg_dir='gnupg-dir'):
+def decrypt_and_uncompress(data, gpg_private=None, gpg_dir='gnupg-dir', timer=NULL_TIMER):
     '''
     Given a data buffer of bytes, if gpg_key_path is provided, decrypt
-    data using gnupg, and uncompress using xz.
+    data using gnupg, and uncompress using xz.  The time and input
+    bytes of each are added to the 'gpg_decrypt' and 'xz_decompress'
+    stages of timer, see StageTimer.
     '''
     if gpg_private is not None:
+        start = time.time()
+        num_bytes = len(data)
         ### setup gpg for encryption
         if not os.path.exists(gpg_dir):
             os.makedirs(gpg_dir)
@@ -71,6 +201,10 @@ def decrypt_and_uncompress(data, gpg_private=None, gpg_dir='gnupg-dir'):
         data, errors = gpg_child.communicate(data)
         if errors:
             log(errors)
+        timer.add('gpg_decrypt', time.time() - start, num_bytes)
+
+    start = time.time()
+    num_bytes = len(data)
 
     ## launch xz child
     xz_child = subprocess.Popen(
@@ -84,13 +218,20 @@ def decrypt_and_uncompress(data, gpg_private=None, gpg_dir='gnupg-dir'):
 
     assert not errors, errors
 
+    timer.add('xz_decompress', time.time() - start, num_bytes)
     return data
 
-def compress_and_encrypt(data, gpg_public=None, gpg_dir='gnupg-dir', gpg_recipient='trec-kba'):
+def compress_and_encrypt(data, gpg_public=None, gpg_dir='gnupg-dir', gpg_recipient='trec-kba',
+                         timer=NULL_TIMER):
     '''
     Given a data buffer of bytes compress it using xz, if gpg_public
-    is provided, encrypt data using gnupg.
+    is provided, encrypt data using gnupg.  The time and input bytes
+    of each are added to the 'xz_compress' and 'gpg_encrypt' stages of
+    timer, see StageTimer.
     '''
+    start = time.time()
+    num_bytes = len(data)
+
     ## launch xz child
     xz_child = subprocess.Popen(
         ['xz', '--compress'],
@@ -103,7 +244,12 @@ def compress_and_encrypt(data, gpg_public=None, gpg_dir='gnupg-dir', gpg_recipie
 
     assert not errors, errors
 
+    timer.add('xz_compress', time.time() - start, num_bytes)
+
     if gpg_public is not None:
+        start = time.time()
+        num_bytes = len(data)
+
         ### setup gpg for encryption.  
         if not os.path.exists(gpg_dir):
             os.makedirs(gpg_dir)
@@ -134,28 +280,151 @@ def compress_and_encrypt(data, gpg_public=None, gpg_dir='gnupg-dir', gpg_recipie
         data, errors = gpg_child.communicate(data)
         if errors:
             log(errors)
+        timer.add('gpg_encrypt', time.time() - start, num_bytes)
 
     return data
 
-def stream_items(thrift_data):
+def is_chunk_file(fname):
     '''
-    Iterator over the StreamItems from a buffer of thrift data
+    True if fname looks like a compressed (and possibly encrypted)
+    chunk file, rather than e.g. a stats.json file
     '''
-    ## wrap it in a file obj, thrift transport, and thrift protocol
-    transport = StringIO(thrift_data)        
-    transport.seek(0)
-    transport = TTransport.TBufferedTransport(transport)
-    protocol = TBinaryProtocol.TBinaryProtocol(transport)
+    return fname.endswith('.xz.gpg') or fname.endswith('.xz')
+
+def chunk_paths(paths):
+    '''
+    Returns a list of chunk file paths from a list of paths that may
+    be chunk files or directories containing chunk files, such as
+    date_hour directories.  Files within a directory are sorted by
+    name, and other files are ignored.
+    '''
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for fname in sorted(os.listdir(path)):
+                if is_chunk_file(fname):
+                    found.append(os.path.join(path, fname))
+        else:
+            found.append(path)
+    return found
+
+def read_chunk(path, gpg_private=None, gpg_dir='gnupg-dir'):
+    '''
+    Returns the thrift data of the chunk file at path, decrypting it
+    if gpg_private is provided, and uncompressing it.
+    '''
+    data = open(path, 'rb').read()
+    assert len(data) > 0, 'failed to load: %s' % path
+    return decrypt_and_uncompress(data, gpg_private, gpg_dir)
+
+## Chunks may hold their StreamItems in the thrift compact protocol,
+## which writes field ids as deltas and integers and lengths as
+## varints, instead of the binary protocol.  Such thrift data starts
+## with this magic, whose first byte is the compact protocol's id,
+## 0x82, which cannot begin a binary-protocol StreamItem, as it is
+## not a thrift type.  Thrift data without it is binary.
+COMPACT_MAGIC = '\x82kba-compact\x01'
+
+def is_compact(thrift_data):
+    'True if thrift_data holds StreamItems in the compact protocol'
+    return thrift_data[:len(COMPACT_MAGIC)] == COMPACT_MAGIC
+
+def _item_protocol(thrift_data, offset=None):
+    '''
+    Returns (transport, protocol) for reading the StreamItems in
+    thrift_data, with the protocol it was written in, and with the
+    transport positioned at offset, or at the first StreamItem.
+    '''
+    transport = TTransport.TSliceTransport(thrift_data)
+    if is_compact(thrift_data):
+        protocol = TCompactProtocol(transport)
+        if offset is None:
+            offset = len(COMPACT_MAGIC)
+    else:
+        protocol = TBinaryProtocol.TBinaryProtocol(transport)
+    if offset:
+        transport.seek(offset)
+    return transport, protocol
+
+def compact_item_offsets(thrift_data):
+    '''
+    Returns the byte offset of every StreamItem in compact-protocol
+    thrift_data, found by skipping over each without building it, for
+    use like the item_offsets of chunk_stats.
+    '''
+    transport, protocol = _item_protocol(thrift_data)
+    offsets = []
+    while transport.remaining():
+        offsets.append(transport.tell())
+        protocol.skip(Thrift.TType.STRUCT)
+    return offsets
+
+def convert_thrift_data(thrift_data, compact=True):
+    '''
+    Returns thrift_data re-encoded with every StreamItem in the compact
+    protocol, or if not compact, in the binary protocol, or
+    thrift_data itself if it is already in that protocol.
+    '''
+    if is_compact(thrift_data) == compact:
+        return thrift_data
+    o_transport = TTransport.TMemoryBuffer()
+    if compact:
+        o_transport.write(COMPACT_MAGIC)
+        o_protocol = TCompactProtocol(o_transport)
+    else:
+        o_protocol = TBinaryProtocol.TBinaryProtocolAccelerated(o_transport)
+    for stream_item in stream_items(thrift_data):
+        stream_item.write(o_protocol)
+    return o_transport.getvalue()
+
+def to_binary(thrift_data):
+    '''
+    Returns thrift_data with its StreamItems in the binary protocol,
+    which the tools that scan byte spans instead of decoding, such as
+    stream_item_spans, require.
+    '''
+    return convert_thrift_data(thrift_data, compact=False)
+
+def stream_items(thrift_data, item_class=None, reuse=False):
+    '''
+    Iterator over the StreamItems from a buffer of thrift data.  Pass
+    item_class=CompactStreamItem to get compact StreamItems, e.g. to
+    keep many of them in memory.
+
+    With reuse=True, every StreamItem is decoded into the same object,
+    and its ContentItems and StreamTime into the same nested objects,
+    with fields reset in place, which saves allocating and collecting
+    a new object graph per StreamItem in a long scan.  The yielded
+    StreamItem is then only valid until the next step of the iterator:
+    copy out any values to keep, and never keep the StreamItem or its
+    ContentItems themselves, e.g. in a list.
+
+    The protocol is detected from thrift_data, see COMPACT_MAGIC.
+    '''
+    if item_class is None:
+        item_class = StreamItem
+
+    ## wrap it in a thrift transport and thrift protocol; the
+    ## transport reads slices of thrift_data in place, rather than
+    ## copying it through a buffer that is refilled every 4KB
+    transport, protocol = _item_protocol(thrift_data)
+
+    if reuse:
+        decoder = TSpecDecoder(protocol)
+        doc = item_class()
 
     ## read stream-item instances until input buffer is exhausted
     while 1:
 
-        ## instantiate a StreamItem instance from kba_thrift
-        doc = StreamItem()
-
         try:
-            ## read it from the thrift protocol instance
-            doc.read(protocol)
+            if reuse:
+                ## overwrite the previous StreamItem in place
+                decoder.read(item_class, None, doc, reuse=True)
+            else:
+                ## instantiate a StreamItem instance from kba_thrift
+                doc = item_class()
+                ## read it from the thrift protocol instance
+                doc.read(protocol)
             ## This has deserialized the data analogous to
             ## json.loads(line).  The StreamItem from the thrift
             ## format is the analog of the JSON stream-item; see
@@ -167,6 +436,904 @@ def stream_items(thrift_data):
         except EOFError:
             break
 
+def xz_stream_items(xz_file):
+    '''
+    Iterator over the StreamItems in an xz-compressed chunk, given as
+    a path or an open file, decompressing it incrementally in this
+    process, so that memory stays bounded by the largest StreamItem
+    rather than the whole chunk, and no xz child is needed.  Requires
+    the lzma module, see TXzTransport.  Encrypted chunks must still
+    go through decrypt_and_uncompress.  Compact-protocol chunks are
+    detected as in stream_items.
+    '''
+    opened = isinstance(xz_file, basestring)
+    if opened:
+        xz_file = open(xz_file, 'rb')
+    transport = TXzTransport(xz_file)
+    protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
+    try:
+        ## peek at the start for the magic, putting it back if absent
+        try:
+            buf = transport.cstringio_refill('', len(COMPACT_MAGIC))
+        except EOFError:
+            ## too short to hold even one StreamItem
+            return
+        if buf.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC:
+            protocol = TCompactProtocol(transport)
+        else:
+            buf.seek(0)
+        while 1:
+            doc = StreamItem()
+            try:
+                doc.read(protocol)
+            except EOFError:
+                break
+            yield doc
+    finally:
+        if opened:
+            xz_file.close()
+
+def stream_items_in_range(thrift_data, start_item, end_item, offset=None):
+    '''
+    Iterator over the StreamItems numbered start_item up to but not
+    including end_item in a buffer of thrift data, counting from zero.
+    If offset is provided, it must be the byte offset of StreamItem
+    start_item, e.g. from the item_offsets of chunk_stats, and the
+    earlier StreamItems are not even scanned.
+    '''
+    if offset is None:
+        offset = len(thrift_data)
+        if is_compact(thrift_data):
+            offsets = compact_item_offsets(thrift_data)
+            if start_item < len(offsets):
+                offset = offsets[start_item]
+        else:
+            for idx, (begin, end, fields) in enumerate(stream_item_spans(thrift_data)):
+                if idx == start_item:
+                    offset = begin
+                    break
+
+    transport, protocol = _item_protocol(thrift_data, offset)
+    for idx in xrange(start_item, end_item):
+        doc = StreamItem()
+        try:
+            doc.read(protocol)
+        except EOFError:
+            break
+        yield doc
+
+def robust_stream_items(thrift_data, on_skip, start_item=0, end_item=None, offset=None):
+    '''
+    Iterator over the StreamItems in a buffer of thrift data, like
+    stream_items_in_range with end_item=None meaning all the rest,
+    except that a StreamItem that cannot be decoded is skipped, and
+    reported by calling on_skip(stream_id, reason), where stream_id
+    is None if it cannot be read either.  If the thrift data is so
+    corrupt that the end of a StreamItem cannot be found, the rest
+    of the buffer is reported as one skip.
+
+    Compact-protocol StreamItems carry no lengths to find the next one
+    by, so in compact thrift data, the first one that cannot be decoded
+    is reported as a skip of the rest of the buffer.
+    '''
+    if is_compact(thrift_data):
+        for doc in _robust_compact_stream_items(thrift_data, on_skip, start_item, end_item, offset):
+            yield doc
+        return
+
+    transport = TTransport.TMemoryBuffer(thrift_data)
+    protocol = TBinaryProtocol.TBinaryProtocol(transport)
+
+    idx, pos = 0, 0
+    if offset is not None:
+        idx, pos = start_item, offset
+
+    while pos < len(thrift_data) and (end_item is None or idx < end_item):
+        try:
+            fields, end = struct_spans(thrift_data, pos)
+        except Exception, exc:
+            on_skip(None, 'unreadable from byte %d: %r' % (pos, exc))
+            return
+
+        if idx >= start_item:
+            transport.cstringio_buf.seek(pos)
+            doc = StreamItem()
+            try:
+                doc.read(protocol)
+            except Exception, exc:
+                try:
+                    stream_id = stream_item_key(thrift_data, fields)[1]
+                except Exception:
+                    stream_id = None
+                on_skip(stream_id, 'undecodable: %r' % exc)
+            else:
+                yield doc
+
+        idx += 1
+        pos = end
+
+def _robust_compact_stream_items(thrift_data, on_skip, start_item, end_item, offset):
+    '''
+    robust_stream_items for compact-protocol thrift_data
+    '''
+    idx = 0
+    if offset is not None:
+        idx = start_item
+    transport, protocol = _item_protocol(thrift_data, offset)
+    while transport.remaining() and (end_item is None or idx < end_item):
+        pos = transport.tell()
+        doc = StreamItem()
+        try:
+            if idx < start_item:
+                protocol.skip(Thrift.TType.STRUCT)
+            else:
+                doc.read(protocol)
+        except Exception, exc:
+            on_skip(None, 'unreadable from byte %d: %r' % (pos, exc))
+            return
+        if idx >= start_item:
+            yield doc
+        idx += 1
+
+def struct_spans(thrift_data, pos=0):
+    '''
+    Scans the binary-protocol struct that starts at byte offset pos in
+    thrift_data without decoding any of its values, and returns
+    (fields, end), where end is the offset just past the struct's STOP
+    byte and fields is a list of (fid, ftype, begin, end) tuples
+    giving the byte span of each top-level field, including its
+    three-byte field header.
+    '''
+    fields = []
+    while 1:
+        ftype, = unpack_from('!b', thrift_data, pos)
+        if ftype == Thrift.TType.STOP:
+            return fields, pos + 1
+        fid, = unpack_from('!h', thrift_data, pos + 1)
+        end = _skip_binary(thrift_data, pos + 3, ftype)
+        fields.append((fid, ftype, pos, end))
+        pos = end
+
+def _skip_binary(thrift_data, pos, ftype):
+    '''
+    returns the offset just past the binary-protocol value of type
+    ftype that starts at pos, using length prefixes to jump over
+    strings and lists of fixed-width values instead of reading them.
+    Nested structs and containers are walked with an explicit stack,
+    as in TBinaryProtocolFast.skip, rather than by recursion.
+    '''
+    widths = TBinaryProtocol.WIDTHS
+    data_len = len(thrift_data)
+    ## frames of the structs and containers being skipped:
+    ## [STRUCT], [LIST, etype, count], or [MAP, ktype, vtype, count]
+    ## where count is of the keys and values left
+    stack = []
+    while 1:
+        if ftype is not None:
+            if ftype in widths:
+                pos += widths[ftype]
+
+            elif ftype == Thrift.TType.STRING:
+                length, = unpack_from('!i', thrift_data, pos)
+                if length < 0:
+                    raise Thrift.TException('negative string length %d' % length)
+                pos += 4 + length
+
+            elif ftype == Thrift.TType.STRUCT:
+                stack.append([Thrift.TType.STRUCT])
+
+            elif ftype in (Thrift.TType.SET, Thrift.TType.LIST):
+                etype, size = unpack_from('!bi', thrift_data, pos)
+                pos += 5
+                if size < 0:
+                    raise Thrift.TException('negative list size %d' % size)
+                if etype in widths:
+                    pos += size * widths[etype]
+                elif size:
+                    stack.append([Thrift.TType.LIST, etype, size])
+
+            elif ftype == Thrift.TType.MAP:
+                ktype, vtype, size = unpack_from('!bbi', thrift_data, pos)
+                pos += 6
+                if size < 0:
+                    raise Thrift.TException('negative map size %d' % size)
+                if ktype in widths and vtype in widths:
+                    pos += size * (widths[ktype] + widths[vtype])
+                elif size:
+                    stack.append([Thrift.TType.MAP, ktype, vtype, 2 * size])
+
+            else:
+                raise Thrift.TException('cannot skip thrift type %r' % ftype)
+
+            if pos > data_len:
+                raise EOFError()
+            ftype = None
+
+        if not stack:
+            return pos
+        frame = stack[-1]
+        if frame[0] == Thrift.TType.STRUCT:
+            ftype, = unpack_from('!b', thrift_data, pos)
+            if ftype == Thrift.TType.STOP:
+                pos += 1
+                stack.pop()
+                ftype = None
+            else:
+                ## skip the field id
+                pos += 3
+        elif frame[0] == Thrift.TType.LIST:
+            ftype = frame[1]
+            frame[2] -= 1
+            if frame[2] == 0:
+                stack.pop()
+        else:
+            ## keys come before values, so an even count means a key
+            if frame[3] % 2 == 0:
+                ftype = frame[1]
+            else:
+                ftype = frame[2]
+            frame[3] -= 1
+            if frame[3] == 0:
+                stack.pop()
+
+def stream_items_with_spans(thrift_data):
+    '''
+    Iterator over (stream_item, spans) pairs from a buffer of thrift
+    data, where spans is a three-tuple (begin, end, fields) locating
+    the stream_item in thrift_data, and fields is the list of
+    per-field byte spans returned by struct_spans.  Pass the spans to
+    write_spliced to re-serialize a modified stream_item.
+    '''
+    ## TMemoryBuffer lets us ask its cStringIO for the read offset
+    transport = TTransport.TMemoryBuffer(thrift_data)
+    protocol = TBinaryProtocol.TBinaryProtocol(transport)
+
+    while 1:
+        doc = StreamItem()
+        begin = transport.cstringio_buf.tell()
+        try:
+            doc.read(protocol)
+        except EOFError:
+            break
+        end = transport.cstringio_buf.tell()
+
+        fields, scan_end = struct_spans(thrift_data, begin)
+        assert scan_end == end, 'scanned to %d, decoded to %d' % (scan_end, end)
+
+        yield doc, (begin, end, fields)
+
+def stream_item_spans(thrift_data):
+    '''
+    Iterator over (begin, end, fields) for every StreamItem in a
+    buffer of thrift data, found by scanning the bytes without
+    decoding any StreamItem; see struct_spans for fields.  The thrift
+    data must be in the binary protocol, see to_binary.
+    '''
+    assert not is_compact(thrift_data), \
+        'cannot scan spans in compact-protocol thrift data, see to_binary'
+    pos = 0
+    while pos < len(thrift_data):
+        fields, end = struct_spans(thrift_data, pos)
+        yield pos, end, fields
+        pos = end
+
+def stream_item_key(thrift_data, fields):
+    '''
+    Returns (stream_time.epoch_ticks, stream_id) for the StreamItem
+    whose field spans are fields, decoding only those two values.
+    Either is None if absent from the StreamItem.
+    '''
+    epoch_ticks = None
+    stream_id = None
+    for fid, ftype, f_begin, f_end in fields:
+        if fid == _stream_item_fids['stream_id'] and ftype == Thrift.TType.STRING:
+            ## skip the field header and the four-byte length
+            stream_id = thrift_data[f_begin + 7:f_end]
+
+        elif fid == _stream_item_fids['stream_time'] and ftype == Thrift.TType.STRUCT:
+            st_fields, st_end = struct_spans(thrift_data, f_begin + 3)
+            for st_fid, st_ftype, st_begin, st_end in st_fields:
+                if st_fid == _stream_time_fids['epoch_ticks'] and \
+                        st_ftype == Thrift.TType.DOUBLE:
+                    epoch_ticks, = unpack_from('!d', thrift_data, st_begin + 3)
+
+    return epoch_ticks, stream_id
+
+def stream_item_field(thrift_data, fields, path):
+    '''
+    Returns the value of the string field at path, such as 'doc_id'
+    or 'body.raw', of the StreamItem whose field spans are fields, as
+    a buffer over thrift_data, i.e. without copying or decoding the
+    StreamItem.  Returns None if the field is absent.
+    '''
+    spec = StreamItem.thrift_spec
+    names = path.split('.')
+    for depth, name in enumerate(names):
+        for field in spec:
+            if field is not None and field[2] == name:
+                break
+        else:
+            raise KeyError('no field %r in %r' % (name, path))
+        for fid, ftype, f_begin, f_end in fields:
+            if fid == field[0] and ftype == field[1]:
+                break
+        else:
+            return None
+
+        if depth == len(names) - 1:
+            assert ftype == Thrift.TType.STRING, '%r is not a string' % path
+            ## skip the field header and the four-byte length
+            return buffer(thrift_data, f_begin + 7, f_end - f_begin - 7)
+
+        assert ftype == Thrift.TType.STRUCT, '%r is not a struct' % name
+        spec = field[3][1]
+        fields, struct_end = struct_spans(thrift_data, f_begin + 3)
+
+def date_hour_range(date_hour):
+    '''
+    Returns the (start, end) epoch seconds of the hour named by a
+    date_hour string such as '2012-04-23-08', or None if date_hour is
+    not in that format.
+    '''
+    try:
+        start = calendar.timegm(time.strptime(date_hour, '%Y-%m-%d-%H'))
+    except ValueError:
+        return None
+    return start, start + 3600
+
+def _chunk_cursor(thrift_data, start=None, end=None):
+    '''
+    Iterator over ((epoch_ticks, stream_id), stream_item) for the
+    StreamItems in thrift_data with start <= epoch_ticks < end, in key
+    order.  Keys are read without decoding, and each StreamItem is
+    decoded only when the iterator reaches it.
+    '''
+    thrift_data = to_binary(thrift_data)
+    keyed = []
+    for begin, item_end, fields in stream_item_spans(thrift_data):
+        epoch_ticks, stream_id = stream_item_key(thrift_data, fields)
+        if epoch_ticks is None:
+            epoch_ticks = float('-inf')
+        if start is not None and epoch_ticks < start:
+            continue
+        if end is not None and epoch_ticks >= end:
+            continue
+        keyed.append(((epoch_ticks, stream_id or ''), begin))
+
+    ## nearly free if the chunk is already sorted
+    keyed.sort()
+
+    transport = TTransport.TMemoryBuffer(thrift_data)
+    protocol = TBinaryProtocol.TBinaryProtocol(transport)
+    for key, begin in keyed:
+        transport.cstringio_buf.seek(begin)
+        doc = StreamItem()
+        doc.read(protocol)
+        yield key, doc
+
+class BloomFilter(object):
+    '''
+    A fixed-size Bloom filter over byte strings.  The num_hashes bit
+    positions for a key are derived from its md5 by double hashing.
+    Membership tests have no false negatives, and false positives
+    occur at roughly the error_rate it was sized for.
+
+    If secret is given, positions are derived from the HMAC-MD5 of
+    each key under secret instead, so that only holders of secret
+    can test membership.
+    '''
+    def __init__(self, num_bits, num_hashes, bits=None, secret=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        if bits is None:
+            bits = bytearray((num_bits + 7) // 8)
+        self.bits = bits
+        self.secret = secret
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01, secret=None):
+        '''
+        Make a BloomFilter sized to hold capacity keys with the
+        requested false positive rate
+        '''
+        num_bits = int(math.ceil(-max(capacity, 1) * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(1, int(round(math.log(2) * num_bits / max(capacity, 1))))
+        return cls(num_bits, num_hashes, secret=secret)
+
+    def _positions(self, key):
+        if self.secret is None:
+            digest = hashlib.md5(key).digest()
+        else:
+            digest = hmac.new(self.secret, key, hashlib.md5).digest()
+        h1, h2 = unpack('<QQ', digest)
+        return [(h1 + idx * h2) % self.num_bits for idx in xrange(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_dict(self):
+        '''
+        make a JSON-compatible dict, see from_dict, which identifies
+        the secret, if any, without revealing it
+        '''
+        rec = {'num_bits': self.num_bits,
+               'num_hashes': self.num_hashes,
+               'bits': base64.b64encode(str(self.bits))}
+        if self.secret is not None:
+            rec['secret_id'] = _secret_id(self.secret)
+        return rec
+
+    @classmethod
+    def from_dict(cls, rec, secret=None):
+        '''
+        inverse of to_dict, or None if rec was made with a secret and
+        secret is not that one
+        '''
+        if 'secret_id' not in rec:
+            secret = None
+        elif secret is None or _secret_id(secret) != rec['secret_id']:
+            return None
+        return cls(rec['num_bits'], rec['num_hashes'],
+                   bytearray(base64.b64decode(rec['bits'])), secret)
+
+def _secret_id(secret):
+    'identifies a BloomFilter secret without revealing it'
+    return hmac.new(secret, 'secret_id', hashlib.md5).hexdigest()
+
+IDS_SECRET_FNAME = 'ids_bloom.secret'
+
+def ids_bloom_secret(gpg_dir='gnupg-dir', create=False):
+    '''
+    Returns the secret for the ids_bloom in the stats of encrypted
+    chunks, which is kept in gpg_dir next to the gpg keys, or None if
+    there is none.  If create is True and there is none, a random
+    secret is made first.
+
+    Copy this file into the gpg_dir of readers along with the gpg
+    private key, so that they can prune encrypted chunks by ids.
+    '''
+    secret_path = os.path.join(gpg_dir, IDS_SECRET_FNAME)
+    if create and not os.path.exists(secret_path):
+        if not os.path.exists(gpg_dir):
+            os.makedirs(gpg_dir)
+        tmp_path = '%s.partial.%d' % (secret_path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.write(fd, base64.b64encode(os.urandom(32)))
+        os.close(fd)
+        ## link rather than rename, so that a secret made concurrently
+        ## by another writer is never replaced
+        try:
+            os.link(tmp_path, secret_path)
+        except OSError:
+            if not os.path.exists(secret_path):
+                raise
+        finally:
+            os.remove(tmp_path)
+    if not os.path.exists(secret_path):
+        return None
+    return open(secret_path).read().strip()
+
+def chunk_stats(thrift_data, ids_secret=None):
+    '''
+    Computes a dict of statistics about a buffer of thrift data by
+    scanning it without decoding any StreamItem:
+
+        num_items        -- number of StreamItems
+        num_with_ner     -- number with NER on any ContentItem
+        min_epoch_ticks  -- earliest stream_time.epoch_ticks, or None
+        max_epoch_ticks  -- latest stream_time.epoch_ticks, or None
+        sources          -- dict of StreamItem.source --> count
+        field_bytes      -- dict of field name --> total bytes of
+                            that field across the chunk, including
+                            'body.raw', 'body.ner', etc.
+        ids_bloom        -- BloomFilter.to_dict() of all stream_ids
+                            and doc_ids, keyed with ids_secret if
+                            given, see chunk_may_match
+        content_md5      -- md5 of thrift_data, as in chunk file names
+        item_offsets     -- byte offset of each StreamItem in
+                            thrift_data, see stream_items_in_range
+        compact          -- True if thrift_data is in the compact
+                            protocol, in which case field_bytes are
+                            still counted as in the binary protocol
+    '''
+    if is_compact(thrift_data):
+        stats = chunk_stats(to_binary(thrift_data), ids_secret)
+        stats['content_md5'] = hashlib.md5(thrift_data).hexdigest()
+        stats['item_offsets'] = compact_item_offsets(thrift_data)
+        stats['compact'] = True
+        return stats
+
+    id_fields = (_stream_item_fids['stream_id'], _stream_item_fids['doc_id'])
+    source_fid = _stream_item_fids['source']
+    content_fids = dict((_stream_item_fids[name], name) for name in content_item_types)
+    content_names = dict((fid, name) for name, fid in _content_item_fids.items())
+    stream_item_names = dict((fid, name) for name, fid in _stream_item_fids.items())
+
+    all_spans = list(stream_item_spans(thrift_data))
+    bloom = BloomFilter.for_capacity(2 * len(all_spans), secret=ids_secret)
+    stats = {
+        'num_items': len(all_spans),
+        'num_with_ner': 0,
+        'min_epoch_ticks': None,
+        'max_epoch_ticks': None,
+        'sources': {},
+        'field_bytes': {},
+        'content_md5': hashlib.md5(thrift_data).hexdigest(),
+        'item_offsets': [begin for begin, end, fields in all_spans],
+        'compact': False,
+        }
+    field_bytes = stats['field_bytes']
+
+    for begin, end, fields in all_spans:
+        epoch_ticks, stream_id = stream_item_key(thrift_data, fields)
+        if epoch_ticks is not None:
+            if stats['min_epoch_ticks'] is None or epoch_ticks < stats['min_epoch_ticks']:
+                stats['min_epoch_ticks'] = epoch_ticks
+            if stats['max_epoch_ticks'] is None or epoch_ticks > stats['max_epoch_ticks']:
+                stats['max_epoch_ticks'] = epoch_ticks
+
+        has_ner = False
+        for fid, ftype, f_begin, f_end in fields:
+            name = stream_item_names.get(fid, str(fid))
+            field_bytes[name] = field_bytes.get(name, 0) + f_end - f_begin
+
+            if ftype == Thrift.TType.STRING and fid in id_fields:
+                bloom.add(thrift_data[f_begin + 7:f_end])
+
+            elif ftype == Thrift.TType.STRING and fid == source_fid:
+                source = thrift_data[f_begin + 7:f_end]
+                stats['sources'][source] = stats['sources'].get(source, 0) + 1
+
+            elif ftype == Thrift.TType.STRUCT and fid in content_fids:
+                ci_fields, ci_end = struct_spans(thrift_data, f_begin + 3)
+                for ci_fid, ci_ftype, ci_begin, ci_end in ci_fields:
+                    ci_name = '%s.%s' % (name, content_names.get(ci_fid, ci_fid))
+                    field_bytes[ci_name] = field_bytes.get(ci_name, 0) + ci_end - ci_begin
+                    ## a non-empty ner string is longer than its headers
+                    if ci_fid == _content_item_fids['ner'] and ci_end - ci_begin > 7:
+                        has_ner = True
+
+        if has_ner:
+            stats['num_with_ner'] += 1
+
+    stats['ids_bloom'] = bloom.to_dict()
+    return stats
+
+def chunk_stats_path(chunk_path):
+    'path to the stats sidecar file for the chunk file at chunk_path'
+    return chunk_path + '.stats.json'
+
+def write_chunk_stats(chunk_path, thrift_data, gpg_dir='gnupg-dir'):
+    '''
+    Writes the chunk_stats of thrift_data to the sidecar file of the
+    chunk file at chunk_path, using an atomic rename.  The sidecar is
+    not encrypted, so readers can consult it without decrypting the
+    chunk.
+
+    For that reason, the ids_bloom of an encrypted chunk, i.e. one
+    whose path ends with .gpg, is keyed with the ids_bloom_secret in
+    gpg_dir, made if needed, so that only readers with the secret can
+    test whether a stream_id or doc_id is in the chunk; see
+    chunk_may_match.
+    '''
+    ids_secret = None
+    if chunk_path.endswith('.gpg'):
+        ids_secret = ids_bloom_secret(gpg_dir, create=True)
+    stats = chunk_stats(thrift_data, ids_secret)
+    stats_path = chunk_stats_path(chunk_path)
+    fh = open(stats_path + '.partial', 'wb')
+    json.dump(stats, fh)
+    fh.close()
+    os.rename(stats_path + '.partial', stats_path)
+
+def read_chunk_stats(chunk_path):
+    '''
+    Returns the stats dict from the sidecar of the chunk file at
+    chunk_path, or None if it has no sidecar.
+    '''
+    stats_path = chunk_stats_path(chunk_path)
+    if not os.path.exists(stats_path):
+        return None
+    return json.load(open(stats_path))
+
+def write_chunk(thrift_data, out_dir, prefix, gpg_public=None, gpg_dir='gnupg-dir',
+                compact=None):
+    '''
+    Compresses (and possibly encrypts) thrift_data into a new chunk
+    file in out_dir named <prefix>.<md5 of thrift_data>.xz[.gpg],
+    using an atomic rename, along with its stats sidecar, and returns
+    its path.
+
+    If compact is True or False, the StreamItems are first converted
+    to the compact or binary protocol, and the md5 in the name is of
+    the converted thrift data.  By default they are written as given.
+    '''
+    if compact is not None:
+        thrift_data = convert_thrift_data(thrift_data, compact)
+    o_fname = '%s.%s.xz' % (prefix, hashlib.md5(thrift_data).hexdigest())
+    if gpg_public is not None:
+        o_fname += '.gpg'
+    o_fpath = os.path.join(out_dir, o_fname)
+    tmp_out_fpath = o_fpath + '.partial'
+
+    fh = open(tmp_out_fpath, 'wb')
+    fh.write(compress_and_encrypt(thrift_data, gpg_public, gpg_dir))
+    fh.close()
+
+    os.rename(tmp_out_fpath, o_fpath)
+    write_chunk_stats(o_fpath, thrift_data, gpg_dir)
+    return o_fpath
+
+def chunk_may_match(stats, start=None, end=None, ids=None, ids_secret=None):
+    '''
+    Returns False if the chunk described by stats certainly contains
+    no StreamItem with start <= epoch_ticks < end, or certainly
+    contains no StreamItem with a stream_id or doc_id in ids.  Any
+    of start, end, and ids may be None to not constrain on it.
+
+    The ids_bloom of an encrypted chunk can only be tested with the
+    ids_bloom_secret it was made with, so without ids_secret, or with
+    another one, ids never rule it out.
+    '''
+    if stats['num_items'] == 0:
+        return False
+
+    if start is not None or end is not None:
+        if stats['min_epoch_ticks'] is None:
+            return False
+        if start is not None and stats['max_epoch_ticks'] < start:
+            return False
+        if end is not None and stats['min_epoch_ticks'] >= end:
+            return False
+
+    if ids is not None and 'ids_bloom' in stats:
+        bloom = BloomFilter.from_dict(stats['ids_bloom'], ids_secret)
+    else:
+        bloom = None
+    if bloom is not None:
+        for _id in ids:
+            if _id in bloom:
+                break
+        else:
+            return False
+
+    return True
+
+def merged_stream(paths, start=None, end=None, gpg_private=None, gpg_dir='gnupg-dir'):
+    '''
+    Iterator over the StreamItems in all the chunk files in paths, in
+    (stream_time.epoch_ticks, stream_id) order, including only those
+    with start <= epoch_ticks < end.  paths may contain date_hour
+    directories and chunk files; either bound may be None.
+
+    Each chunk is sorted in memory by key, so chunks need not already
+    be sorted.  The chunks are merged through a heap of per-chunk
+    cursors, which holds at most one decoded StreamItem per open
+    chunk.  A date_hour directory that does not overlap [start, end)
+    is never read, and the chunks of one that does are only opened
+    when the stream reaches the start of its hour, so only the chunks
+    of the date_hours currently being interleaved are in memory.
+
+    Chunks with a stats sidecar (see write_chunk_stats) are skipped
+    without decrypting them if they cannot overlap [start, end), and
+    are otherwise opened only when the stream reaches their earliest
+    StreamItem.
+
+    This assumes that every StreamItem in a date_hour directory has
+    epoch_ticks within that hour, or at least not before it, as in
+    the corpus, where date_hours are the hours of stream_time.  A
+    StreamItem from before its hour comes out late, after StreamItems
+    with later keys; such StreamItems are counted and logged, but are
+    still yielded.
+    '''
+    ## heap entries are (key, seq, stream_item, source), where source
+    ## is either the cursor that yielded stream_item, or a path that
+    ## has not yet been opened, in which case stream_item is None.
+    ## seq breaks ties, so StreamItems are never compared.
+    heap = []
+    seqs = itertools.count()
+    last_key = None
+    num_out_of_order = 0
+
+    def queue_chunk(chunk_path, key):
+        stats = read_chunk_stats(chunk_path)
+        if stats is not None:
+            if not chunk_may_match(stats, start, end):
+                return
+            key = max(key, (stats['min_epoch_ticks'], ''))
+        heapq.heappush(heap, (key, seqs.next(), None, chunk_path))
+
+    for path in paths:
+        if os.path.isdir(path):
+            date_hour = os.path.basename(os.path.normpath(path))
+        else:
+            date_hour = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        hour_range = date_hour_range(date_hour)
+        if hour_range is None:
+            key = (float('-inf'), '')
+        else:
+            hour_start, hour_end = hour_range
+            if start is not None and hour_end <= start:
+                continue
+            if end is not None and hour_start >= end:
+                continue
+            key = (hour_start, '')
+
+        if os.path.isdir(path):
+            heapq.heappush(heap, (key, seqs.next(), None, path))
+        else:
+            queue_chunk(path, key)
+
+    while heap:
+        key, seq, stream_item, source = heapq.heappop(heap)
+
+        if stream_item is None:
+            if os.path.isdir(source):
+                ## the stream has reached this date_hour
+                for chunk_path in chunk_paths([source]):
+                    queue_chunk(chunk_path, key)
+            else:
+                ## the stream has reached this chunk, so open it
+                thrift_data = read_chunk(source, gpg_private, gpg_dir)
+                cursor = _chunk_cursor(thrift_data, start, end)
+                for next_key, next_item in cursor:
+                    heapq.heappush(heap, (next_key, seqs.next(), next_item, cursor))
+                    break
+            continue
+
+        if last_key is not None and key < last_key:
+            if num_out_of_order == 0:
+                log('merged_stream: %r came after %r; a date_hour dir or chunk '
+                    'has StreamItems from before its hour' % (key, last_key))
+            num_out_of_order += 1
+        else:
+            last_key = key
+
+        yield stream_item
+
+        ## advance the cursor that produced this stream_item
+        for next_key, next_item in source:
+            heapq.heappush(heap, (next_key, seqs.next(), next_item, source))
+            break
+
+    if num_out_of_order:
+        log('merged_stream: %d StreamItems out of order' % num_out_of_order)
+
+def _value_is_canonical(value, ftype, args, thrift_data, pos):
+    '''
+    True if the binary-protocol value of type ftype, with spec args,
+    that starts at pos in thrift_data is exactly what the generated
+    write() would produce for value
+    '''
+    if ftype == Thrift.TType.STRUCT:
+        fields, end = struct_spans(thrift_data, pos)
+        return _is_canonical(value, thrift_data, fields)
+
+    elif ftype == Thrift.TType.BOOL:
+        ## any nonzero byte reads as True, but write() makes 1
+        return thrift_data[pos] in '\x00\x01'
+
+    elif ftype == Thrift.TType.LIST:
+        etype, eargs = args
+        h_etype, size = unpack_from('!bi', thrift_data, pos)
+        if h_etype != etype or size != len(value):
+            return False
+        if etype in TBinaryProtocol.WIDTHS and etype != Thrift.TType.BOOL or \
+                etype == Thrift.TType.STRING:
+            return True
+        pos += 5
+        for elem in value:
+            if not _value_is_canonical(elem, etype, eargs, thrift_data, pos):
+                return False
+            pos = _skip_binary(thrift_data, pos, etype)
+        return True
+
+    elif ftype in (Thrift.TType.SET, Thrift.TType.MAP):
+        ## write() emits the elements in the iteration order of the
+        ## set or dict, which need not be the order they were read
+        ## in, so only flat containers are compared, by their headers
+        if ftype == Thrift.TType.SET:
+            etypes = (args[0],)
+            h_etypes, size = unpack_from('!bi', thrift_data, pos)
+            h_etypes = (h_etypes,)
+        else:
+            etypes = (args[0], args[2])
+            h_ktype, h_vtype, size = unpack_from('!bbi', thrift_data, pos)
+            h_etypes = (h_ktype, h_vtype)
+        if h_etypes != etypes or size != len(value):
+            return False
+        for etype in etypes:
+            if not (etype in TBinaryProtocol.WIDTHS and etype != Thrift.TType.BOOL or
+                    etype == Thrift.TType.STRING):
+                return False
+        return size <= 1
+
+    return True
+
+def _is_canonical(obj, thrift_data, fields, replace=()):
+    '''
+    True if the original bytes of obj, whose field spans in
+    thrift_data are fields, are exactly what the generated write()
+    would produce for it: ascending field ids, each with the type from
+    thrift_spec, no field that has since been set to None, and the
+    same in every nested struct and list of structs.  The fields named
+    in replace are only checked for their id and type.
+    '''
+    spec = getattr(obj, 'thrift_spec', None)
+    if spec is None:
+        return False
+    last_fid = 0
+    for fid, ftype, f_begin, f_end in fields:
+        if fid <= last_fid or fid >= len(spec) or spec[fid] is None:
+            return False
+        value = getattr(obj, spec[fid][2])
+        if spec[fid][1] != ftype or value is None:
+            return False
+        if spec[fid][2] not in replace and \
+                not _value_is_canonical(value, ftype, spec[fid][3], thrift_data, f_begin + 3):
+            return False
+        last_fid = fid
+    return True
+
+def write_spliced(o_transport, thrift_data, spans, stream_item, replace=('source_metadata',)):
+    '''
+    Writes stream_item to the file-like o_transport, producing bytes
+    identical to stream_item.write(TBinaryProtocol(o_transport)), but
+    only re-serializes the fields named in replace.  Every other field
+    is copied verbatim from its byte span in thrift_data, so the cost
+    is proportional to the size of the edit, not the document.
+
+    spans must be the value yielded alongside stream_item by
+    stream_items_with_spans(thrift_data), and only the fields named in
+    replace may have been modified since it was read.  If the original
+    bytes are not in the canonical layout that write() produces,
+    e.g. they carry fields unknown to kba_thrift, at the top level or
+    in any nested ContentItem or StreamTime, this falls back to a full
+    re-encode.
+    '''
+    begin, end, fields = spans
+    o_protocol = TBinaryProtocol.TBinaryProtocol(o_transport)
+
+    if not _is_canonical(stream_item, thrift_data, fields, replace):
+        stream_item.write(o_protocol)
+        return
+
+    ## spec entries for the replaced fields, in field id order
+    pending = sorted([field for field in stream_item.thrift_spec
+                      if field is not None and field[2] in replace])
+
+    ## the STOP byte ends the struct, and any replaced fields with ids
+    ## beyond the last original field are written just before it
+    fields = fields + [(None, Thrift.TType.STOP, end - 1, end)]
+
+    copy_from = begin
+    for fid, ftype, f_begin, f_end in fields:
+        while pending and (fid is None or pending[0][0] <= fid):
+            r_fid, r_ftype, r_name, r_spec, r_default = pending.pop(0)
+
+            ## copy the untouched bytes that precede the replacement
+            o_transport.write(buffer(thrift_data, copy_from, f_begin - copy_from))
+            copy_from = f_begin
+
+            if r_fid == fid:
+                ## drop the original encoding of this field
+                copy_from = f_end
+
+            value = getattr(stream_item, r_name)
+            if value is not None:
+                o_protocol.writeFieldBegin(r_name, r_ftype, r_fid)
+                o_protocol.writeFieldByTType(r_ftype, value, r_spec)
+                o_protocol.writeFieldEnd()
+
+    o_transport.write(buffer(thrift_data, copy_from, end - copy_from))
+
 class TokenizationException(Exception):
     pass
 
@@ -365,6 +1532,9 @@ def tokens(doc, content='body'):
     Provides an iterator interface over the NER tokens
 
     The 'content' parameter can be any of 'body', 'title', 'anchor'
+
+    Raises TokenizationException, naming the doc's stream_id, if a
+    line of NER cannot be parsed into a Token.
     '''
     assert content in content_item_types, \
         'content parameter was %s instead of %r' % (content, known_content)
@@ -392,9 +1562,9 @@ def tokens(doc, content='body'):
         try:
             tok = Token(line_number, sentence_number, fields[line_number])
         except TokenizationException, exc:
+            ## let the caller skip this doc and carry on with the rest
             log(traceback.format_exc(exc))
-            log(content_item.ner)
-            sys.exit('Failed on a TokenizationException in %s.' % doc.stream_id)
+            raise TokenizationException('Failed on a TokenizationException in %s.' % doc.stream_id)
         
         ## increment sentence_number after we pass a boundary, note
         ## that boundary tokens are part of the *preceeding* sentence
@@ -425,6 +1595,67 @@ def sentences(doc, content='body'):
     if this_sentence:
         yield this_sentence
 
+def count_ner(content_item):
+    '''
+    Returns (num_tokens, num_sentences) for the NER of content_item,
+    exactly as counted by iterating sentences() over it, i.e.
+    num_tokens is the number of Tokens that tokens() yields,
+    including sentence boundaries, and num_sentences is the number
+    of arrays that sentences() yields.
+
+    This counts tabs and newlines in bulk rather than building
+    Tokens, and follows the same record rules as fielded_records with
+    expected_field_counts [1, 7]: a newline ends a record only after
+    zero or six tabs, and is otherwise ignored.  Unlike tokens(), it
+    does not validate the fields of each token.
+    '''
+    ner = content_item.ner
+    if not ner:
+        return 0, 0
+
+    ## text after the last newline is never part of a record
+    ner = ner[:ner.rfind('\n') + 1]
+
+    ## reduce the NER to just its tabs and newlines, in which every
+    ## well-formed token line is six tabs and a newline
+    skeleton = ner.translate(None, _not_tab_or_newline)
+    boundaries = skeleton.replace(_token_skeleton, '')
+
+    if '\t' not in boundaries:
+        ## fast path: every newline ends a record
+        num_tokens = (len(skeleton) - len(boundaries)) // len(_token_skeleton)
+        num_boundaries = len(boundaries)
+        last_is_token = skeleton.endswith(_token_skeleton)
+
+    else:
+        ## replay the fielded_records state machine, carrying tabs
+        ## across the newlines that it ignores
+        num_boundaries = 0
+        num_tokens = 0
+        last_is_token = False
+        num_tabs = 0
+        for line in skeleton.split('\n')[:-1]:
+            num_tabs += len(line)
+            if num_tabs == 0:
+                num_boundaries += 1
+                last_is_token = False
+            elif num_tabs == 6:
+                num_tokens += 1
+                last_is_token = True
+                num_tabs = 0
+
+    ## a boundary ends a sentence, and any tokens after the last
+    ## boundary form one more
+    num_sentences = num_boundaries
+    if last_is_token:
+        num_sentences += 1
+
+    return num_tokens + num_boundaries, num_sentences
+
+## for count_ner
+_not_tab_or_newline = ''.join([chr(idx) for idx in range(256) if chr(idx) not in '\t\n'])
+_token_skeleton = '\t' * 6 + '\n'
+
 def get_annotation(path_to_annotation):
     '''
     Reads a file of TREC KBA 2012 annotation and returns a dict keyed
@@ -476,7 +1707,8 @@ def get_annotation(path_to_annotation):
 
 
 def filter_annotated_docs(annotation_path, thrift_dir, out_dir, date_hour,
-                          gpg_private=None, gpg_public=None, gpg_dir='gnupg-dir'):
+                          gpg_private=None, gpg_public=None, gpg_dir='gnupg-dir',
+                          timing_report=None):
     '''
     reads in the compressed (and possibly encrypted) thrift of
     thrift_dir and generates a duplicate that is identical except for
@@ -485,126 +1717,200 @@ def filter_annotated_docs(annotation_path, thrift_dir, out_dir, date_hour,
     The resulting data is re-compressed.  If gpg_public is provided,
     then it is also re-encrypted.
 
-    The new files are stored in out_dir/<date_hour>/ directories
-    
-    The stats.json files are ignored.
+    The new files are stored in out_dir/<date_hour>/ directories,
+    each with a stats sidecar, see write_chunk_stats.
+
+    The stats.json files are ignored, but input chunks with a stats
+    sidecar that rules out all annotated stream_ids are skipped
+    without decrypting them.
+
+    If timing_report is a path, the time, bytes, and items of every
+    stage of processing are written there as JSON lines, one per
+    input file that is read, with 'file' and 'stages' keys, and a
+    last line for the whole run, with 'run' and 'stages' keys; see
+    StageTimer.  The report is written to timing_report.partial and
+    renamed when the run completes, so it is never left truncated.
     '''
     annotation = get_annotation(annotation_path)
+    ids_secret = ids_bloom_secret(gpg_dir)
+
+    timing_fh = None
+    if timing_report is not None:
+        ## renamed into place once the run completes, so a failed run
+        ## leaves the lines of the files done so far in the .partial
+        timing_fh = open(timing_report + '.partial', 'wb')
+        run_timer = StageTimer()
+
+    try:
+        ## prepare to write files an a temp version of out_dir.  We will
+        ## do an atomic rename of this dir after it is finished.
+        out_dir = os.path.join(out_dir, date_hour)
+        tmp_out_dir = out_dir + '.partial'
+
+        if not os.path.exists(tmp_out_dir):
+            os.makedirs(tmp_out_dir)
+
+        ## loop over all files from input dir
+        num_files = 0
+        num_pruned = 0
+        for i_fname in os.listdir(os.path.join(thrift_dir, date_hour)):
+            ## ignore other files, e.g. stats.json and stats sidecars
+            if not is_chunk_file(i_fname):
+                continue
 
-    ## prepare to write files an a temp version of out_dir.  We will
-    ## do an atomic rename of this dir after it is finished.
-    out_dir = os.path.join(out_dir, date_hour)
-    tmp_out_dir = out_dir + '.partial'
+            ## get subcorpus name and original_md5 for use in new output
+            ## file names
+            subcorpus, o_content_md5, _xz, _gpg = i_fname.split('.')
+            assert subcorpus in ['news', 'linking', 'social'], subcorpus
 
-    if not os.path.exists(tmp_out_dir):
-        os.makedirs(tmp_out_dir)
+            ## construct input file path
+            i_fpath = os.path.join(thrift_dir, date_hour, i_fname)
 
-    ## loop over all files from input dir
-    num_files = 0
-    for i_fname in os.listdir(os.path.join(thrift_dir, date_hour)):
-        ## ignore other files, e.g. stats.json
-        if not (i_fname.endswith('.xz.gpg') or i_fname.endswith('.xz')):
-            continue
+            ## if the chunk has a stats sidecar, skip it without
+            ## decrypting if it has none of the annotated stream_ids
+            i_stats = read_chunk_stats(i_fpath)
+            if i_stats is not None and not chunk_may_match(i_stats, ids=annotation,
+                                                           ids_secret=ids_secret):
+                num_pruned += 1
+                continue
 
-        ## get subcorpus name and original_md5 for use in new output
-        ## file names
-        subcorpus, o_content_md5, _xz, _gpg = i_fname.split('.')
-        assert subcorpus in ['news', 'linking', 'social'], subcorpus
+            timer = NULL_TIMER
+            if timing_report is not None:
+                timer = StageTimer()
 
-        ## construct input file path
-        i_fpath = os.path.join(thrift_dir, date_hour, i_fname)
+            ## load the encrypted data
+            with timer.stage('read') as stage:
+                i_encrypted_data = open(i_fpath).read()
+                stage.add(nbytes=len(i_encrypted_data))
 
-        ## load the encrypted data
-        i_encrypted_data = open(i_fpath).read()
+            assert len(i_encrypted_data) > 0, 'failed to load: %s' % fpath
 
-        assert len(i_encrypted_data) > 0, 'failed to load: %s' % fpath
+            ## decrypt and uncompress using subprocess tools above
+            i_thrift_data = decrypt_and_uncompress(i_encrypted_data, gpg_private, gpg_dir, timer)
 
-        ## decrypt and uncompress using subprocess tools above
-        i_thrift_data = decrypt_and_uncompress(i_encrypted_data, gpg_private, gpg_dir)
+            ## compare md5 hashes:
+            with timer.stage('md5_verify') as stage:
+                i_content_md5 = hashlib.md5(i_thrift_data).hexdigest()
+                stage.add(nbytes=len(i_thrift_data))
+            assert i_content_md5 == i_fname.split('.')[1], \
+                '%r != %r' % (i_content_md5, o_content_md5)
 
-        ## compare md5 hashes:
-        i_content_md5 = hashlib.md5(i_thrift_data).hexdigest()
-        assert i_content_md5 == i_fname.split('.')[1], \
-            '%r != %r' % (i_content_md5, o_content_md5)
+            ## splicing needs the byte spans of the binary protocol
+            i_thrift_data = to_binary(i_thrift_data)
 
-        ## Make output file obj for thrift, wrap in protocol
-        o_transport = StringIO()
-        o_protocol = TBinaryProtocol.TBinaryProtocol(o_transport)
+            ## Make output file obj for thrift
+            o_transport = StringIO()
 
-        ## iterate over input stream items
-        num_annotated = 0
-        for stream_item in stream_items(i_thrift_data):
+            ## iterate over input stream items
+            num_annotated = 0
+            for stream_item, spans in timer.timed_iter('decode', stream_items_with_spans(i_thrift_data)):
             
-            ## only keep those docs that have annotation
-            if not stream_item.stream_id in annotation:
+                ## only keep those docs that have annotation
+                if not stream_item.stream_id in annotation:
+                    continue
+                else:
+                    log('%s has annotation for %s' % (
+                        stream_item.stream_id,
+                        ', '.join(annotation[stream_item.stream_id].keys())))
+
+                with timer.stage('rewrite_metadata') as stage:
+                    ## Every stream_item has a source_metadata JSON string,
+                    ## which we can load and extend to include the annotation:
+                    source_metadata = json.loads(stream_item.source_metadata)
+                    source_metadata['annotation'] = annotation[stream_item.stream_id]
+
+                    ## We can just replace the source_metadata string, and
+                    ## thrift will serialize it into output o_transport
+                    stream_item.source_metadata = json.dumps(source_metadata)
+                    stage.add(items=1)
+
+                ## write modified stream_item object to new output file,
+                ## copying the bytes of all the other fields verbatim
+                with timer.stage('encode') as stage:
+                    write_spliced(o_transport, i_thrift_data, spans, stream_item,
+                                  replace=['source_metadata'])
+                    stage.add(items=1)
+
+                num_annotated += 1
+
+            if num_annotated == 0:
+                ## do not save an empty file
+                if timing_report is not None:
+                    _write_timing(timing_fh, 'file', i_fpath, timer, run_timer)
                 continue
-            else:
-                log('%s has annotation for %s' % (
-                    stream_item.stream_id,
-                    ', '.join(annotation[stream_item.stream_id].keys())))
-
-            ## Every stream_item has a source_metadata JSON string,
-            ## which we can load and extend to include the annotation:
-            source_metadata = json.loads(stream_item.source_metadata)
-            source_metadata['annotation'] = annotation[stream_item.stream_id]
-
-            ## We can just replace the source_metadata string, and
-            ## thrift will serialize it into output o_protocol
-            stream_item.source_metadata = json.dumps(source_metadata)
-
-            ## write modified stream_item object to new output file
-            stream_item.write(o_protocol)
-
-            num_annotated += 1
-
-        if num_annotated == 0:
-            ## do not save an empty file
-            continue
         
-        ## prepare to write out the new file
-        o_transport.seek(0)
-        o_thrift_data = o_transport.getvalue()
+            ## prepare to write out the new file
+            o_transport.seek(0)
+            o_thrift_data = o_transport.getvalue()
 
-        ## compute md5 of uncompressed data
-        o_content_md5 = hashlib.md5(o_thrift_data).hexdigest()
+            ## compute md5 of uncompressed data
+            o_content_md5 = hashlib.md5(o_thrift_data).hexdigest()
         
-        ## construct output filename
-        o_fname = '%s.%s.%s.xz' % (subcorpus, o_content_md5, i_content_md5)
+            ## construct output filename
+            o_fname = '%s.%s.%s.xz' % (subcorpus, o_content_md5, i_content_md5)
 
-        ## put gpg extension only if we are encrypting output
-        if gpg_public is not None:
-            o_fname += '.gpg'
+            ## put gpg extension only if we are encrypting output
+            if gpg_public is not None:
+                o_fname += '.gpg'
 
-        # output file
-        o_fpath = os.path.join(tmp_out_dir, o_fname)
+            # output file
+            o_fpath = os.path.join(tmp_out_dir, o_fname)
         
-        ## temporary output file called .partial, which will be
-        ## atomically renamed upon completion.  This provides
-        ## robustness against crashes or restarts in condor.
-        tmp_out_fpath = o_fpath + '.partial'
-
-        ## compress and encrypt the data
-        o_encrypted_data = compress_and_encrypt(o_thrift_data, gpg_public, gpg_dir)
-
-        ## write it to the tmp file 
-        fh = open(tmp_out_fpath, 'wb')
-        fh.write(o_encrypted_data)
-        fh.close()
-
-        ## atomic move of fully written file
-        os.rename(tmp_out_fpath, o_fpath)
-
-        ## loop to next input thrift file
-        num_files += 1
-
-        ## free memory
-        o_encrypted_data = None
-        o_thrift_data = None
-
-    ## atomic move of tmp_out_dir to out_dir
-    log('renaming %s --> %s' % (tmp_out_dir, out_dir))
-    os.rename(tmp_out_dir, out_dir)
-    log('Done!  created %d files' % num_files)
+            ## temporary output file called .partial, which will be
+            ## atomically renamed upon completion.  This provides
+            ## robustness against crashes or restarts in condor.
+            tmp_out_fpath = o_fpath + '.partial'
+
+            ## compress and encrypt the data
+            o_encrypted_data = compress_and_encrypt(o_thrift_data, gpg_public, gpg_dir, timer=timer)
+
+            with timer.stage('write') as stage:
+                ## write it to the tmp file 
+                fh = open(tmp_out_fpath, 'wb')
+                fh.write(o_encrypted_data)
+                fh.close()
+
+                ## atomic move of fully written file
+                os.rename(tmp_out_fpath, o_fpath)
+                stage.add(nbytes=len(o_encrypted_data))
+
+            ## record stats for pruning later reads of the new file
+            with timer.stage('write_stats') as stage:
+                write_chunk_stats(o_fpath, o_thrift_data, gpg_dir)
+                stage.add(nbytes=len(o_thrift_data))
+
+            if timing_report is not None:
+                _write_timing(timing_fh, 'file', i_fpath, timer, run_timer)
+
+            ## loop to next input thrift file
+            num_files += 1
+
+            ## free memory
+            o_encrypted_data = None
+            o_thrift_data = None
+
+        ## atomic move of tmp_out_dir to out_dir
+        log('renaming %s --> %s' % (tmp_out_dir, out_dir))
+        os.rename(tmp_out_dir, out_dir)
+        log('Done!  created %d files, pruned %d using stats' % (num_files, num_pruned))
+
+        if timing_report is not None:
+            _write_timing(timing_fh, 'run', date_hour, run_timer)
+    finally:
+        if timing_fh is not None:
+            timing_fh.close()
+
+    if timing_report is not None:
+        os.rename(timing_report + '.partial', timing_report)
+
+def _write_timing(fh, kind, name, timer, run_timer=None):
+    '''
+    writes a JSON line reporting timer to fh, and adds it into
+    run_timer, if provided
+    '''
+    fh.write(json.dumps({kind: name, 'stages': timer.report()}) + '\n')
+    if run_timer is not None:
+        run_timer.merge(timer)
 
 if __name__ == '__main__':
     ## argparse is in python 2.7, and is can be used on early python
@@ -618,6 +1924,7 @@ if __name__ == '__main__':
     parser.add_argument('--public', default=None, help='Provide GPG encryption (public) key for re-saving corpus')
     parser.add_argument('--gpgdir', default='gnupg-dir', help='dir for storing gpg files, e.g. keys')
     parser.add_argument('--path', nargs='?', action='append', help='add path to python library dirs, can be used multiple times.')
+    parser.add_argument('--timing-report', default=None, help='path for a JSON lines report of the time spent in each stage, per file and for the run')
     args = parser.parse_args()
 
     ## add any needed paths to python path, so we can import things
@@ -632,4 +1939,4 @@ if __name__ == '__main__':
     ## import the KBA-specific thrift types
     from kba_thrift.ttypes import StreamItem
 
-    filter_annotated_docs(args.annotation, args.thrift_dir, args.out_dir, args.date_hour, gpg_private=args.private, gpg_public=args.public, gpg_dir=args.gpgdir)
+    filter_annotated_docs(args.annotation, args.thrift_dir, args.out_dir, args.date_hour, gpg_private=args.private, gpg_public=args.public, gpg_dir=args.gpgdir, timing_report=args.timing_report)
@@ -0,0 +1,484 @@
+'''
+Fetching chunk files by URL, with a content-addressed local cache.
+
+Chunk file names embed the md5 of their uncompressed thrift data,
+e.g. news.<md5>.xz.gpg, so a chunk fetched once can be reused by any
+later job on the same node, and verified by decrypting it and
+checking its md5.  The cache holds the fetched bytes as they were
+downloaded, i.e. still encrypted.
+'''
+
+import os
+import sys
+import time
+import errno
+import random
+import socket
+import shutil
+import urllib
+import hashlib
+import httplib
+import urlparse
+import tempfile
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+import kba_corpus
+
+## default size cap for a ChunkCache
+DEFAULT_CACHE_BYTES = 10 * 2**30
+
+## attempts at fetching a chunk before giving up, with exponential
+## backoff starting at DEFAULT_BACKOFF_SECONDS between attempts
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+## a stalled connection counts as a transient error after this long
+HTTP_TIMEOUT_SECONDS = 60
+
+class ChunkVerificationError(Exception):
+    pass
+
+class HTTPStatusError(IOError):
+    def __init__(self, status, url):
+        IOError.__init__(self, 'HTTP status %d fetching %s' % (status, url))
+        self.status = status
+
+def _is_transient(exc):
+    '''
+    True if exc is an error that fetching again might not repeat:
+    server errors and throttling, dropped connections, and timeouts
+    '''
+    if isinstance(exc, HTTPStatusError):
+        return exc.status >= 500 or exc.status in (408, 429)
+    return isinstance(exc, (socket.error, httplib.HTTPException))
+
+def chunk_md5(url):
+    '''
+    Returns the content md5 embedded in the file name of a chunk URL
+    or path, i.e. the second dot-separated part, or None if the name
+    has no md5 in that position.
+    '''
+    parts = os.path.basename(url).split('.')
+    if len(parts) < 3:
+        return None
+    md5 = parts[1].lower()
+    if len(md5) != 32 or md5.strip('0123456789abcdef'):
+        return None
+    return md5
+
+class ChunkCache(object):
+    '''
+    A directory of fetched chunk files named by their content md5,
+    capped at max_bytes by evicting the least recently used files.
+
+    Several processes on one node may share a cache_dir: files are
+    written under temporary names and atomically renamed into place,
+    and a file that another process evicts while it is being read
+    stays readable until closed.
+    '''
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(cache_dir)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def path(self, md5):
+        return os.path.join(self.cache_dir, md5)
+
+    def get(self, md5):
+        '''
+        Returns the cached bytes for md5, or None if not cached
+        '''
+        try:
+            fh = open(self.path(md5), 'rb')
+            data = fh.read()
+            fh.close()
+        except IOError:
+            return None
+        self.touch(md5)
+        return data
+
+    def touch(self, md5):
+        '''
+        Marks the file for md5 as recently used, and returns False if
+        it is not cached, e.g. if it was just evicted
+        '''
+        try:
+            os.utime(self.path(md5), None)
+        except OSError:
+            return False
+        return True
+
+    def put(self, md5, data):
+        '''
+        Stores data under md5, then evicts files as needed to stay
+        under max_bytes
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.partial.')
+        try:
+            fh = os.fdopen(fd, 'wb')
+            fh.write(data)
+            fh.close()
+            os.rename(tmp_path, self.path(md5))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def adopt(self, md5, path):
+        '''
+        Moves the file at path, which must be on the same filesystem
+        as cache_dir, into the cache under md5, then evicts files as
+        needed to stay under max_bytes
+        '''
+        os.rename(path, self.path(md5))
+        self.evict()
+
+    def remove(self, md5):
+        try:
+            os.remove(self.path(md5))
+        except OSError:
+            pass
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache is
+        under max_bytes
+        '''
+        entries = []
+        total_bytes = 0
+        for fname in os.listdir(self.cache_dir):
+            if fname.startswith('.partial.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, fname))
+            except OSError:
+                ## evicted by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+            total_bytes += st.st_size
+
+        entries.sort()
+        while total_bytes > self.max_bytes and entries:
+            mtime, size, fname = entries.pop(0)
+            self.remove(fname)
+            total_bytes -= size
+
+def fetch_chunk(url, cache=None, gpg_private=None, gpg_dir='gnupg-dir',
+                max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    '''
+    Fetches the chunk file at url, retrying transient errors as in
+    copy_url, decrypts (if gpg_private is provided) and uncompresses
+    it, and returns its thrift data.
+
+    If the file name embeds a content md5, the thrift data is
+    verified against it, raising ChunkVerificationError on mismatch,
+    and a ChunkCache passed as cache is consulted before fetching
+    and updated after.
+    '''
+    md5 = chunk_md5(url)
+
+    if cache is not None and md5 is not None:
+        data = cache.get(md5)
+        if data is not None:
+            thrift_data = _cached_thrift_data(url, md5, data, cache, gpg_private, gpg_dir)
+            if thrift_data is not None:
+                return thrift_data
+
+    o_fh = StringIO()
+    copy_url(url, o_fh, max_attempts, backoff_seconds)
+    data = o_fh.getvalue()
+    thrift_data = _verified_thrift_data(url, md5, data, gpg_private, gpg_dir)
+
+    if md5 is not None and cache is not None:
+        cache.put(md5, data)
+
+    return thrift_data
+
+def _verified_thrift_data(url, md5, data, gpg_private, gpg_dir, timer=kba_corpus.NULL_TIMER):
+    '''
+    decrypts and uncompresses the fetched bytes of the chunk at url,
+    and checks the result against md5, unless it is None
+    '''
+    thrift_data = kba_corpus.decrypt_and_uncompress(data, gpg_private, gpg_dir, timer)
+    if md5 is not None:
+        with timer.stage('md5_verify') as stage:
+            actual_md5 = hashlib.md5(thrift_data).hexdigest()
+            stage.add(nbytes=len(thrift_data))
+        if actual_md5 != md5:
+            raise ChunkVerificationError('%s has md5 %s' % (url, actual_md5))
+    return thrift_data
+
+def _cached_thrift_data(url, md5, data, cache, gpg_private, gpg_dir, timer=kba_corpus.NULL_TIMER):
+    '''
+    returns the verified thrift data of a cached copy of the chunk at
+    url, or evicts the copy and returns None if it is corrupt
+    '''
+    try:
+        return _verified_thrift_data(url, md5, data, gpg_private, gpg_dir, timer)
+    except (AssertionError, ChunkVerificationError):
+        kba_corpus.log('evicting corrupt cached copy of %s' % url)
+        cache.remove(md5)
+        return None
+
+## per-thread HTTP connections, keyed on (scheme, netloc)
+_connections = threading.local()
+
+def _http_get(scheme, netloc, path, o_fh):
+    '''
+    GETs path from netloc over a connection that this thread keeps
+    open for later requests, and writes the body to o_fh
+    '''
+    if not hasattr(_connections, 'by_host'):
+        _connections.by_host = {}
+
+    for attempt in range(2):
+        conn = _connections.by_host.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=HTTP_TIMEOUT_SECONDS)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=HTTP_TIMEOUT_SECONDS)
+            _connections.by_host[(scheme, netloc)] = conn
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            break
+        except (httplib.HTTPException, socket.error):
+            ## the server may have closed an idle connection, so
+            ## reconnect once
+            conn.close()
+            del _connections.by_host[(scheme, netloc)]
+            if attempt == 1:
+                raise
+
+    if response.status != 200:
+        response.read()
+        raise HTTPStatusError(response.status, '%s://%s%s' % (scheme, netloc, path))
+    while 1:
+        block = response.read(2**20)
+        if not block:
+            break
+        o_fh.write(block)
+
+def copy_url(url, o_fh, max_attempts=DEFAULT_MAX_ATTEMPTS,
+             backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    '''
+    Writes the file at url to the seekable file object o_fh, reusing
+    this thread's connection to the host for HTTP URLs.  Transient
+    errors, see _is_transient, are retried up to max_attempts in all,
+    waiting about backoff_seconds, then twice that, and so on, with
+    random jitter so that many tasks do not retry in lockstep.
+    '''
+    for attempt in range(max_attempts):
+        o_fh.seek(0)
+        o_fh.truncate()
+        try:
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            if scheme in ('http', 'https'):
+                if query:
+                    path += '?' + query
+                _http_get(scheme, netloc, path or '/', o_fh)
+            else:
+                i_fh = urllib.urlopen(url)
+                shutil.copyfileobj(i_fh, o_fh)
+                i_fh.close()
+            return
+        except Exception, exc:
+            if attempt + 1 == max_attempts or not _is_transient(exc):
+                raise
+            delay = backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+            kba_corpus.log('retrying %s in %.1f seconds after: %s' % (url, delay, exc))
+            time.sleep(delay)
+
+def download(url, tmp_dir=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+             backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    '''
+    Downloads the file at url into a new temporary file in tmp_dir,
+    as in copy_url, and returns the temporary file's path.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix='.partial.')
+    o_fh = os.fdopen(fd, 'wb')
+    try:
+        copy_url(url, o_fh, max_attempts, backoff_seconds)
+        o_fh.close()
+    except:
+        o_fh.close()
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+def _prefetch(url, cache, tmp_dir, max_attempts, backoff_seconds):
+    '''
+    runs in a prefetch thread, and returns (path, is_cached) for a
+    local copy of the chunk at url
+    '''
+    md5 = chunk_md5(url)
+    if cache is not None and md5 is not None and cache.touch(md5):
+        return cache.path(md5), True
+    return download(url, tmp_dir, max_attempts, backoff_seconds), False
+
+class FetchedChunk(object):
+    '''
+    A chunk file at url that prefetch_chunks has downloaded, or is
+    downloading, to a local file.  Call thrift_data() to wait for
+    it, and decrypt, uncompress and verify it, which raises any
+    error from the download.  Pass it a kba_corpus.StageTimer to
+    record the 'fetch_wait' and 'read' stages as well as those of
+    decrypting and verifying.
+    '''
+    def __init__(self, url, async_result, cache, gpg_private, gpg_dir):
+        self.url = url
+        self._async_result = async_result
+        self._cache = cache
+        self._gpg_private = gpg_private
+        self._gpg_dir = gpg_dir
+        self._is_read = False
+
+    def discard(self):
+        '''
+        remove the downloaded file, if it was never read, waiting for
+        the download to finish if it is still in flight
+        '''
+        if self._is_read:
+            return
+        self._async_result.wait()
+        if not self._async_result.successful():
+            return
+        path, is_cached = self._async_result.get()
+        if not is_cached and os.path.exists(path):
+            os.remove(path)
+
+    def thrift_data(self, timer=kba_corpus.NULL_TIMER):
+        md5 = chunk_md5(self.url)
+        with timer.stage('fetch_wait'):
+            path, is_cached = self._async_result.get()
+        self._is_read = True
+        try:
+            with timer.stage('read') as stage:
+                data = open(path, 'rb').read()
+                stage.add(nbytes=len(data))
+        except IOError:
+            ## evicted since the prefetch thread found it
+            return fetch_chunk(self.url, self._cache, self._gpg_private, self._gpg_dir)
+
+        if is_cached:
+            thrift_data = _cached_thrift_data(self.url, md5, data, self._cache,
+                                              self._gpg_private, self._gpg_dir, timer)
+            if thrift_data is None:
+                return fetch_chunk(self.url, self._cache, self._gpg_private, self._gpg_dir)
+            return thrift_data
+
+        try:
+            thrift_data = _verified_thrift_data(self.url, md5, data,
+                                                self._gpg_private, self._gpg_dir, timer)
+            if md5 is not None and self._cache is not None:
+                self._cache.adopt(md5, path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        return thrift_data
+
+class _SerialResult(object):
+    '''
+    Stands in for the AsyncResult of a prefetch when max_in_flight is
+    0, calling func(*args) in the caller's thread on the first get()
+    '''
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._value = None
+        self._exc_info = None
+        self._done = False
+
+    def get(self):
+        if not self._done:
+            self._done = True
+            try:
+                self._value = self._func(*self._args)
+            except Exception:
+                self._exc_info = sys.exc_info()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def wait(self):
+        ## nothing is in flight until get() is called
+        pass
+
+    def successful(self):
+        return self._done and self._exc_info is None
+
+def prefetch_chunks(urls, max_in_flight=4, cache=None, tmp_dir=None,
+                    gpg_private=None, gpg_dir='gnupg-dir',
+                    max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_seconds=DEFAULT_BACKOFF_SECONDS):
+    '''
+    Iterator over a FetchedChunk for each of urls, in order, while
+    up to max_in_flight of the following chunks are downloaded in a
+    pool of threads, so that the network is busy while the caller
+    decrypts and decodes.  Each thread reuses its HTTP connection to
+    a host across downloads, and retries transient errors as in
+    copy_url.
+
+    Chunks already in the ChunkCache passed as cache are not
+    downloaded, and verified downloads are added to it.  Downloads
+    go to temporary files in the cache's dir, or in tmp_dir if there
+    is no cache, and are removed once read.
+
+    With max_in_flight=0, nothing is downloaded ahead: each chunk is
+    fetched in the caller's thread when its thrift_data() is called.
+    '''
+    if max_in_flight < 0:
+        raise ValueError('max_in_flight must be >= 0, not %r' % max_in_flight)
+    if cache is not None:
+        tmp_dir = cache.cache_dir
+
+    if max_in_flight == 0:
+        for url in urls:
+            chunk = FetchedChunk(url, _SerialResult(
+                    _prefetch, (url, cache, tmp_dir, max_attempts, backoff_seconds)),
+                                 cache, gpg_private, gpg_dir)
+            try:
+                yield chunk
+            finally:
+                chunk.discard()
+        return
+
+    pool = ThreadPool(max_in_flight)
+    def start(url):
+        async_result = pool.apply_async(
+            _prefetch, (url, cache, tmp_dir, max_attempts, backoff_seconds))
+        return FetchedChunk(url, async_result, cache, gpg_private, gpg_dir)
+
+    fetched = []
+    try:
+        urls = iter(urls)
+        for url in urls:
+            fetched.append(start(url))
+            if len(fetched) == max_in_flight:
+                break
+
+        while fetched:
+            for next_url in urls:
+                fetched.append(start(next_url))
+                break
+            chunk = fetched.pop(0)
+            try:
+                yield chunk
+            finally:
+                ## in case the caller moved on without reading it
+                chunk.discard()
+
+    finally:
+        ## if the caller stopped early, let the downloads in flight
+        ## finish, and remove them
+        pool.close()
+        pool.join()
+        for chunk in fetched:
+            chunk.discard()
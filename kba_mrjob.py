@@ -0,0 +1,89 @@
+'''
+Helpers for mrjob jobs that process the KBA corpus, such as
+subcorpus_counter.py
+'''
+
+import time
+
+import kba_corpus
+
+class BatchedCounters(object):
+    '''
+    Aggregates Hadoop counter increments for an MRJob in a local dict
+    and passes them to job.increment_counter in batches.
+
+    Under Hadoop streaming, every increment_counter call writes a
+    reporter:counter: line to stderr, so counting per StreamItem
+    costs millions of writes per task.  This flushes after max_calls
+    increments or max_seconds, whichever comes first, which still
+    tells Hadoop that the task is alive as long as max_seconds is
+    well under mapred.task.timeout.  Call flush() at the end of the
+    task, e.g. in mapper_final, to report the remainder.
+    '''
+    def __init__(self, job, max_calls=10000, max_seconds=30):
+        self.job = job
+        self.max_calls = max_calls
+        self.max_seconds = max_seconds
+        self._pending = {}
+        self._num_calls = 0
+        self._last_flush = time.time()
+
+    def increment(self, group, counter, amount=1):
+        'same signature as MRJob.increment_counter'
+        key = (group, counter)
+        self._pending[key] = self._pending.get(key, 0) + amount
+        self._num_calls += 1
+        if self._num_calls >= self.max_calls or \
+                time.time() - self._last_flush >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        'report all pending increments to Hadoop'
+        for (group, counter), amount in self._pending.iteritems():
+            self.job.increment_counter(group, counter, amount)
+        self._pending = {}
+        self._num_calls = 0
+        self._last_flush = time.time()
+
+class SkipRecorder(object):
+    '''
+    Records StreamItems that a job skips because they could not be
+    decoded or processed, so that one bad StreamItem does not cost
+    the rest of its chunk.  Pass it as the on_skip callback of
+    kba_corpus.robust_stream_items, or call it directly with the
+    stream_id and reason when processing a StreamItem fails.
+
+    Each skip is logged, counted in the 'SkippedStreamItems' counter
+    of group through counters, a BatchedCounters, and kept in
+    self.records as [url, stream_id, reason], where url is whatever
+    was last assigned to self.url.  Only the first max_records are
+    kept, to bound memory on a badly corrupt input.
+    '''
+    def __init__(self, counters, group, max_records=1000):
+        self.counters = counters
+        self.group = group
+        self.max_records = max_records
+        self.url = None
+        self.records = []
+        self.num_skipped = 0
+
+    def __call__(self, stream_id, reason):
+        kba_corpus.log('skipping StreamItem %s in %s: %s' % (stream_id, self.url, reason))
+        self.counters.increment(self.group, 'SkippedStreamItems', 1)
+        self.num_skipped += 1
+        if len(self.records) < self.max_records:
+            self.records.append([self.url, stream_id, reason])
+
+def increment_timer_counters(job, group, timer):
+    '''
+    Mirrors the totals of a kba_corpus.StageTimer as Hadoop counters
+    of job in group: <stage>-ms, <stage>-bytes, and <stage>-items for
+    each stage, omitting zeros.  Call it once at the end of a task,
+    as the totals are added to the counters.
+    '''
+    for name, totals in timer.report().items():
+        for suffix, amount in [('ms', int(totals['seconds'] * 1000)),
+                               ('bytes', totals['bytes']),
+                               ('items', totals['items'])]:
+            if amount:
+                job.increment_counter(group, '%s-%s' % (name, suffix), amount)
@@ -0,0 +1,244 @@
+'''
+Mergeable sketches for corpus statistics in bounded memory:
+
+    HyperLogLog   -- distinct counts, e.g. of schost
+    KLLSketch     -- quantiles, e.g. of body length
+    CountMinTopK  -- heavy hitters, e.g. entity names
+
+Each one can be built independently over any part of the corpus and
+combined with merge(), which gives the same guarantees as building
+it over all the data at once, so they can be built in a mapper and
+merged in a combiner and reducer.  to_dict() makes a compact
+JSON-compatible dict, e.g. for mrjob's JSONProtocol, and from_dict()
+reverses it.
+'''
+
+import math
+import zlib
+import base64
+import random
+import hashlib
+from array import array
+from struct import pack, unpack
+
+def _hash64(key):
+    'a 64-bit hash of the byte string key'
+    return unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+def _pack_counts(counts):
+    '''
+    serializes an array of counts as little-endian 64-bit integers,
+    compressed, since most counts in a sketch are zero or small
+    '''
+    return zlib.compress(pack('<%dQ' % len(counts), *counts))
+
+def _unpack_counts(data):
+    'inverse of _pack_counts, returns an array'
+    data = zlib.decompress(data)
+    return array('L', unpack('<%dQ' % (len(data) // 8), data))
+
+class HyperLogLog(object):
+    '''
+    Estimates the number of distinct byte strings added, with a
+    relative standard error of about 1.04 / sqrt(2**precision), using
+    2**precision one-byte registers.
+    '''
+    def __init__(self, precision=12, registers=None):
+        assert 4 <= precision <= 16, precision
+        self.precision = precision
+        if registers is None:
+            registers = bytearray(2 ** precision)
+        self.registers = registers
+
+    def add(self, key):
+        hashed = _hash64(key)
+        idx = hashed >> (64 - self.precision)
+        ## position of the leftmost one bit in the remaining bits
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        assert self.precision == other.precision, (self.precision, other.precision)
+        for idx, rank in enumerate(other.registers):
+            if rank > self.registers[idx]:
+                self.registers[idx] = rank
+
+    def count(self):
+        'estimated number of distinct keys'
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / sum([2.0 ** -rank for rank in self.registers])
+        num_zero = self.registers.count('\0')
+        if estimate <= 2.5 * num_registers and num_zero:
+            ## small range correction, by linear counting
+            estimate = num_registers * math.log(float(num_registers) / num_zero)
+        return int(round(estimate))
+
+    def to_dict(self):
+        'make a JSON-compatible dict, see from_dict'
+        return {'precision': self.precision,
+                'registers': base64.b64encode(str(self.registers))}
+
+    @classmethod
+    def from_dict(cls, rec):
+        'inverse of to_dict'
+        return cls(rec['precision'], bytearray(base64.b64decode(rec['registers'])))
+
+class KLLSketch(object):
+    '''
+    Estimates quantiles of a stream of numbers with rank error of
+    roughly 1.7 / k, in O(k) space, using the compactor hierarchy of
+    Karnin, Lang, and Liberty.  Level h holds items that each stand
+    for 2**h of the values added.
+    '''
+    def __init__(self, k=200, compactors=None, count=0):
+        self.k = k
+        if compactors is None:
+            compactors = [[]]
+        self.compactors = compactors
+        self.count = count
+
+    def _capacity(self, level):
+        ## lower levels get geometrically smaller capacities
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2.0 / 3) ** depth)))
+
+    def _size(self):
+        return sum([len(items) for items in self.compactors])
+
+    def _max_size(self):
+        return sum([self._capacity(level) for level in range(len(self.compactors))])
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for level, items in enumerate(self.compactors):
+                if len(items) >= self._capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    ## keep every other item, from a random offset,
+                    ## at twice the weight; an odd item out stays
+                    items.sort()
+                    kept = []
+                    if len(items) % 2:
+                        kept = [items.pop()]
+                    offset = random.randint(0, 1)
+                    self.compactors[level + 1].extend(items[offset::2])
+                    self.compactors[level] = kept
+                    break
+            else:
+                break
+
+    def merge(self, other):
+        assert self.k == other.k, (self.k, other.k)
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.count += other.count
+        self._compress()
+
+    def quantile(self, fraction):
+        '''
+        estimated value at rank fraction * count, where fraction is
+        between 0 and 1, or None if empty
+        '''
+        weighted = []
+        for level, items in enumerate(self.compactors):
+            weighted.extend([(value, 2 ** level) for value in items])
+        if not weighted:
+            return None
+        weighted.sort()
+        total = sum([weight for value, weight in weighted])
+        target = fraction * total
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self):
+        'make a JSON-compatible dict, see from_dict'
+        return {'k': self.k, 'count': self.count, 'compactors': self.compactors}
+
+    @classmethod
+    def from_dict(cls, rec):
+        'inverse of to_dict'
+        return cls(rec['k'], rec['compactors'], rec['count'])
+
+class CountMinTopK(object):
+    '''
+    Finds the most frequent byte strings in a stream: a count-min
+    sketch of width by depth counters over-estimates any key's count
+    by at most 2 * total / width with probability 1 - 2**-depth, and
+    the k keys with the highest estimates so far are kept as
+    candidates.
+    '''
+    def __init__(self, width=2048, depth=4, k=100, table=None, candidates=None, total=0):
+        self.width = width
+        self.depth = depth
+        self.k = k
+        if table is None:
+            table = array('L', [0]) * (width * depth)
+        self.table = table
+        if candidates is None:
+            candidates = {}
+        self.candidates = candidates
+        self.total = total
+
+    def _cells(self, key):
+        h1, h2 = unpack('<QQ', hashlib.md5(key).digest())
+        return [row * self.width + (h1 + row * h2) % self.width for row in xrange(self.depth)]
+
+    def estimate(self, key):
+        'estimated count of key, never less than the true count'
+        return min([self.table[cell] for cell in self._cells(key)])
+
+    def add(self, key, count=1):
+        for cell in self._cells(key):
+            self.table[cell] += count
+        self.total += count
+        self.candidates[key] = self.estimate(key)
+        if len(self.candidates) > 2 * self.k:
+            self._prune()
+
+    def _prune(self):
+        'keep only the k candidates with the highest estimates'
+        top = sorted(self.candidates.items(), key=lambda pair: pair[1], reverse=True)[:self.k]
+        self.candidates = dict(top)
+
+    def merge(self, other):
+        assert (self.width, self.depth) == (other.width, other.depth)
+        for cell, count in enumerate(other.table):
+            self.table[cell] += count
+        self.total += other.total
+        for key in set(self.candidates) | set(other.candidates):
+            self.candidates[key] = self.estimate(key)
+        self._prune()
+
+    def top(self, num=None):
+        'list of (key, estimated count) pairs, most frequent first'
+        top = sorted(self.candidates.items(), key=lambda pair: pair[1], reverse=True)
+        return top[:num or self.k]
+
+    def to_dict(self):
+        'make a JSON-compatible dict, see from_dict'
+        return {'width': self.width, 'depth': self.depth, 'k': self.k,
+                'total': self.total, 'candidates': self.top(),
+                'table': base64.b64encode(_pack_counts(self.table))}
+
+    @classmethod
+    def from_dict(cls, rec):
+        'inverse of to_dict'
+        return cls(rec['width'], rec['depth'], rec['k'],
+                   _unpack_counts(base64.b64decode(rec['table'])),
+                   dict([(key.encode('utf-8'), count) for key, count in rec['candidates']]),
+                   rec['total'])
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+'''
+Runs an mrjob job, such as subcorpus_counter.py or corpus_stats.py,
+on this machine without Hadoop, but with its map and reduce tasks
+spread over a pool of processes, for development runs over whole
+date_hours.  mrjob's own local runner runs one task at a time.
+
+Like Hadoop streaming, each step's input lines are cut into
+contiguous splits, one per map task.  Each map task runs the
+mapper (with mapper_init and mapper_final), sorts its output and
+runs the combiner, and writes one file per reduce task, chosen by a
+hash of the key.  Each reduce task sorts its files by key in memory
+and runs the reducer.  All records between tasks go through the
+job's internal protocol and the final output through its output
+protocol, so reducers see exactly what they would on EMR, e.g. JSON
+lists rather than tuples.  Counters from all tasks are summed and
+logged.
+
+For example, to count a date_hour with eight processes:
+
+    python local_runner.py subcorpus_counter.SubcorpusCounter public_urls-2012-04-23-08.txt --processes 8 -- --prefetch 2
+
+Arguments after -- are passed to the job.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from cStringIO import StringIO
+
+import kba_corpus
+
+## mrjob's names for the functions of a step
+STEP_FUNCS = ['mapper', 'mapper_init', 'mapper_final',
+              'combiner', 'combiner_init', 'combiner_final',
+              'reducer', 'reducer_init', 'reducer_final']
+
+def load_job_class(spec):
+    'returns the MRJob subclass named by spec, e.g. subcorpus_counter.SubcorpusCounter'
+    module_name, class_name = spec.rsplit('.', 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+def _make_job(job_class, job_args):
+    '''
+    makes an instance of job_class whose counters and status
+    messages go to a buffer instead of stderr, see _counters
+    '''
+    job = job_class(list(job_args))
+    job.sandbox(stdin=StringIO(), stdout=StringIO(), stderr=StringIO())
+    return job
+
+def _counters(job):
+    'dict of group --> counter --> amount from a job made by _make_job'
+    return job.parse_counters()
+
+def _add_counters(totals, counters):
+    for group, group_counters in counters.items():
+        group_totals = totals.setdefault(group, {})
+        for counter, amount in group_counters.items():
+            group_totals[counter] = group_totals.get(counter, 0) + amount
+
+def _step(job, step_num):
+    '''
+    returns a dict of the functions of step step_num of job, with
+    None for the ones it does not define
+    '''
+    step = job.steps()[step_num]
+    funcs = {}
+    for name in STEP_FUNCS:
+        try:
+            funcs[name] = step[name]
+        except KeyError:
+            funcs[name] = None
+    return funcs
+
+def _protocols(job, step_num, num_steps, has_reducer):
+    '''
+    returns (input protocol, map output protocol, reduce output
+    protocol) of a step, as Hadoop streaming would use them
+    '''
+    if step_num == 0:
+        input_protocol = job.input_protocol()
+    else:
+        input_protocol = job.internal_protocol()
+    if step_num == num_steps - 1:
+        output_protocol = job.output_protocol()
+    else:
+        output_protocol = job.internal_protocol()
+    if has_reducer:
+        map_protocol = job.internal_protocol()
+    else:
+        map_protocol = output_protocol
+    return input_protocol, map_protocol, output_protocol
+
+def _run_funcs(func, init, final, args_iter):
+    '''
+    Iterator over the (key, value) output of calling init, then
+    func(*args) for every args in args_iter, then final, skipping
+    any that are None.  As in mrjob, these may return None instead
+    of yielding anything.
+    '''
+    if init is not None:
+        for pair in init() or ():
+            yield pair
+    for args in args_iter:
+        for pair in func(*args) or ():
+            yield pair
+    if final is not None:
+        for pair in final() or ():
+            yield pair
+
+def _key_of(line):
+    'the serialized key of a line, which Hadoop sorts and partitions on'
+    return line.split('\t', 1)[0]
+
+def _grouped(lines, protocol):
+    '''
+    Iterator over (key, values) for sorted lines, where values is an
+    iterator over the decoded values of consecutive lines with the
+    same serialized key, as Hadoop passes them to a reducer
+    '''
+    for key_text, group in itertools.groupby(lines, _key_of):
+        pairs = (protocol.read(line) for line in group)
+        first_key, first_value = pairs.next()
+        yield first_key, itertools.chain([first_value], (value for key, value in pairs))
+
+def run_mapper_task(task):
+    '''
+    Runs one map task, and returns (paths, counters), where paths
+    holds one file of sorted, serialized output per reduce task, or a
+    single file of final output if the step has no reducer.  task is
+    a tuple so that it can be sent to a pool process.
+    '''
+    job_class, job_args, step_num, num_steps, lines, task_dir, num_partitions = task
+    job = _make_job(job_class, job_args)
+    funcs = _step(job, step_num)
+    has_reducer = funcs['reducer'] is not None
+    input_protocol, map_protocol, output_protocol = _protocols(
+        job, step_num, num_steps, has_reducer)
+
+    if funcs['mapper'] is None:
+        ## the identity mapper
+        funcs['mapper'] = lambda key, value: [(key, value)]
+    map_args = (input_protocol.read(line.rstrip('\r\n')) for line in lines)
+    out_lines = [map_protocol.write(key, value) for key, value in
+                 _run_funcs(funcs['mapper'], funcs['mapper_init'], funcs['mapper_final'], map_args)]
+
+    if not has_reducer:
+        path = os.path.join(task_dir, 'output')
+        fh = open(path, 'wb')
+        for line in out_lines:
+            fh.write(line + '\n')
+        fh.close()
+        return [path], _counters(job)
+
+    out_lines.sort(key=_key_of)
+    if funcs['combiner'] is not None:
+        out_lines = [map_protocol.write(key, value) for key, value in
+                     _run_funcs(funcs['combiner'], funcs['combiner_init'], funcs['combiner_final'],
+                                _grouped(out_lines, map_protocol))]
+
+    partitions = [[] for idx in range(num_partitions)]
+    for line in out_lines:
+        partitions[hash(_key_of(line)) % num_partitions].append(line)
+    paths = []
+    for idx, partition in enumerate(partitions):
+        path = os.path.join(task_dir, 'part-%05d' % idx)
+        fh = open(path, 'wb')
+        for line in partition:
+            fh.write(line + '\n')
+        fh.close()
+        paths.append(path)
+    return paths, _counters(job)
+
+def run_reducer_task(task):
+    '''
+    Runs one reduce task over the map output files in paths, and
+    returns (path, counters), where path is a file of its serialized
+    output
+    '''
+    job_class, job_args, step_num, num_steps, paths, task_dir = task
+    job = _make_job(job_class, job_args)
+    funcs = _step(job, step_num)
+    input_protocol, map_protocol, output_protocol = _protocols(job, step_num, num_steps, True)
+
+    lines = []
+    for path in paths:
+        lines.extend([line.rstrip('\n') for line in open(path)])
+    lines.sort(key=_key_of)
+
+    path = os.path.join(task_dir, 'output')
+    fh = open(path, 'wb')
+    for key, value in _run_funcs(funcs['reducer'], funcs['reducer_init'], funcs['reducer_final'],
+                                 _grouped(lines, map_protocol)):
+        fh.write(output_protocol.write(key, value) + '\n')
+    fh.close()
+    return path, _counters(job)
+
+def _splits(lines, num_splits):
+    'cuts lines into up to num_splits contiguous lists of nearly equal length'
+    splits = []
+    for idx in range(num_splits):
+        split = lines[idx * len(lines) // num_splits:(idx + 1) * len(lines) // num_splits]
+        if split:
+            splits.append(split)
+    return splits
+
+def run_job(job_class, input_paths, o_fh, job_args=(), num_processes=None,
+            num_map_tasks=None, num_reduce_tasks=None, tmp_dir=None):
+    '''
+    Runs all the steps of job_class over the lines of the files in
+    input_paths, with job_args as its command line arguments, in a
+    pool of num_processes processes, and writes the final output to
+    o_fh.  Returns the summed counters.
+
+    num_map_tasks defaults to one per input line, as a manifest from
+    chunk_manifest.py expects, and num_reduce_tasks to num_processes.
+    '''
+    num_processes = num_processes or multiprocessing.cpu_count()
+    num_reduce_tasks = num_reduce_tasks or num_processes
+    num_steps = len(_make_job(job_class, job_args).steps())
+
+    lines = []
+    for path in input_paths:
+        lines.extend(open(path).readlines())
+
+    work_dir = tempfile.mkdtemp(prefix='local_runner.', dir=tmp_dir)
+    pool = multiprocessing.Pool(num_processes)
+    counters = {}
+    try:
+        for step_num in range(num_steps):
+            splits = _splits(lines, num_map_tasks or len(lines) or 1)
+            map_tasks = []
+            for task_num, split in enumerate(splits):
+                task_dir = os.path.join(work_dir, 'step-%d-map-%05d' % (step_num, task_num))
+                os.makedirs(task_dir)
+                map_tasks.append((job_class, job_args, step_num, num_steps, split,
+                                  task_dir, num_reduce_tasks))
+            kba_corpus.log('step %d: running %d map tasks' % (step_num, len(map_tasks)))
+            map_results = pool.map(run_mapper_task, map_tasks, chunksize=1)
+            for paths, task_counters in map_results:
+                _add_counters(counters, task_counters)
+
+            has_reducer = _step(_make_job(job_class, job_args), step_num)['reducer'] is not None
+            if has_reducer:
+                reduce_tasks = []
+                for idx in range(num_reduce_tasks):
+                    task_dir = os.path.join(work_dir, 'step-%d-reduce-%05d' % (step_num, idx))
+                    os.makedirs(task_dir)
+                    reduce_tasks.append((job_class, job_args, step_num, num_steps,
+                                         [paths[idx] for paths, task_counters in map_results],
+                                         task_dir))
+                kba_corpus.log('step %d: running %d reduce tasks' % (step_num, len(reduce_tasks)))
+                output_paths = []
+                for path, task_counters in pool.map(run_reducer_task, reduce_tasks, chunksize=1):
+                    output_paths.append(path)
+                    _add_counters(counters, task_counters)
+            else:
+                output_paths = [paths[0] for paths, task_counters in map_results]
+
+            lines = []
+            for path in output_paths:
+                lines.extend(open(path).readlines())
+
+        o_fh.writelines(lines)
+
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(work_dir)
+
+    for group in sorted(counters):
+        for counter in sorted(counters[group]):
+            kba_corpus.log('counter %s %s: %d' % (group, counter, counters[group][counter]))
+    return counters
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('job', help='module and class of the MRJob, e.g. subcorpus_counter.SubcorpusCounter')
+    parser.add_argument('input', nargs='+', help='input files, e.g. lists of chunk URLs or a manifest from chunk_manifest.py')
+    parser.add_argument('--processes', type=int, default=None, help='size of the process pool, defaults to the number of CPUs')
+    parser.add_argument('--map-tasks', type=int, default=None, help='number of map tasks, defaults to one per input line')
+    parser.add_argument('--reduce-tasks', type=int, default=None, help='number of reduce tasks, defaults to --processes')
+    parser.add_argument('--output', default=None, help='path for the final output, defaults to stdout')
+    parser.add_argument('--tmp-dir', default=None, help='dir for the intermediate files')
+    argv = sys.argv[1:]
+    job_args = []
+    if '--' in argv:
+        job_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    if args.output:
+        o_fh = open(args.output, 'wb')
+    else:
+        o_fh = sys.stdout
+    run_job(load_job_class(args.job), args.input, o_fh, job_args=job_args,
+            num_processes=args.processes, num_map_tasks=args.map_tasks,
+            num_reduce_tasks=args.reduce_tasks, tmp_dir=args.tmp_dir)
+    if args.output:
+        o_fh.close()
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+'''
+Sorts the StreamItems from any number of chunk files into new chunk
+files ordered by (stream_time.epoch_ticks, stream_id), so that the
+corpus can be replayed as a true stream.
+
+Within a date_hour, the 'news', 'social', and 'linking' chunks are
+not globally ordered.  This is an external merge sort: StreamItems
+are never decoded.  Instead, each chunk is scanned for the byte span
+and sort key of every StreamItem, and the spans are gathered into
+runs.  When a run exceeds max_run_bytes, it is sorted and spilled to
+a temporary file, and the runs are then k-way merged into new chunks
+of items_per_chunk StreamItems each, named <prefix>-<seq>.<md5>.xz
+with a zero-padded sequence number, so that sorting the names, as
+kba_corpus.chunk_paths does, gives the chunks in stream order.
+'''
+
+import os
+import sys
+import heapq
+import shutil
+import tempfile
+from operator import itemgetter
+from struct import pack, unpack, calcsize
+from cStringIO import StringIO
+
+import kba_corpus
+
+## each record in a run file is a header of (epoch_ticks,
+## len(stream_id), len(stream_item)) followed by the stream_id and the
+## serialized stream_item
+RUN_RECORD_HEADER = '!dii'
+RUN_RECORD_HEADER_SIZE = calcsize(RUN_RECORD_HEADER)
+
+## default bound on the bytes of StreamItems held in memory at once
+DEFAULT_MAX_RUN_BYTES = 256 * 2**20
+
+def chunk_records(thrift_data):
+    '''
+    Iterator over (key, item_bytes) for every StreamItem in a buffer
+    of thrift data, where key is (epoch_ticks, stream_id).  Items
+    without a stream_time sort before all others.
+    '''
+    thrift_data = kba_corpus.to_binary(thrift_data)
+    for begin, end, fields in kba_corpus.stream_item_spans(thrift_data):
+        epoch_ticks, stream_id = kba_corpus.stream_item_key(thrift_data, fields)
+        if epoch_ticks is None:
+            epoch_ticks = float('-inf')
+        yield (epoch_ticks, stream_id or ''), thrift_data[begin:end]
+
+def write_run(records, run_path):
+    '''
+    Sorts the list of (key, item_bytes) records by key and writes it
+    to a run file at run_path
+    '''
+    records.sort(key=itemgetter(0))
+    fh = open(run_path, 'wb')
+    for (epoch_ticks, stream_id), item in records:
+        fh.write(pack(RUN_RECORD_HEADER, epoch_ticks, len(stream_id), len(item)))
+        fh.write(stream_id)
+        fh.write(item)
+    fh.close()
+
+def read_run(run_path):
+    '''
+    Iterator over the sorted (key, item_bytes) records in a run file
+    '''
+    fh = open(run_path, 'rb')
+    while 1:
+        header = fh.read(RUN_RECORD_HEADER_SIZE)
+        if not header:
+            break
+        epoch_ticks, id_len, item_len = unpack(RUN_RECORD_HEADER, header)
+        stream_id = fh.read(id_len)
+        item = fh.read(item_len)
+        yield (epoch_ticks, stream_id), item
+    fh.close()
+
+def sort_chunks(i_paths, out_dir, max_run_bytes=DEFAULT_MAX_RUN_BYTES,
+                items_per_chunk=500, prefix='sorted', tmp_dir=None,
+                gpg_private=None, gpg_public=None, gpg_dir='gnupg-dir'):
+    '''
+    Reads all the chunk files in i_paths, which may include
+    directories of chunk files, and writes their StreamItems to new
+    chunk files in out_dir, in (epoch_ticks, stream_id) order.
+    Returns the list of new chunk paths, in stream order, which is
+    also the order of their names, <prefix>-000000.<md5>.xz[.gpg],
+    <prefix>-000001.<md5>.xz[.gpg], and so on.
+
+    At most roughly max_run_bytes of serialized StreamItems plus one
+    input chunk are held in memory, and spilled runs are written
+    under tmp_dir, which defaults to the system temp dir.
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    run_dir = tempfile.mkdtemp(prefix='sort_chunks.', dir=tmp_dir)
+    try:
+        ## gather records into runs, spilling each full run to disk
+        run_paths = []
+        records = []
+        run_bytes = 0
+        for i_path in kba_corpus.chunk_paths(i_paths):
+            thrift_data = kba_corpus.read_chunk(i_path, gpg_private, gpg_dir)
+            for key, item in chunk_records(thrift_data):
+                records.append((key, item))
+                run_bytes += len(item)
+                if run_bytes >= max_run_bytes:
+                    run_path = os.path.join(run_dir, 'run-%d' % len(run_paths))
+                    write_run(records, run_path)
+                    run_paths.append(run_path)
+                    kba_corpus.log('spilled %d items to %s' % (len(records), run_path))
+                    records = []
+                    run_bytes = 0
+            thrift_data = None
+
+        ## the final run stays in memory
+        records.sort(key=itemgetter(0))
+        runs = map(read_run, run_paths) + [iter(records)]
+
+        ## k-way merge the runs into new chunks
+        o_paths = []
+        o_buffer = StringIO()
+        num_items = 0
+        for key, item in heapq.merge(*runs):
+            o_buffer.write(item)
+            num_items += 1
+            if num_items == items_per_chunk:
+                o_paths.append(kba_corpus.write_chunk(
+                        o_buffer.getvalue(), out_dir, '%s-%06d' % (prefix, len(o_paths)),
+                        gpg_public, gpg_dir))
+                o_buffer = StringIO()
+                num_items = 0
+
+        if num_items > 0:
+            o_paths.append(kba_corpus.write_chunk(
+                    o_buffer.getvalue(), out_dir, '%s-%06d' % (prefix, len(o_paths)),
+                    gpg_public, gpg_dir))
+
+    finally:
+        shutil.rmtree(run_dir)
+
+    kba_corpus.log('sorted into %d chunks' % len(o_paths))
+    return o_paths
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('out_dir', help='path to directory for the new time-ordered chunk files')
+    parser.add_argument('input', nargs='+', help='chunk files, or directories of chunk files such as date_hour dirs')
+    parser.add_argument('--max-run-bytes', type=int, default=DEFAULT_MAX_RUN_BYTES, help='bytes of StreamItems to hold in memory before spilling a sorted run to disk')
+    parser.add_argument('--items-per-chunk', type=int, default=500, help='number of StreamItems in each output chunk')
+    parser.add_argument('--prefix', default='sorted', help='prefix for output chunk file names, followed by a sequence number')
+    parser.add_argument('--tmp-dir', default=None, help='dir for spilled runs')
+    parser.add_argument('--private', default=None, help='Provide GPG decryption (private) key for reading corpus')
+    parser.add_argument('--public', default=None, help='Provide GPG encryption (public) key for re-saving corpus')
+    parser.add_argument('--gpgdir', default='gnupg-dir', help='dir for storing gpg files, e.g. keys')
+    args = parser.parse_args()
+
+    sort_chunks(args.input, args.out_dir, max_run_bytes=args.max_run_bytes,
+                items_per_chunk=args.items_per_chunk, prefix=args.prefix,
+                tmp_dir=args.tmp_dir, gpg_private=args.private,
+                gpg_public=args.public, gpg_dir=args.gpgdir)
@@ -12,10 +12,25 @@ from cStringIO import StringIO
 from thrift import Thrift
 from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol
+from thrift.protocol import TCompactProtocol
+try:
+    ## only in the thrift library vendored in kba-corpus
+    from thrift.protocol.TSpecDecoder import TSpecDecoder
+except ImportError:
+    TSpecDecoder = None
+try:
+    ## also only in the thrift library vendored in kba-corpus
+    from thrift.transport.TXzTransport import TXzTransport
+except ImportError:
+    TXzTransport = None
 
 ## import the KBA-specific thrift types
 from ttypes import StreamItem, ContentItem, Label, StreamTime, Offset
 
+## Chunks in the thrift compact protocol start with this magic, as in
+## kba_corpus.COMPACT_MAGIC, and others are in the binary protocol.
+COMPACT_MAGIC = '\x82kba-compact\x01'
+
 def make_stream_time(zulu_timestamp):
     '''
     Make a StreamTime object for a zulu_timestamp in this format:
@@ -48,19 +63,47 @@ class Chunk(object):
     '''
     A serialized batch of StreamItem instances.
     '''
-    def __init__(self, data=None, file_obj=None):
+    def __init__(self, data=None, file_obj=None, reuse=False, compact=False,
+                 path=None, xz=None):
         '''
-        Load a chunk from an existing file handle or buffer of data.
+        Load a chunk from an existing file handle or buffer of data,
+        or from the file at path.  If xz is True, or is None and path
+        ends with .xz, the file is xz-compressed, and is decompressed
+        incrementally while iterating, without an xz child process or
+        holding the whole chunk in memory, which needs TXzTransport.
         If no data is passed in, then chunk starts as empty and
-        chunk.add(stream_item) can be called to append to it.
+        chunk.add(stream_item) can be called to append to it, in the
+        thrift compact protocol if compact is True, which is smaller
+        but slower to decode.  Loaded chunks are read in whichever
+        protocol they were written in.
+
+        If reuse is True, iterating decodes every StreamItem into the
+        same object, resetting its fields in place, rather than
+        allocating new ones.  Each StreamItem yielded is then only
+        valid until the next step of the iteration; copy out anything
+        to keep.
         '''
+        self._reuse = reuse
         self._count = 0
         self._o_protocol = None
         self._o_transport = None
+        if xz is None:
+            xz = path is not None and path.endswith('.xz')
+        self._xz = xz
+        if xz:
+            assert TXzTransport is not None, \
+                'reading .xz needs the thrift library vendored in kba-corpus'
+        if path is not None:
+            file_obj = open(path, 'rb')
+
         if data is None and file_obj is None:
             ## Make output file obj for thrift, wrap in protocol
             self._o_transport = StringIO()
-            self._o_protocol = TBinaryProtocol.TBinaryProtocol(self._o_transport)
+            if compact:
+                self._o_transport.write(COMPACT_MAGIC)
+                self._o_protocol = TCompactProtocol.TCompactProtocol(self._o_transport)
+            else:
+                self._o_protocol = TBinaryProtocol.TBinaryProtocol(self._o_transport)
 
         elif file_obj is None:
             ## wrap it in a file obj
@@ -93,22 +136,58 @@ class Chunk(object):
         Iterator over StreamItems in the chunk
         '''
         assert self._chunk_fh, 'cannot iterate over stream_items in an empty Chunk'
-        ## seek to the start, so can iterate multiple times over the chunk
+        ## seek to the start, so can iterate multiple times over the
+        ## chunk, and past the magic of a compact chunk
         self._chunk_fh.seek(0)
-        ## wrap the file handle in buffered transport
-        i_transport = TTransport.TBufferedTransport(self._chunk_fh)
-        ## use the Thrift Binary Protocol
-        i_protocol = TBinaryProtocol.TBinaryProtocol(i_transport)
+        if self._xz:
+            ## decompress the file handle as it is read
+            i_transport = TXzTransport(self._chunk_fh)
+            try:
+                buf = i_transport.cstringio_refill('', len(COMPACT_MAGIC))
+            except EOFError:
+                ## too short to hold even one StreamItem
+                return
+            compact = buf.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC
+            if not compact:
+                buf.seek(0)
+        else:
+            compact = self._chunk_fh.read(len(COMPACT_MAGIC)) == COMPACT_MAGIC
+            if not compact:
+                self._chunk_fh.seek(0)
+            ## wrap the file handle in buffered transport, via a file
+            ## object transport, which has the readAll that its refill
+            ## needs when the decoder reads its buffer directly
+            i_transport = TTransport.TBufferedTransport(
+                TTransport.TFileObjectTransport(self._chunk_fh))
+        ## use the Thrift Binary Protocol, or Compact Protocol
+        if compact:
+            i_protocol = TCompactProtocol.TCompactProtocol(i_transport)
+        else:
+            i_protocol = TBinaryProtocol.TBinaryProtocol(i_transport)
+
+        if self._reuse:
+            doc = StreamItem()
+            if TSpecDecoder is not None:
+                ## also reuses the nested ContentItems
+                decoder = TSpecDecoder(i_protocol)
 
         ## read StreamItem instances until input buffer is exhausted
         while 1:
 
-            ## instantiate a StreamItem instance 
-            doc = StreamItem()
+            if not self._reuse:
+                ## instantiate a StreamItem instance 
+                doc = StreamItem()
 
             try:
                 ## read it from the thrift protocol instance
-                doc.read(i_protocol)
+                if self._reuse and TSpecDecoder is not None:
+                    decoder.read(StreamItem, None, doc, reuse=True)
+                elif self._reuse:
+                    ## reset the fields that the next item may lack
+                    doc.__init__()
+                    doc.read(i_protocol)
+                else:
+                    doc.read(i_protocol)
 
                 ## yield is python primitive for iteration
                 yield doc
@@ -14,6 +14,9 @@ You can get a list of all the date_hour strings here:
 
    s3cmd get s3://aws-publicdatasets/trec/kba/kba-stream-corpus-2012/dir-names.txt        
 
+For balanced map tasks, use chunk_manifest.py to pack the URLs into
+one JSON line per map task, which this job also accepts as input.
+
 '''
 
 import re
@@ -21,9 +24,10 @@ import os
 import sys
 import json
 import time
-import urllib
 import syslog
+import tempfile
 import traceback
+import itertools
 
 ## you can configure boto within EMR by modifying your copy of the
 ## shell scripts in s3://trec-kba-emr/emr-setup to create ~/.boto file
@@ -35,6 +39,20 @@ from mrjob.job import MRJob
 import mrjob.protocol
 
 import kba_corpus
+import kba_fetch
+from kba_mrjob import BatchedCounters, SkipRecorder, increment_timer_counters
+
+def add_counts(totals, count_pair):
+    '''
+    Adds count_pair, a sequence of integers, element-wise into the
+    list of integers totals
+    '''
+    for idx, count in enumerate(count_pair):
+        totals[idx] += count
+
+## output key for the records of skipped StreamItems, which is not a
+## subcorpus name
+SKIPPED_KEY = 'skipped'
 
 class SubcorpusCounter(MRJob):
     INPUT_PROTOCOL  = mrjob.protocol.RawValueProtocol
@@ -42,51 +60,122 @@ class SubcorpusCounter(MRJob):
     ## this is the default, so redundant
     INTERNAL_PROTOCOL = mrjob.protocol.JSONProtocol
 
+    def configure_options(self):
+        super(SubcorpusCounter, self).configure_options()
+        self.add_passthrough_option(
+            '--chunk-cache-dir', default=os.path.join(tempfile.gettempdir(), 'kba-chunk-cache'),
+            help='local dir for caching fetched chunk files across jobs, or "" to disable')
+        self.add_passthrough_option(
+            '--chunk-cache-bytes', type='int', default=kba_fetch.DEFAULT_CACHE_BYTES,
+            help='size cap for --chunk-cache-dir')
+        self.add_passthrough_option(
+            '--prefetch', type='int', default=4,
+            help='number of chunk files to download ahead of the one being counted, or 0 to fetch each in turn')
+        self.add_passthrough_option(
+            '--emit-skipped', action='store_true', default=False,
+            help='also output [url, stream_id, reason] for every StreamItem skipped, under the key %r' % SKIPPED_KEY)
+        self.add_passthrough_option(
+            '--timing', action='store_true', default=False,
+            help='time each stage of processing, and report it in the log and as SubcorpusCounterTiming counters')
+
+    def mapper_init(self):
+        '''
+        Prepares in-mapper combining: the chunk URLs handled by this
+        map task are gathered in self.urls, and their counts
+        accumulate in self.counts, which maps subcorpus name to
+        [num_ner_tokens, num_ner_sentences], and are emitted once by
+        mapper_final.
+
+        Per-StreamItem counters are batched through self.counters
+        rather than written to stderr on every increment.
+        '''
+        self.urls = []
+        self.item_ranges = {}
+        self.counts = {}
+        self.counters = BatchedCounters(self)
+        self.skipped = SkipRecorder(self.counters, 'SubcorpusCounter')
+
+        ## time spent in each stage, see kba_corpus.StageTimer
+        self.timer = kba_corpus.NULL_TIMER
+        if self.options.timing:
+            self.timer = kba_corpus.StageTimer()
+
+        ## chunks fetched by earlier tasks or jobs on this node
+        self.cache = None
+        if self.options.chunk_cache_dir:
+            self.cache = kba_fetch.ChunkCache(self.options.chunk_cache_dir,
+                                              self.options.chunk_cache_bytes)
+
     def mapper(self, empty, public_url):
         '''
-        Takes as input a public URL to a TREC KBA 2012 chunk file,
-        which it then loads, decrypts, uncompresses, and deserializes,
-        so that it can count the number of NER tokens.
-
-        This emits keys equal to the subcorpus name ('news',
-        'linking', or 'social') and value is a two tuple of integers.
-        First integer in the two-tuple is equal to the number of NER
-        tokens, and second the number of sentences as tokenized by
-        Stanford NER.
+        Takes as input a public URL to a TREC KBA 2012 chunk file, or
+        a line of a manifest from chunk_manifest.py, and saves the
+        URLs for mapper_final, which fetches all of this task's chunk
+        files with prefetching.
+        '''
+        public_url = public_url.strip()
+        if not public_url.startswith('{'):
+            self.urls.append(public_url)
+        else:
+            for chunk in json.loads(public_url)['chunks']:
+                self.urls.append(chunk['url'])
+                if 'items' in chunk:
+                    ## a sub-split counts only this range of items
+                    self.item_ranges[len(self.urls) - 1] = (
+                        chunk['items'][0], chunk['items'][1], chunk.get('offset'))
+
+        ## help hadoop keep track
+        self.increment_counter('SkippingTaskCounters','MapProcessedRecords',1)
+
+    def count_chunk(self, fetched, item_range=None):
+        '''
+        Takes a kba_fetch.FetchedChunk for a TREC KBA 2012 chunk file,
+        which it then decrypts, uncompresses, and deserializes, so
+        that it can count the number of NER tokens.  If item_range is
+        provided, only (start_item, end_item, offset) are counted, as
+        for kba_corpus.stream_items_in_range.
+
+        The counts are added to self.counts under the subcorpus name
+        ('news', 'linking', or 'social'), and the first integer is the
+        number of NER tokens, and second the number of sentences as
+        tokenized by Stanford NER.
+
+        A StreamItem that cannot be decoded or counted is recorded
+        by self.skipped and left out, and the rest of the chunk is
+        still counted.  Only failing to fetch or decrypt the chunk,
+        after kba_fetch's retries, fails the whole chunk.
         '''
-        
         subcorpus_name = None
         num_ner_tokens = 0
         num_ner_sentences = 0
 
         try:
-            ## fetch the file to a local tempfile
-            kba_corpus.log('fetching %r' % public_url)
-            data = urllib.urlopen(public_url.strip()).read()
+            ## wait for the prefetched file, and shell out to gpg and
+            ## xz to get the thrift
+            kba_corpus.log('counting %r' % fetched.url)
+            thrift_data = fetched.thrift_data(self.timer)
+            self.skipped.url = fetched.url
 
-            ## shell out to gpg and xz to get the thrift
-            thrift_data = kba_corpus.decrypt_and_uncompress(
-                data, 'kba_corpus.tar.gz/trec-kba-rsa.secret-key')
+            if item_range is None:
+                item_range = (0, None, None)
+            chunk_items = self.timer.timed_iter('decode', kba_corpus.robust_stream_items(
+                    thrift_data, self.skipped, *item_range))
 
             ## iterate over all the docs in this chunk            
-            for stream_item in kba_corpus.stream_items(thrift_data):
+            for stream_item in chunk_items:
+                try:
+                    with self.timer.stage('count_ner') as stage:
+                        num_tokens, num_sentences = self.count_stream_item(stream_item)
+                        stage.add(items=1)
+                except Exception, exc:
+                    kba_corpus.log(traceback.format_exc(exc))
+                    self.skipped(stream_item.stream_id, str(exc))
+                    continue
+
                 ## this should be the same every time, could assert
                 subcorpus_name = stream_item.source
-
-                ## for fun, keep counters on how many docs have NER or not
-                if not (stream_item.body.ner or stream_item.anchor.ner or stream_item.title.ner):
-                    self.increment_counter('SubcorpusCounter', 'no-NER', 1)
-                else:
-                    self.increment_counter('SubcorpusCounter', 'hasNER', 1)
-
-                ## tell hadoop we are still alive
-                self.increment_counter('SubcorpusCounter', 'StreamItemsProcessed', 1)
-
-                ## iterate over sentences to generate the two counts
-                for content in ['body', 'anchor', 'title']:
-                    for sentence in kba_corpus.sentences(stream_item, content=content):
-                        num_ner_tokens += len(sentence)
-                        num_ner_sentences += 1
+                num_ner_tokens += num_tokens
+                num_ner_sentences += num_sentences
 
         except Exception, exc:
             ## oops, log verbosely, including with counters (maybe too clever)
@@ -97,27 +186,96 @@ class SubcorpusCounter(MRJob):
             self.increment_counter('SubcorpusCounter', key, 1)
 
         else:
-            ## it must have all worked, so emit data
+            ## it must have all worked, so keep the counts until
+            ## mapper_final emits them.  A failed chunk contributes
+            ## nothing, as before.
             self.increment_counter('SubcorpusCounter','Success',1)
-            yield subcorpus_name, (num_ner_tokens, num_ner_sentences)
+            add_counts(self.counts.setdefault(subcorpus_name, [0, 0]),
+                       (num_ner_tokens, num_ner_sentences))
 
-        finally:
-            ## help hadoop keep track
-            self.increment_counter('SkippingTaskCounters','MapProcessedRecords',1)
-
-    def reducer(self, source, counts):
+    def count_stream_item(self, stream_item):
         '''
-        Sums up all the counts for a given source
+        Returns (num_ner_tokens, num_ner_sentences) for stream_item,
+        and updates the per-StreamItem counters
         '''
+        ## for fun, keep counters on how many docs have NER or not
+        if not (stream_item.body.ner or stream_item.anchor.ner or stream_item.title.ner):
+            self.counters.increment('SubcorpusCounter', 'no-NER', 1)
+        else:
+            self.counters.increment('SubcorpusCounter', 'hasNER', 1)
+
+        ## tell hadoop we are still alive, which the batched
+        ## counters still do at least every max_seconds
+        self.counters.increment('SubcorpusCounter', 'StreamItemsProcessed', 1)
+
+        ## count tokens and sentences straight from the NER bytes,
+        ## same as iterating over sentences
         num_ner_tokens = 0
         num_ner_sentences = 0
+        for content in ['body', 'anchor', 'title']:
+            num_tokens, num_sentences = kba_corpus.count_ner(
+                getattr(stream_item, content))
+            num_ner_tokens += num_tokens
+            num_ner_sentences += num_sentences
+        return num_ner_tokens, num_ner_sentences
+
+    def mapper_final(self):
+        '''
+        Counts all of this task's chunk files, downloading the next
+        few while each one is decoded, or reading them from the
+        local cache, then emits the accumulated counts, one record
+        per subcorpus, and flushes the batched counters.  With
+        --emit-skipped, also emits the skipped StreamItems.
+        '''
+        for idx, fetched in enumerate(kba_fetch.prefetch_chunks(
+                self.urls, max_in_flight=self.options.prefetch, cache=self.cache,
+                gpg_private='kba_corpus.tar.gz/trec-kba-rsa.secret-key')):
+            self.count_chunk(fetched, self.item_ranges.get(idx))
+
+        self.counters.flush()
+        if self.options.timing:
+            kba_corpus.log('timing: %s' % json.dumps(self.timer.report()))
+            increment_timer_counters(self, 'SubcorpusCounterTiming', self.timer)
+
+        for source, count_pair in self.counts.iteritems():
+            yield source, count_pair
+
+        if self.skipped.num_skipped:
+            kba_corpus.log('skipped %d StreamItems' % self.skipped.num_skipped)
+        if self.options.emit_skipped and self.skipped.records:
+            yield SKIPPED_KEY, self.skipped.records
+
+    def combiner(self, source, counts):
+        '''
+        Sums up the counts for a given source from the map tasks on
+        one node, so that only one record per source is shuffled
+        '''
+        if source == SKIPPED_KEY:
+            yield source, list(itertools.chain.from_iterable(counts))
+            return
+        totals = [0, 0]
+        for count_pair in counts:
+            add_counts(totals, count_pair)
+        yield source, totals
+
+    def reducer(self, source, counts):
+        '''
+        Sums up all the counts for a given source, or gathers all
+        the records of skipped StreamItems
+        '''
+        if source == SKIPPED_KEY:
+            yield source, list(itertools.chain.from_iterable(counts))
+            return
+
         kba_corpus.log('reading counts for %r' % source)
         self.increment_counter('SubcorpusCounter','ReducerLaunched',1)
+        counters = BatchedCounters(self)
+        totals = [0, 0]
         for count_pair in counts:
-            num_ner_tokens    += count_pair[0]
-            num_ner_sentences += count_pair[1]
-            self.increment_counter('SubcorpusCounter','CountPairRead',1)
-        yield source, (num_ner_tokens, num_ner_sentences)
+            add_counts(totals, count_pair)
+            counters.increment('SubcorpusCounter','CountPairRead',1)
+        counters.flush()
+        yield source, totals
         self.increment_counter('SkippingTaskCounters','ReduceProcessedRecords',1)
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+'''
+Checks that the stats sidecar of an encrypted (.gpg) chunk keys its
+ids_bloom with the ids_bloom_secret in gpg_dir, so that readers with
+the secret can prune the chunk by ids, and readers without it cannot.
+
+    python test_chunk_stats.py
+'''
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import kba_corpus
+from thrift.protocol import TBinaryProtocol
+from kba_thrift.ttypes import StreamItem, ContentItem
+
+def encode_stream_items(num_items):
+    'returns thrift data of num_items StreamItems with ids 0-id, 1-id, etc.'
+    o_transport = StringIO()
+    protocol = TBinaryProtocol.TBinaryProtocol(o_transport)
+    for idx in range(num_items):
+        doc = StreamItem(doc_id='%d-id' % idx, stream_id='1335168000-%d-id' % idx,
+                         source='news', body=ContentItem(raw='raw'))
+        doc.write(protocol)
+    return o_transport.getvalue()
+
+class TestEncryptedChunkStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_chunk_stats.')
+        self.gpg_dir = os.path.join(self.tmp_dir, 'gnupg-dir')
+        self.thrift_data = encode_stream_items(10)
+        ## the sidecar only depends on the chunk's path and thrift data
+        self.chunk_path = os.path.join(self.tmp_dir, 'news.%s.xz.gpg' % (
+                hashlib.md5(self.thrift_data).hexdigest()))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pruned_by_ids_with_secret(self):
+        kba_corpus.write_chunk_stats(self.chunk_path, self.thrift_data, self.gpg_dir)
+        stats = kba_corpus.read_chunk_stats(self.chunk_path)
+        secret = kba_corpus.ids_bloom_secret(self.gpg_dir)
+        self.assertTrue(secret)
+        self.assertTrue('secret_id' in stats['ids_bloom'])
+        self.assertFalse(secret in open(kba_corpus.chunk_stats_path(self.chunk_path)).read())
+
+        self.assertTrue(kba_corpus.chunk_may_match(
+                stats, ids=set(['1335168000-3-id']), ids_secret=secret))
+        self.assertTrue(kba_corpus.chunk_may_match(
+                stats, ids=set(['7-id']), ids_secret=secret))
+        self.assertFalse(kba_corpus.chunk_may_match(
+                stats, ids=set(['1335168000-%d-id' % idx for idx in range(10, 20)]),
+                ids_secret=secret))
+
+    def test_not_pruned_without_secret(self):
+        kba_corpus.write_chunk_stats(self.chunk_path, self.thrift_data, self.gpg_dir)
+        stats = kba_corpus.read_chunk_stats(self.chunk_path)
+        absent = set(['1335168000-%d-id' % idx for idx in range(10, 20)])
+        self.assertTrue(kba_corpus.chunk_may_match(stats, ids=absent))
+        self.assertTrue(kba_corpus.chunk_may_match(stats, ids=absent, ids_secret='another secret'))
+
+    def test_secret_is_reused(self):
+        secret = kba_corpus.ids_bloom_secret(self.gpg_dir, create=True)
+        self.assertEqual(kba_corpus.ids_bloom_secret(self.gpg_dir, create=True), secret)
+        self.assertEqual(os.listdir(self.gpg_dir), [kba_corpus.IDS_SECRET_FNAME])
+
+    def test_plaintext_chunk_is_unkeyed(self):
+        chunk_path = self.chunk_path[:-len('.gpg')]
+        kba_corpus.write_chunk_stats(chunk_path, self.thrift_data, self.gpg_dir)
+        stats = kba_corpus.read_chunk_stats(chunk_path)
+        self.assertFalse('secret_id' in stats['ids_bloom'])
+        self.assertFalse(kba_corpus.chunk_may_match(stats, ids=set(['10-id'])))
+        self.assertFalse(os.path.exists(self.gpg_dir))
+
+if __name__ == '__main__':
+    unittest.main()
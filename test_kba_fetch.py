@@ -0,0 +1,215 @@
+#!/usr/bin/python
+'''
+Checks fetch_chunk, ChunkCache and prefetch_chunks against chunk
+files served by a SimpleHTTPServer on a thread: cached chunks are not
+fetched again, corrupt cached copies are refetched, the cache stays
+under max_bytes, 404s fail at once and 503s are retried; prefetched
+chunks come out in order, no more than max_in_flight are downloaded
+at once, and no temporary files are left behind when the caller
+skips chunks or stops early.
+
+    python test_kba_fetch.py
+'''
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import SocketServer
+import SimpleHTTPServer
+from cStringIO import StringIO
+
+import kba_fetch
+import kba_corpus
+from thrift.protocol import TBinaryProtocol
+from kba_thrift.ttypes import StreamItem, ContentItem
+
+class ChunkHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    '''
+    serves the files in the server's chunk_dir, after sleeping for
+    the server's delay, and records the paths requested and the most
+    requests it has served at once.  A file name in the server's
+    statuses is first answered with the error statuses listed there.
+    '''
+
+    def translate_path(self, path):
+        return os.path.join(self.server.chunk_dir, os.path.basename(path))
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(os.path.basename(self.path))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            statuses = server.statuses.get(os.path.basename(self.path))
+            if statuses:
+                self.send_error(statuses.pop(0))
+                return
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+class ChunkServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, chunk_dir, delay=0.0):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), ChunkHandler)
+        self.chunk_dir = chunk_dir
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.statuses = {}
+
+def write_synthetic_chunks(chunk_dir, num_chunks=5, items_per_chunk=3):
+    'writes chunk files of StreamItems into chunk_dir, and returns their names'
+    names = []
+    for chunk_num in range(num_chunks):
+        o_transport = StringIO()
+        protocol = TBinaryProtocol.TBinaryProtocol(o_transport)
+        for idx in range(items_per_chunk):
+            doc = StreamItem(doc_id='%d-%d' % (chunk_num, idx), source='news',
+                             body=ContentItem(raw='x' * (chunk_num * 100 + idx)))
+            doc.write(protocol)
+        path = kba_corpus.write_chunk(o_transport.getvalue(), chunk_dir, 'news')
+        names.append(os.path.basename(path))
+    return names
+
+class ServerTestCase(unittest.TestCase):
+    'serves synthetic chunks from a ChunkServer with the given delay'
+    delay = 0.0
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_kba_fetch.')
+        self.chunk_dir = os.path.join(self.tmp_dir, 'served')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(self.chunk_dir)
+        self.names = write_synthetic_chunks(self.chunk_dir)
+        self.server = ChunkServer(self.chunk_dir, self.delay)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.urls = ['http://127.0.0.1:%d/%s' % (self.server.server_address[1], name)
+                     for name in self.names]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+class TestFetchChunk(ServerTestCase):
+
+    def test_miss_then_hit(self):
+        cache = kba_fetch.ChunkCache(self.cache_dir)
+        thrift_data = kba_fetch.fetch_chunk(self.urls[0], cache)
+        self.assertEqual(hashlib.md5(thrift_data).hexdigest(),
+                         kba_fetch.chunk_md5(self.urls[0]))
+        self.assertEqual(kba_fetch.fetch_chunk(self.urls[0], cache), thrift_data)
+        self.assertEqual(self.server.requests, [self.names[0]])
+
+    def test_corrupt_cached_copy(self):
+        cache = kba_fetch.ChunkCache(self.cache_dir)
+        md5 = kba_fetch.chunk_md5(self.urls[0])
+        thrift_data = kba_fetch.fetch_chunk(self.urls[0], cache)
+        good = cache.get(md5)
+        for corrupt in ('not xz at all', kba_corpus.compress_and_encrypt('other data')):
+            cache.put(md5, corrupt)
+            self.assertEqual(kba_fetch.fetch_chunk(self.urls[0], cache), thrift_data)
+            self.assertEqual(cache.get(md5), good)
+        self.assertEqual(self.server.requests, [self.names[0]] * 3)
+
+    def test_evict_to_max_bytes(self):
+        sizes = [os.path.getsize(os.path.join(self.chunk_dir, name)) for name in self.names]
+        ## room for the last two chunks fetched, but not three
+        max_bytes = sizes[-1] + sizes[-2] + min(sizes) - 1
+        cache = kba_fetch.ChunkCache(self.cache_dir, max_bytes)
+        for mtime, url in enumerate(self.urls):
+            kba_fetch.fetch_chunk(url, cache)
+            ## distinct mtimes, oldest first, whatever the clock resolution
+            os.utime(cache.path(kba_fetch.chunk_md5(url)), (mtime, mtime))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted([kba_fetch.chunk_md5(url) for url in self.urls[-2:]]))
+
+    def test_404(self):
+        self.server.statuses[self.names[0]] = [404]
+        try:
+            kba_fetch.fetch_chunk(self.urls[0], backoff_seconds=0.01)
+        except kba_fetch.HTTPStatusError, exc:
+            self.assertEqual(exc.status, 404)
+        else:
+            self.fail('no HTTPStatusError')
+        ## not retried
+        self.assertEqual(self.server.requests, [self.names[0]])
+
+    def test_503_is_retried(self):
+        self.server.statuses[self.names[0]] = [503]
+        thrift_data = kba_fetch.fetch_chunk(self.urls[0], backoff_seconds=0.01)
+        self.assertEqual(hashlib.md5(thrift_data).hexdigest(),
+                         kba_fetch.chunk_md5(self.urls[0]))
+        self.assertEqual(self.server.requests, [self.names[0]] * 2)
+
+class TestPrefetchChunks(ServerTestCase):
+    delay = 0.1
+
+    def assert_no_partials(self):
+        self.assertEqual([fname for fname in os.listdir(self.cache_dir)
+                          if fname.startswith('.partial.')], [])
+
+    def test_order_and_depth(self):
+        cache = kba_fetch.ChunkCache(self.cache_dir)
+        got = []
+        for chunk in kba_fetch.prefetch_chunks(self.urls, max_in_flight=2, cache=cache):
+            got.append(chunk.url)
+            thrift_data = chunk.thrift_data()
+            self.assertEqual(kba_fetch.chunk_md5(chunk.url),
+                             hashlib.md5(thrift_data).hexdigest())
+        self.assertEqual(got, self.urls)
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual(sorted(self.server.requests), sorted(self.names))
+        self.assert_no_partials()
+
+    def test_skipped_chunks_are_removed(self):
+        cache = kba_fetch.ChunkCache(self.cache_dir)
+        for max_in_flight in (0, 2):
+            for chunk in kba_fetch.prefetch_chunks(self.urls, max_in_flight, cache=cache):
+                pass
+            self.assert_no_partials()
+        ## nothing was read, so nothing was cached
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_stop_early(self):
+        cache = kba_fetch.ChunkCache(self.cache_dir)
+        chunks = kba_fetch.prefetch_chunks(self.urls, max_in_flight=2, cache=cache)
+        first = chunks.next()
+        first.thrift_data()
+        chunks.next()
+        chunks.close()
+        self.assert_no_partials()
+        self.assertEqual(os.listdir(self.cache_dir), [kba_fetch.chunk_md5(self.urls[0])])
+        ## the two chunks yielded and the two after, and no more
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_cache_hit_is_recently_used(self):
+        cache = kba_fetch.ChunkCache(self.cache_dir)
+        cache.put(kba_fetch.chunk_md5(self.urls[0]),
+                  open(os.path.join(self.chunk_dir, self.names[0]), 'rb').read())
+        path = cache.path(kba_fetch.chunk_md5(self.urls[0]))
+        os.utime(path, (1, 1))
+        for chunk in kba_fetch.prefetch_chunks(self.urls[:1], max_in_flight=1, cache=cache):
+            chunk.thrift_data()
+        self.assertEqual(self.server.requests, [])
+        self.assertTrue(os.path.getmtime(path) > 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+'''
+Checks that local_runner.run_job produces the same output as mrjob's
+inline runner, for a word count with a combiner, and for a
+SubcorpusCounter-style job that counts StreamItems per subcorpus over
+a directory of synthetic chunk files.  Skipped without mrjob.
+
+    python test_local_runner.py
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import kba_corpus
+import local_runner
+from thrift.protocol import TBinaryProtocol
+from kba_thrift.ttypes import StreamItem, ContentItem
+
+try:
+    from mrjob.job import MRJob
+    import mrjob.protocol
+except ImportError:
+    MRJob = None
+
+if MRJob is not None:
+
+    class WordCount(MRJob):
+        'counts the words of its input lines'
+
+        def mapper(self, empty, line):
+            for word in line.split():
+                yield word, 1
+
+        def combiner(self, word, counts):
+            yield word, sum(counts)
+
+        def reducer(self, word, counts):
+            yield word, sum(counts)
+
+    class ChunkCounter(MRJob):
+        '''
+        reads paths to chunk files, and outputs [num_items, body
+        bytes] per subcorpus, summed in mapper_final and the combiner
+        as SubcorpusCounter does
+        '''
+        INPUT_PROTOCOL = mrjob.protocol.RawValueProtocol
+
+        def mapper_init(self):
+            self.counts = {}
+
+        def mapper(self, empty, chunk_path):
+            thrift_data = kba_corpus.read_chunk(chunk_path.strip())
+            for stream_item in kba_corpus.stream_items(thrift_data):
+                totals = self.counts.setdefault(stream_item.source, [0, 0])
+                totals[0] += 1
+                totals[1] += len(stream_item.body.raw)
+                self.increment_counter('ChunkCounter', 'StreamItems', 1)
+
+        def mapper_final(self):
+            for source, totals in self.counts.iteritems():
+                yield source, totals
+
+        def combiner(self, source, counts):
+            totals = [0, 0]
+            for count_pair in counts:
+                totals = [a + b for a, b in zip(totals, count_pair)]
+            yield source, totals
+
+        reducer = combiner
+
+def write_synthetic_chunks(chunk_dir, num_chunks=4, items_per_chunk=20):
+    'writes chunk files of StreamItems from a mix of subcorpora into chunk_dir'
+    sources = ['news', 'social', 'linking']
+    paths = []
+    for chunk_num in range(num_chunks):
+        source = sources[chunk_num % len(sources)]
+        o_transport = StringIO()
+        protocol = TBinaryProtocol.TBinaryProtocol(o_transport)
+        for idx in range(items_per_chunk):
+            doc = StreamItem(doc_id='%d-%d' % (chunk_num, idx), source=source,
+                             body=ContentItem(raw='x' * (chunk_num * 100 + idx)))
+            doc.write(protocol)
+        paths.append(kba_corpus.write_chunk(o_transport.getvalue(), chunk_dir, source))
+    return paths
+
+class TestLocalRunner(unittest.TestCase):
+
+    def setUp(self):
+        if MRJob is None:
+            self.skipTest('mrjob is not installed, so there is no inline runner to compare with')
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_local_runner.')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_input(self, lines):
+        path = os.path.join(self.tmp_dir, 'input.txt')
+        fh = open(path, 'wb')
+        fh.write(''.join([line + '\n' for line in lines]))
+        fh.close()
+        return path
+
+    def assert_same_output(self, job_class, input_path):
+        inline_job = job_class(['-r', 'inline', '--no-conf', input_path])
+        inline_job.sandbox()
+        runner = inline_job.make_runner()
+        try:
+            runner.run()
+            inline_lines = sorted(runner.stream_output())
+        finally:
+            runner.cleanup()
+
+        o_fh = StringIO()
+        local_runner.run_job(job_class, [input_path], o_fh, num_processes=2,
+                             num_reduce_tasks=3, tmp_dir=self.tmp_dir)
+        local_lines = sorted(o_fh.getvalue().splitlines(True))
+        self.assertTrue(local_lines)
+        self.assertEqual(local_lines, inline_lines)
+
+    def test_word_count(self):
+        input_path = self.write_input(['a b c a', 'b a', '', 'c c d'])
+        self.assert_same_output(WordCount, input_path)
+
+    def test_chunk_counter(self):
+        chunk_dir = os.path.join(self.tmp_dir, '2012-04-23-08')
+        os.makedirs(chunk_dir)
+        input_path = self.write_input(write_synthetic_chunks(chunk_dir))
+        self.assert_same_output(ChunkCounter, input_path)
+
+if __name__ == '__main__':
+    unittest.main()
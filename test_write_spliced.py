@@ -0,0 +1,80 @@
+#!/usr/bin/python
+'''
+Checks that write_spliced produces the same bytes as a full re-encode
+with StreamItem.write, including when nested structs are not in the
+canonical layout that write() produces.
+
+    python test_write_spliced.py
+'''
+
+import unittest
+from cStringIO import StringIO
+
+import kba_corpus
+from thrift.Thrift import TType
+from thrift.protocol import TBinaryProtocol
+from kba_thrift.ttypes import StreamItem, ContentItem, StreamTime
+
+def _write_strings(protocol, fields):
+    'writes the (fid, value) string fields, in the order given'
+    for fid, value in fields:
+        protocol.writeFieldBegin(None, TType.STRING, fid)
+        protocol.writeString(value)
+        protocol.writeFieldEnd()
+
+def _write_stream_item(protocol, body_fields):
+    '''
+    writes by hand a StreamItem whose body ContentItem has exactly the
+    string fields body_fields, in the order given
+    '''
+    protocol.writeStructBegin('StreamItem')
+    _write_strings(protocol, [(1, 'doc-id')])
+    protocol.writeFieldBegin('body', TType.STRUCT, 7)
+    protocol.writeStructBegin('ContentItem')
+    _write_strings(protocol, body_fields)
+    protocol.writeFieldStop()
+    protocol.writeStructEnd()
+    protocol.writeFieldEnd()
+    _write_strings(protocol, [(9, '{"old": 1}'), (10, '1335168000-doc-id')])
+    protocol.writeFieldStop()
+    protocol.writeStructEnd()
+
+class TestWriteSpliced(unittest.TestCase):
+
+    def assert_splice_matches_write(self, thrift_data):
+        items = list(kba_corpus.stream_items_with_spans(thrift_data))
+        self.assertEqual(len(items), 1)
+        stream_item, spans = items[0]
+        stream_item.source_metadata = '{"new": 2}'
+
+        spliced = StringIO()
+        kba_corpus.write_spliced(spliced, thrift_data, spans, stream_item)
+        written = StringIO()
+        stream_item.write(TBinaryProtocol.TBinaryProtocol(written))
+        self.assertEqual(spliced.getvalue(), written.getvalue())
+
+    def encode(self, body_fields):
+        o_transport = StringIO()
+        _write_stream_item(TBinaryProtocol.TBinaryProtocol(o_transport), body_fields)
+        return o_transport.getvalue()
+
+    def test_canonical(self):
+        doc = StreamItem(doc_id='doc-id', stream_id='1335168000-doc-id',
+                         source_metadata='{"old": 1}',
+                         body=ContentItem(raw='raw', encoding='UTF-8'),
+                         stream_time=StreamTime(epoch_ticks=1335168000.0,
+                                                zulu_timestamp='2012-04-23T08:00:00.000000Z'))
+        o_transport = StringIO()
+        doc.write(TBinaryProtocol.TBinaryProtocol(o_transport))
+        self.assert_splice_matches_write(o_transport.getvalue())
+
+    def test_nested_unknown_field(self):
+        self.assert_splice_matches_write(
+            self.encode([(1, 'raw'), (2, 'UTF-8'), (99, 'unknown')]))
+
+    def test_nested_out_of_order_field(self):
+        self.assert_splice_matches_write(
+            self.encode([(2, 'UTF-8'), (1, 'raw')]))
+
+if __name__ == '__main__':
+    unittest.main()
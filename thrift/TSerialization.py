@@ -20,6 +20,11 @@
 from protocol import TBinaryProtocol
 from transport import TTransport
 
+try:
+    from protocol import fastbinary
+except:
+    fastbinary = None
+
 def serialize(thrift_object, protocol_factory = TBinaryProtocol.TBinaryProtocolFactory()):
     transport = TTransport.TMemoryBuffer()
     protocol = protocol_factory.getProtocol(transport)
@@ -32,3 +37,64 @@ def deserialize(base, buf, protocol_factory = TBinaryProtocol.TBinaryProtocolFac
     base.read(protocol)
     return base
 
+
+def serialize_many(thrift_objects, protocol_factory = TBinaryProtocol.TBinaryProtocolAcceleratedFactory()):
+    """Serialize a sequence of thrift objects into one buffer.
+
+    Returns (buf, offsets), where offsets[i] is the position in buf of
+    the i-th object.  One transport and protocol are used for the whole
+    batch, rather than one of each per object as with serialize, and
+    the default protocol is encoded by fastbinary when it is available.
+    """
+    transport = TTransport.TMemoryBuffer()
+    protocol = protocol_factory.getProtocol(transport)
+    tell = transport.cstringio_buf.tell
+    offsets = []
+    if protocol.__class__ == TBinaryProtocol.TBinaryProtocolAccelerated and fastbinary is not None:
+        # as the generated write() would, but without a call to it and a
+        # write to the transport per object
+        encode = fastbinary.encode_binary
+        parts = []
+        size = 0
+        for thrift_object in thrift_objects:
+            offsets.append(size)
+            if thrift_object.thrift_spec is not None:
+                part = encode(thrift_object, (thrift_object.__class__, thrift_object.thrift_spec))
+            else:
+                transport = TTransport.TMemoryBuffer()
+                thrift_object.write(protocol_factory.getProtocol(transport))
+                part = transport.getvalue()
+            parts.append(part)
+            size += len(part)
+        return ''.join(parts), offsets
+    for thrift_object in thrift_objects:
+        offsets.append(tell())
+        thrift_object.write(protocol)
+    return transport.getvalue(), offsets
+
+def deserialize_many(cls, buf, offsets = None, protocol_factory = TBinaryProtocol.TBinaryProtocolAcceleratedFactory()):
+    """Deserialize a list of new instances of cls from buf.
+
+    One object is read at each position in offsets, e.g. some of those
+    returned by serialize_many, or if offsets is None, every object in
+    buf is read in turn.  The buf must be in the protocol that
+    protocol_factory makes, which by default is decoded by fastbinary
+    when it is available.
+    """
+    transport = TTransport.TMemoryBuffer(buf)
+    protocol = protocol_factory.getProtocol(transport)
+    cbuf = transport.cstringio_buf
+    objects = []
+    if offsets is None:
+        size = len(buf)
+        while cbuf.tell() < size:
+            base = cls()
+            base.read(protocol)
+            objects.append(base)
+        return objects
+    for offset in offsets:
+        cbuf.seek(offset)
+        base = cls()
+        base.read(protocol)
+        objects.append(base)
+    return objects
@@ -70,3 +70,75 @@ class TExceptionBase(Exception):
   read = TBase.read.im_func
   write = TBase.write.im_func
   
+
+
+def compact_types(*classes):
+  '''
+  Make new-style, __slots__ based versions of generated struct
+  classes, such as StreamItem, for holding many decoded structs in
+  memory, and return a dict of them by class name.  The structs
+  nested in them get compact versions too, which the thrift_spec of
+  each compact class refers to, so reading a compact StreamItem makes
+  compact ContentItems.
+
+  Compact structs have the same attributes, constructor arguments,
+  and defaults as the generated ones, and equality and repr from
+  TBase, but no per-instance __dict__.  They are read with fastbinary
+  when the generated code would use it, and otherwise with a
+  TSpecDecoder, and written with fastbinary or the generated write().
+  '''
+  from thrift.protocol import TSpecDecoder
+  compact = {}
+
+  def make(cls):
+    if cls in compact:
+      return compact[cls]
+    spec = []
+    for field in cls.thrift_spec:
+      if field is not None:
+        field = field[:3] + (compact_args(field[1], field[3]),) + field[4:]
+      spec.append(field)
+    names = [field[2] for field in spec if field is not None]
+    defaults = [field[4] for field in spec if field is not None]
+
+    def __init__(self, *args, **kwargs):
+      for name, default in zip(names, defaults):
+        setattr(self, name, default)
+      for name, value in zip(names, args):
+        setattr(self, name, value)
+      for name, value in kwargs.items():
+        setattr(self, name, value)
+
+    def write(self, oprot):
+      if oprot.__class__ == TBinaryProtocol.TBinaryProtocolAccelerated and fastbinary is not None:
+        oprot.trans.write(fastbinary.encode_binary(self, (self.__class__, self.thrift_spec)))
+        return
+      cls.write.im_func(self, oprot)
+
+    compact[cls] = type(cls.__name__, (TBase,), {
+        '__slots__': names,
+        '__doc__': cls.__doc__,
+        '__module__': cls.__module__,
+        '__init__': __init__,
+        'thrift_spec': tuple(spec),
+        'read': TSpecDecoder.read,
+        'write': write,
+        })
+    return compact[cls]
+
+  def compact_args(ftype, args):
+    if ftype == TType.STRUCT:
+      struct_cls, struct_spec = args
+      struct_cls = make(struct_cls)
+      return (struct_cls, struct_cls.thrift_spec)
+    elif ftype in (TType.LIST, TType.SET):
+      etype, eargs = args
+      return (etype, compact_args(etype, eargs))
+    elif ftype == TType.MAP:
+      ktype, kargs, vtype, vargs = args
+      return (ktype, compact_args(ktype, kargs), vtype, compact_args(vtype, vargs))
+    return args
+
+  for cls in classes:
+    make(cls)
+  return dict((cls.__name__, compact_cls) for cls, compact_cls in compact.items())
@@ -18,7 +18,8 @@
 #
 
 from TProtocol import *
-from struct import pack, unpack
+from struct import pack, unpack, Struct
+from thrift.transport.TTransport import CReadableTransport
 
 class TBinaryProtocol(TProtocolBase):
 
@@ -257,3 +258,260 @@ class TBinaryProtocolAccelerated(TBinaryProtocol):
 class TBinaryProtocolAcceleratedFactory:
   def getProtocol(self, trans):
     return TBinaryProtocolAccelerated(trans)
+
+
+_BYTE = Struct('!b')
+_I16 = Struct('!h')
+_I32 = Struct('!i')
+_I64 = Struct('!q')
+_DOUBLE = Struct('!d')
+_FIELD_HEADER = Struct('!bh')
+_MAP_HEADER = Struct('!bbi')
+_LIST_HEADER = Struct('!bi')
+
+# byte widths of the fixed-size types, also used by scanners of
+# binary-protocol data that skip values without a protocol
+WIDTHS = {
+  TType.BOOL: 1,
+  TType.BYTE: 1,
+  TType.I16: 2,
+  TType.I32: 4,
+  TType.I64: 8,
+  TType.DOUBLE: 8,
+  }
+
+
+class TBinaryProtocolFast(TBinaryProtocol):
+
+  """Pure python version of TBinaryProtocol, for when fastbinary is
+  not available, that produces and accepts exactly the same bytes.
+
+  Values are packed and unpacked with precompiled Struct objects, and
+  field, list, set, and map headers are each written and read in one
+  call.  On a transport that implements CReadableTransport, such as
+  TMemoryBuffer or TSliceTransport, reads slice the transport's
+  cStringIO directly instead of going through readAll, and a field
+  header is read with a single three-byte read, which steps back two
+  bytes when it turns out to be the one-byte STOP.
+
+  skip() jumps over strings and runs of fixed-size values by their
+  length prefixes, without reading them, and walks nested structs
+  and containers with a stack instead of recursion.
+  """
+
+  def __init__(self, trans, strictRead=False, strictWrite=True):
+    TBinaryProtocol.__init__(self, trans, strictRead, strictWrite)
+    self._cstring = isinstance(trans, CReadableTransport)
+    if self._cstring:
+      self._read = self._readCString
+    else:
+      self._read = trans.readAll
+
+  def _readCString(self, sz):
+    buf = self.trans.cstringio_buf
+    data = buf.read(sz)
+    if len(data) < sz:
+      data = self.trans.cstringio_refill(data, sz).read(sz)
+    return data
+
+  def _skipBytes(self, sz):
+    '''
+    Advance past sz bytes, by seeking in the transport's cStringIO as
+    far as it goes, and refilling it for the rest.
+    '''
+    if not self._cstring or sz <= 64:
+      # a short read costs less than finding the end of the buffer
+      self._read(sz)
+      return
+    trans = self.trans
+    buf = trans.cstringio_buf
+    while True:
+      pos = buf.tell()
+      buf.seek(0, 2)
+      avail = buf.tell() - pos
+      if avail >= sz:
+        buf.seek(pos + sz)
+        return
+      sz -= avail
+      buf = trans.cstringio_refill('', 1)
+
+  def skip(self, type):
+    '''
+    Skip over a value of the given type, and return the number of
+    bytes it took up.
+    '''
+    skipped = 0
+    # frames of the structs and containers being skipped:
+    # [STRUCT], [LIST, etype, count], or [MAP, ktype, vtype, count]
+    # where count is of the keys and values left
+    stack = []
+    while True:
+      if type is not None:
+        if type in WIDTHS:
+          self._skipBytes(WIDTHS[type])
+          skipped += WIDTHS[type]
+        elif type == TType.STRING:
+          size, = _I32.unpack(self._read(4))
+          if size < 0:
+            raise TProtocolException(TProtocolException.NEGATIVE_SIZE,
+                                     'Negative string size %d' % size)
+          self._skipBytes(size)
+          skipped += 4 + size
+        elif type == TType.STRUCT:
+          stack.append([TType.STRUCT])
+        elif type in (TType.LIST, TType.SET):
+          etype, size = _LIST_HEADER.unpack(self._read(5))
+          skipped += 5
+          if size < 0:
+            raise TProtocolException(TProtocolException.NEGATIVE_SIZE,
+                                     'Negative list size %d' % size)
+          if etype in WIDTHS:
+            self._skipBytes(size * WIDTHS[etype])
+            skipped += size * WIDTHS[etype]
+          elif size:
+            stack.append([TType.LIST, etype, size])
+        elif type == TType.MAP:
+          ktype, vtype, size = _MAP_HEADER.unpack(self._read(6))
+          skipped += 6
+          if size < 0:
+            raise TProtocolException(TProtocolException.NEGATIVE_SIZE,
+                                     'Negative map size %d' % size)
+          if ktype in WIDTHS and vtype in WIDTHS:
+            self._skipBytes(size * (WIDTHS[ktype] + WIDTHS[vtype]))
+            skipped += size * (WIDTHS[ktype] + WIDTHS[vtype])
+          elif size:
+            stack.append([TType.MAP, ktype, vtype, 2 * size])
+        else:
+          raise TProtocolException(TProtocolException.INVALID_DATA,
+                                   'Cannot skip thrift type %r' % type)
+        type = None
+
+      if not stack:
+        return skipped
+      frame = stack[-1]
+      if frame[0] == TType.STRUCT:
+        fname, type, fid = self.readFieldBegin()
+        if type == TType.STOP:
+          skipped += 1
+          stack.pop()
+          type = None
+        else:
+          skipped += 3
+      elif frame[0] == TType.LIST:
+        type = frame[1]
+        frame[2] -= 1
+        if frame[2] == 0:
+          stack.pop()
+      else:
+        # keys come before values, so an even count means a key
+        if frame[3] % 2 == 0:
+          type = frame[1]
+        else:
+          type = frame[2]
+        frame[3] -= 1
+        if frame[3] == 0:
+          stack.pop()
+
+  def writeFieldBegin(self, name, type, id):
+    self.trans.write(_FIELD_HEADER.pack(type, id))
+
+  def writeFieldStop(self):
+    self.trans.write('\x00')
+
+  def writeMapBegin(self, ktype, vtype, size):
+    self.trans.write(_MAP_HEADER.pack(ktype, vtype, size))
+
+  def writeListBegin(self, etype, size):
+    self.trans.write(_LIST_HEADER.pack(etype, size))
+
+  def writeSetBegin(self, etype, size):
+    self.trans.write(_LIST_HEADER.pack(etype, size))
+
+  def writeBool(self, bool):
+    if bool:
+      self.trans.write('\x01')
+    else:
+      self.trans.write('\x00')
+
+  def writeByte(self, byte):
+    self.trans.write(_BYTE.pack(byte))
+
+  def writeI16(self, i16):
+    self.trans.write(_I16.pack(i16))
+
+  def writeI32(self, i32):
+    self.trans.write(_I32.pack(i32))
+
+  def writeI64(self, i64):
+    self.trans.write(_I64.pack(i64))
+
+  def writeDouble(self, dub):
+    self.trans.write(_DOUBLE.pack(dub))
+
+  def writeString(self, str):
+    self.trans.write(_I32.pack(len(str)))
+    self.trans.write(str)
+
+  def readFieldBegin(self):
+    if not self._cstring:
+      type, = _BYTE.unpack(self._read(1))
+      if type == TType.STOP:
+        return (None, type, 0)
+      id, = _I16.unpack(self._read(2))
+      return (None, type, id)
+
+    buf = self.trans.cstringio_buf
+    data = buf.read(3)
+    if len(data) < 3:
+      if not data:
+        buf = self.trans.cstringio_refill(data, 1)
+        data = buf.read(3)
+      if data[0] != '\x00' and len(data) < 3:
+        buf = self.trans.cstringio_refill(data, 3)
+        data = buf.read(3)
+    if data[0] == '\x00':
+      # STOP has no field id, so the rest belongs to what follows
+      buf.seek(1 - len(data), 1)
+      return (None, TType.STOP, 0)
+    type, id = _FIELD_HEADER.unpack(data)
+    return (None, type, id)
+
+  def readMapBegin(self):
+    return _MAP_HEADER.unpack(self._read(6))
+
+  def readListBegin(self):
+    return _LIST_HEADER.unpack(self._read(5))
+
+  def readSetBegin(self):
+    return _LIST_HEADER.unpack(self._read(5))
+
+  def readBool(self):
+    return self._read(1) != '\x00'
+
+  def readByte(self):
+    return _BYTE.unpack(self._read(1))[0]
+
+  def readI16(self):
+    return _I16.unpack(self._read(2))[0]
+
+  def readI32(self):
+    return _I32.unpack(self._read(4))[0]
+
+  def readI64(self):
+    return _I64.unpack(self._read(8))[0]
+
+  def readDouble(self):
+    return _DOUBLE.unpack(self._read(8))[0]
+
+  def readString(self):
+    len, = _I32.unpack(self._read(4))
+    return self._read(len)
+
+
+class TBinaryProtocolFastFactory:
+  def __init__(self, strictRead=False, strictWrite=True):
+    self.strictRead = strictRead
+    self.strictWrite = strictWrite
+
+  def getProtocol(self, trans):
+    return TBinaryProtocolFast(trans, self.strictRead, self.strictWrite)
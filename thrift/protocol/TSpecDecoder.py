@@ -0,0 +1,322 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements. See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership. The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+'''
+TSpecDecoder reads generated thrift structs by their thrift_spec
+instead of their generated read() methods, which test the field id
+against every field in turn and look up each protocol method on
+every call.  Each struct class is compiled once per protocol into a
+table indexed by field id, of the field's type, its attribute name,
+and a function reading its value from the protocol, so nested
+structs, lists, sets, and maps are read by table lookups too.
+
+For the binary protocol on a CReadableTransport, such as
+TMemoryBuffer or TSliceTransport, field headers, strings, and
+numbers are read straight from the transport's cStringIO, as
+fastbinary does, rather than through the protocol's methods.
+
+The objects it makes are identical to those of the generated code,
+including defaults and fields skipped for having the wrong type.
+With reuse=True, read() decodes into an existing object instead,
+resetting its fields to their defaults and reading nested structs
+into the objects it already holds, so a long scan need not allocate
+a new object graph for every struct.
+
+To use it for every read of some generated classes, e.g. both the
+kba_thrift and streamcorpus StreamItem families, call install() on
+them; fastbinary is still used when the generated code would use it.
+'''
+
+from struct import Struct
+from thrift.Thrift import TType
+from thrift.protocol import TBinaryProtocol
+from thrift.transport import TTransport
+
+try:
+  from thrift.protocol import fastbinary
+except:
+  fastbinary = None
+
+
+_FIELD_HEADER = Struct('!bh')
+_I32 = Struct('!i')
+
+# Struct to unpack each fixed-width type in the binary protocol
+_BINARY_STRUCTS = {
+  TType.BOOL: Struct('!?'),
+  TType.BYTE: Struct('!b'),
+  TType.I16: Struct('!h'),
+  TType.I32: _I32,
+  TType.I64: Struct('!q'),
+  TType.DOUBLE: Struct('!d'),
+  }
+
+
+class TSpecDecoder(object):
+  '''
+  Reads structs from one protocol instance, given their classes and
+  thrift_spec tuples, keeping the compiled table of each class.
+  '''
+
+  def __init__(self, iprot):
+    self.iprot = iprot
+    self._tables = {}
+    self._fields = {}
+    # the binary protocol's struct and field begin/end are no-ops
+    self._binary = isinstance(iprot, TBinaryProtocol.TBinaryProtocol)
+    self._direct = self._binary and isinstance(iprot.trans, TTransport.CReadableTransport)
+    if self._direct:
+      self.read = self._read_direct
+      # which jumps over unwanted fields by their length prefixes
+      self._skip = TBinaryProtocol.TBinaryProtocolFast(iprot.trans).skip
+
+  def _read_bytes(self, sz):
+    '''
+    Internal method that reads exactly sz bytes from the cStringIO
+    of the transport, refilling it if needed
+    '''
+    trans = self.iprot.trans
+    data = trans.cstringio_buf.read(sz)
+    if len(data) < sz:
+      data = trans.cstringio_refill(data, sz).read(sz)
+    return data
+
+  def _table(self, cls, spec):
+    '''
+    Internal method that compiles spec into a list, indexed by field
+    id, of None or (ftype, name, read_value, struct class or None),
+    and a list of (name, default, struct class or None) for resetting
+    the fields of a reused object
+    '''
+    table = [None] * len(spec)
+    fields = []
+    self._tables[cls] = table
+    self._fields[cls] = fields
+    for field in spec:
+      if field is None:
+        continue
+      fid, ftype, name, args, default = field[:5]
+      struct_cls = None
+      if ftype == TType.STRUCT:
+        struct_cls = args[0]
+      table[fid] = (ftype, name, self._reader(ftype, args), struct_cls)
+      fields.append((name, default, struct_cls))
+    return table
+
+  def _prepare(self, cls, spec, obj, reuse):
+    '''
+    Internal method that returns (table, obj, spare) for reading a
+    struct of class cls, where spare is None or, when reusing obj, a
+    dict of the nested structs that obj held, by attribute name
+    '''
+    table = self._tables.get(cls)
+    if table is None:
+      if spec is None:
+        spec = cls.thrift_spec
+      table = self._table(cls, spec)
+    spare = None
+    if obj is None:
+      obj = cls()
+    elif reuse:
+      spare = {}
+      for name, default, struct_cls in self._fields[cls]:
+        if struct_cls is not None:
+          nested = getattr(obj, name, None)
+          if nested.__class__ is struct_cls:
+            spare[name] = nested
+        setattr(obj, name, default)
+    return table, obj, spare
+
+  def _reader(self, ftype, args):
+    '''
+    Internal method that returns a function of no arguments that
+    reads a value of type ftype, with the spec args of a field
+    '''
+    iprot = self.iprot
+    if self._direct:
+      read_bytes = self._read_bytes
+      if ftype == TType.STRING:
+        def read_string():
+          size, = _I32.unpack(read_bytes(4))
+          return read_bytes(size)
+        return read_string
+      elif ftype in _BINARY_STRUCTS:
+        unpack = _BINARY_STRUCTS[ftype].unpack
+        size = _BINARY_STRUCTS[ftype].size
+        return lambda: unpack(read_bytes(size))[0]
+
+    if ftype == TType.STRING:
+      return iprot.readString
+    elif ftype == TType.I32:
+      return iprot.readI32
+    elif ftype == TType.I64:
+      return iprot.readI64
+    elif ftype == TType.DOUBLE:
+      return iprot.readDouble
+    elif ftype == TType.I16:
+      return iprot.readI16
+    elif ftype == TType.BYTE:
+      return iprot.readByte
+    elif ftype == TType.BOOL:
+      return iprot.readBool
+
+    elif ftype == TType.STRUCT:
+      cls, spec = args
+      read = self.read
+      return lambda: read(cls, spec)
+
+    elif ftype == TType.LIST:
+      etype, eargs = args
+      read_elem = self._reader(etype, eargs)
+      def read_list():
+        _etype, size = iprot.readListBegin()
+        value = [read_elem() for idx in xrange(size)]
+        iprot.readListEnd()
+        return value
+      return read_list
+
+    elif ftype == TType.SET:
+      etype, eargs = args
+      read_elem = self._reader(etype, eargs)
+      def read_set():
+        _etype, size = iprot.readSetBegin()
+        value = set([read_elem() for idx in xrange(size)])
+        iprot.readSetEnd()
+        return value
+      return read_set
+
+    elif ftype == TType.MAP:
+      ktype, kargs, vtype, vargs = args
+      read_key = self._reader(ktype, kargs)
+      read_val = self._reader(vtype, vargs)
+      def read_map():
+        _ktype, _vtype, size = iprot.readMapBegin()
+        value = {}
+        for idx in xrange(size):
+          # the key must be read before the value
+          key = read_key()
+          value[key] = read_val()
+        iprot.readMapEnd()
+        return value
+      return read_map
+
+    raise TypeError('cannot decode thrift type %r' % ftype)
+
+  def read(self, cls, spec=None, obj=None, reuse=False):
+    '''
+    Read a struct of class cls, with the given thrift_spec or that of
+    cls, into obj or a new instance of cls, and return it.
+
+    If reuse, the fields of obj are first reset to their defaults,
+    and nested structs are read into the objects obj held before, so
+    any reference into obj from an earlier read sees the new values.
+    Otherwise, fields that are absent keep the values obj had, as with
+    the generated read().
+    '''
+    table, obj, spare = self._prepare(cls, spec, obj, reuse)
+    iprot = self.iprot
+    readFieldBegin = iprot.readFieldBegin
+    num_fids = len(table)
+    binary = self._binary
+    if not binary:
+      iprot.readStructBegin()
+    while True:
+      fname, ftype, fid = readFieldBegin()
+      if ftype == TType.STOP:
+        break
+      entry = None
+      if 0 <= fid < num_fids:
+        entry = table[fid]
+      if entry is None or entry[0] != ftype:
+        iprot.skip(ftype)
+      elif spare is not None and ftype == TType.STRUCT:
+        setattr(obj, entry[1], self.read(entry[3], None, spare.get(entry[1]), True))
+      else:
+        setattr(obj, entry[1], entry[2]())
+      if not binary:
+        iprot.readFieldEnd()
+    if not binary:
+      iprot.readStructEnd()
+    return obj
+
+  def _read_direct(self, cls, spec=None, obj=None, reuse=False):
+    '''
+    Version of read for the binary protocol on a CReadableTransport,
+    which reads field headers and strings inline
+    '''
+    table, obj, spare = self._prepare(cls, spec, obj, reuse)
+    trans = self.iprot.trans
+    num_fids = len(table)
+    while True:
+      buf = trans.cstringio_buf
+      header = buf.read(3)
+      if len(header) < 3:
+        if not header:
+          buf = trans.cstringio_refill(header, 1)
+          header = buf.read(3)
+        if header[0] != '\x00' and len(header) < 3:
+          buf = trans.cstringio_refill(header, 3)
+          header = buf.read(3)
+      if header[0] == '\x00':
+        # STOP has no field id, so the rest belongs to what follows
+        buf.seek(1 - len(header), 1)
+        return obj
+      ftype, fid = _FIELD_HEADER.unpack(header)
+      entry = None
+      if 0 <= fid < num_fids:
+        entry = table[fid]
+      if entry is None or entry[0] != ftype:
+        self._skip(ftype)
+      elif ftype == TType.STRING:
+        data = buf.read(4)
+        if len(data) < 4:
+          buf = trans.cstringio_refill(data, 4)
+          data = buf.read(4)
+        size, = _I32.unpack(data)
+        data = buf.read(size)
+        if len(data) < size:
+          data = trans.cstringio_refill(data, size).read(size)
+        setattr(obj, entry[1], data)
+      elif spare is not None and ftype == TType.STRUCT:
+        setattr(obj, entry[1], self._read_direct(entry[3], None, spare.get(entry[1]), True))
+      else:
+        setattr(obj, entry[1], entry[2]())
+
+
+def read(self, iprot):
+  '''
+  Replacement for the read() method of a generated struct, see
+  install.  The TSpecDecoder of iprot is kept on it.
+  '''
+  if iprot.__class__ == TBinaryProtocol.TBinaryProtocolAccelerated and isinstance(iprot.trans, TTransport.CReadableTransport) and self.thrift_spec is not None and fastbinary is not None:
+    fastbinary.decode_binary(self, iprot.trans, (self.__class__, self.thrift_spec))
+    return
+  decoder = getattr(iprot, '_spec_decoder', None)
+  if decoder is None:
+    decoder = iprot._spec_decoder = TSpecDecoder(iprot)
+  decoder.read(self.__class__, self.thrift_spec, self)
+
+
+def install(*classes):
+  '''
+  Make the read() method of each of the generated struct classes use
+  a TSpecDecoder.  Structs nested in them are read by the decoder
+  whether or not their classes are installed.
+  '''
+  for cls in classes:
+    cls.read = read
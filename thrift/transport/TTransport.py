@@ -17,6 +17,8 @@
 # under the License.
 #
 
+import os
+import mmap
 from cStringIO import StringIO
 from struct import pack,unpack
 from thrift.Thrift import TException
@@ -237,6 +239,89 @@ class TMemoryBuffer(TTransportBase, CReadableTransport):
     # only one shot at reading...
     raise EOFError()
 
+class TSliceTransport(TTransportBase, CReadableTransport):
+  """Read-only transport over one complete buffer of serialized data.
+
+  The value may be a str, a buffer() view, or an mmap, and is never
+  copied as a whole: every read is a single slice of it, including
+  readAll of a multi-megabyte string, and read_view returns a buffer()
+  view without copying at all.  Unlike TBufferedTransport, there is no
+  refill, so the cStringIO that the C accelerator reads from is created
+  once over the whole value.
+  """
+
+  def __init__(self, value):
+    self._value = value
+    self._len = len(value)
+    self._buffer = StringIO(value)
+
+  @classmethod
+  def from_file(cls, path):
+    """Makes a transport over a read-only mmap of the file at path."""
+    fh = open(path, 'rb')
+    try:
+      if os.fstat(fh.fileno()).st_size == 0:
+        return cls('')
+      return cls(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+    finally:
+      # the mmap keeps its own reference to the file
+      fh.close()
+
+  def isOpen(self):
+    return not self._buffer.closed
+
+  def open(self):
+    pass
+
+  def close(self):
+    self._buffer.close()
+
+  def tell(self):
+    return self._buffer.tell()
+
+  def seek(self, pos):
+    self._buffer.seek(pos)
+
+  def remaining(self):
+    return self._len - self._buffer.tell()
+
+  def read(self, sz):
+    return self._buffer.read(sz)
+
+  def readAll(self, sz):
+    if self._len - self._buffer.tell() < sz:
+      self._buffer.seek(self._len)
+      raise EOFError()
+    return self._buffer.read(sz)
+
+  def read_view(self, sz):
+    """Returns a buffer() view of the next sz bytes, without copying."""
+    pos = self._buffer.tell()
+    if self._len - pos < sz:
+      self._buffer.seek(self._len)
+      raise EOFError()
+    self._buffer.seek(pos + sz)
+    return buffer(self._value, pos, sz)
+
+  def skip(self, sz):
+    if self._len - self._buffer.tell() < sz:
+      self._buffer.seek(self._len)
+      raise EOFError()
+    self._buffer.seek(sz, 1)
+
+  def write(self, buf):
+    raise TTransportException(TTransportException.UNKNOWN,
+                              'TSliceTransport is read-only')
+
+  # Implement the CReadableTransport interface.
+  @property
+  def cstringio_buf(self):
+    return self._buffer
+
+  def cstringio_refill(self, partialread, reqlen):
+    # the whole value is already in the buffer
+    raise EOFError()
+
 class TFramedTransportFactory:
 
   """Factory transport that builds framed transports"""
@@ -0,0 +1,203 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements. See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership. The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+'''
+TXzTransport provides a transport that compresses writes and
+decompresses reads in the xz format, like TZlibTransport does with
+zlib, using the lzma module of python 3.3 or its backport to python
+2, backports.lzma.  Reads decompress only as much as the protocol
+asks for, so a large .xz file can be decoded in bounded memory.
+'''
+
+from cStringIO import StringIO
+from TTransport import TTransportBase, TTransportException, TFileObjectTransport, CReadableTransport
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+
+class TXzTransport(TTransportBase, CReadableTransport):
+  '''
+  Class that wraps a transport or file object with xz, compressing
+  writes and decompressing reads.
+
+  Each flush() that follows a write ends an xz stream and starts
+  another, so everything written before a flush can be read back by
+  xz --decompress, which reads concatenated streams as one, as does
+  this class.
+  '''
+
+  # Size of the reads of compressed bytes from the underlying
+  # transport, and the least that cstringio_refill decompresses for
+  # the fastbinary C extension.
+  DEFAULT_READ_SIZE = 65536
+
+  # Bytes of writes buffered before passing them to the compressor,
+  # which is costly to call for every small write of a protocol.
+  WRITE_BUFFER_SIZE = 65536
+
+  def __init__(self, trans, preset=6, read_size=DEFAULT_READ_SIZE):
+    '''
+    Create a new TXzTransport, wrapping C{trans}.
+
+    @param trans: A thrift transport object, or a file object such
+    as an open .xz file, which is wrapped in a TFileObjectTransport.
+    @param preset: The xz compression preset for writes, from 0
+    (fastest) to 9 (best compression).  Default is 6, as for xz.
+    @type preset: int
+    @param read_size: Number of compressed bytes to read from trans
+    at a time.
+    @type read_size: int
+    '''
+    if lzma is None:
+      raise ImportError('TXzTransport needs the lzma module, '
+                        'which python 2 gets from backports.lzma')
+    if not isinstance(trans, TTransportBase):
+      trans = TFileObjectTransport(trans)
+    self.__trans = trans
+    self.preset = preset
+    self.read_size = read_size
+    self._init_lzma()
+
+  def _init_lzma(self):
+    '''
+    Internal method for setting up the buffers and the xz
+    compression and decompression objects.
+    '''
+    self.__rbuf = StringIO('')
+    self.__wbuf = StringIO()
+    self._decomp = lzma.LZMADecompressor()
+    self._comp = None
+    # true while self._decomp is partway through a stream
+    self._started = False
+    self._trans_eof = False
+
+  def isOpen(self):
+    '''Return the underlying transport's open status'''
+    return self.__trans.isOpen()
+
+  def open(self):
+    '''Open the underlying transport'''
+    return self.__trans.open()
+
+  def close(self):
+    '''End the xz stream being written, and close the underlying transport'''
+    self.flush()
+    self._init_lzma()
+    return self.__trans.close()
+
+  def _decompress_more(self):
+    '''
+    Internal method that reads compressed bytes from the underlying
+    transport until some of them decompress, and returns the
+    decompressed bytes, or '' at the end of the compressed data.
+    '''
+    while not self._trans_eof:
+      zbuf = self.__trans.read(self.read_size)
+      if not zbuf:
+        self._trans_eof = True
+        if self._started:
+          raise TTransportException(TTransportException.END_OF_FILE,
+                                    'xz data ends partway through a stream')
+        return ''
+      self._started = True
+      buf = self._decomp.decompress(zbuf)
+      while self._decomp.eof:
+        # the rest is the start of a concatenated stream, if any
+        zbuf = self._decomp.unused_data
+        self._decomp = lzma.LZMADecompressor()
+        self._started = bool(zbuf)
+        if zbuf:
+          buf += self._decomp.decompress(zbuf)
+      if buf:
+        return buf
+    return ''
+
+  def read(self, sz):
+    '''
+    Read up to sz bytes from the decompressed bytes buffer, and
+    decompress more from the underlying transport if it is empty.
+    '''
+    ret = self.__rbuf.read(sz)
+    if ret:
+      return ret
+    buf = self._decompress_more()
+    if not buf:
+      return ''
+    self.__rbuf = StringIO(buf)
+    return self.__rbuf.read(sz)
+
+  def write(self, buf):
+    '''
+    Write some bytes, putting them into the internal write buffer,
+    and compressing it once it is full.
+    '''
+    self.__wbuf.write(buf)
+    if self.__wbuf.tell() >= self.WRITE_BUFFER_SIZE:
+      self._compress_wbuf()
+
+  def _compress_wbuf(self):
+    '''
+    Internal method that passes the write buffer to the compressor,
+    starting a new xz stream if there is none, and writes whatever
+    compressed bytes come out to the underlying transport.
+    '''
+    wout = self.__wbuf.getvalue()
+    if not wout:
+      return
+    if self._comp is None:
+      self._comp = lzma.LZMACompressor(preset=self.preset)
+    zbuf = self._comp.compress(wout)
+    if zbuf:
+      self.__trans.write(zbuf)
+    self.__wbuf = StringIO()
+
+  def flush(self):
+    '''
+    End the xz stream of the bytes written since the last flush,
+    write the rest of it to the underlying transport, and flush that.
+    '''
+    self._compress_wbuf()
+    if self._comp is not None:
+      self.__trans.write(self._comp.flush())
+      self._comp = None
+    self.__trans.flush()
+
+  # Implement the CReadableTransport interface.
+  @property
+  def cstringio_buf(self):
+    return self.__rbuf
+
+  def cstringio_refill(self, partialread, reqlen):
+    parts = [partialread, self.__rbuf.read()]
+    have = len(partialread) + len(parts[1])
+    while have < max(reqlen, self.read_size):
+      buf = self._decompress_more()
+      if not buf:
+        break
+      parts.append(buf)
+      have += len(buf)
+    if have < reqlen:
+      raise EOFError()
+    self.__rbuf = StringIO(''.join(parts))
+    return self.__rbuf
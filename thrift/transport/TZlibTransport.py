@@ -24,6 +24,7 @@ data compression.
 
 from __future__ import division
 import zlib
+from collections import deque
 from cStringIO import StringIO
 from TTransport import TTransportBase, CReadableTransport
 
@@ -48,7 +49,7 @@ class TZlibTransportFactory(object):
   _last_trans = None
   _last_z = None
 
-  def getTransport(self, trans, compresslevel=9):
+  def getTransport(self, trans, compresslevel=9, read_ahead=None):
     '''Wrap a transport , trans, with the TZlibTransport
     compressed transport class, returning a new
     transport to the caller.
@@ -56,13 +57,15 @@ class TZlibTransportFactory(object):
     @param compresslevel: The zlib compression level, ranging
     from 0 (no compression) to 9 (best compression).  Defaults to 9.
     @type compresslevel: int
+    @param read_ahead: See TZlibTransport.
+    @type read_ahead: int
     
     This method returns a TZlibTransport which wraps the
     passed C{trans} TTransport derived instance.
     '''
     if trans == self._last_trans:
       return self._last_z
-    ztrans = TZlibTransport(trans, compresslevel)
+    ztrans = TZlibTransport(trans, compresslevel, read_ahead)
     self._last_trans = trans
     self._last_z = ztrans
     return ztrans
@@ -73,13 +76,22 @@ class TZlibTransport(TTransportBase, CReadableTransport):
   Class that wraps a transport with zlib, compressing writes
   and decompresses reads, using the python standard
   library zlib module.
+
+  Decompressed bytes are kept as a queue of blocks, one per
+  decompression, and the block being read is a cStringIO whose
+  position is the read offset, so unread bytes are never copied
+  when more are decompressed.
   '''
 
   # Read buffer size for the python fastbinary C extension,
   # the TBinaryProtocolAccelerated class.
   DEFAULT_BUFFSIZE = 4096
 
-  def __init__(self, trans, compresslevel=9):
+  # Least number of compressed bytes to read from the underlying
+  # transport at a time.
+  DEFAULT_READ_AHEAD = 65536
+
+  def __init__(self, trans, compresslevel=9, read_ahead=None):
     '''
     Create a new TZlibTransport, wrapping C{trans}, another
     TTransport derived object.
@@ -89,20 +101,29 @@ class TZlibTransport(TTransportBase, CReadableTransport):
     @param compresslevel: The zlib compression level, ranging
     from 0 (no compression) to 9 (best compression).  Default is 9.
     @type compresslevel: int
+    @param read_ahead: Least number of compressed bytes to read from
+    C{trans} at a time, even if fewer are needed.  Default is
+    DEFAULT_READ_AHEAD; use 0 for a transport, such as a socket,
+    on which reading ahead could block.
+    @type read_ahead: int
     '''
     self.__trans = trans
     self.compresslevel = compresslevel
-    self.__rbuf = StringIO()
-    self.__wbuf = StringIO()
+    if read_ahead is None:
+      read_ahead = self.DEFAULT_READ_AHEAD
+    self.read_ahead = read_ahead
+    self._reinit_buffers()
     self._init_zlib()
     self._init_stats()
 
   def _reinit_buffers(self):
     '''
     Internal method to initialize/reset the internal StringIO objects
-    for read and write buffers.
+    for read and write buffers, and the queue of decompressed blocks
+    after the one being read.
     '''
-    self.__rbuf = StringIO()
+    self.__rbuf = StringIO('')
+    self.__rblocks = deque()
     self.__wbuf = StringIO()
 
   def _init_stats(self):
@@ -187,36 +208,66 @@ class TZlibTransport(TTransportBase, CReadableTransport):
     self._init_zlib()
     return self.__trans.close()
 
+  def _next_block(self, sz):
+    '''
+    Internal method that makes the next decompressed block the one
+    being read, decompressing more from the underlying transport if
+    none is queued.  Returns False if the underlying transport has no
+    more bytes.
+    '''
+    while not self.__rblocks:
+      if not self.readComp(sz):
+        return False
+    self.__rbuf = StringIO(self.__rblocks.popleft())
+    return True
+
   def read(self, sz):
     '''
     Read up to sz bytes from the decompressed bytes buffer, and
     read from the underlying transport if the decompression
-    buffer is empty.
+    buffer is empty.  Returns '' if the underlying transport does.
     '''
     ret = self.__rbuf.read(sz)
     if len(ret) > 0:
       return ret
-    # keep reading from transport until something comes back
-    while True:
-      if self.readComp(sz):
-        break
+    if not self._next_block(sz):
+      return ''
+    return self.__rbuf.read(sz)
+
+  def readAll(self, sz):
+    '''
+    Read exactly sz bytes, joining them from as many decompressed
+    blocks as needed, or raise EOFError.
+    '''
     ret = self.__rbuf.read(sz)
-    return ret
+    if len(ret) == sz:
+      return ret
+    parts = [ret]
+    have = len(ret)
+    while have < sz:
+      if not self._next_block(sz - have):
+        raise EOFError()
+      ret = self.__rbuf.read(sz - have)
+      parts.append(ret)
+      have += len(ret)
+    return ''.join(parts)
 
   def readComp(self, sz):
     '''
-    Read compressed data from the underlying transport, then
-    decompress it and append it to the internal StringIO read buffer
+    Read at least sz, or read_ahead, compressed bytes from the
+    underlying transport, then decompress them and queue the result
+    as a block for reading.  Returns False if the underlying
+    transport returned nothing, even if no block was queued.
     '''
-    zbuf = self.__trans.read(sz)
+    zbuf = self.__trans.read(max(sz, self.read_ahead))
+    if len(zbuf) == 0 and len(self._zcomp_read.unconsumed_tail) == 0:
+      return False
     zbuf = self._zcomp_read.unconsumed_tail + zbuf
     buf = self._zcomp_read.decompress(zbuf)
     self.bytes_in += len(zbuf)
     self.bytes_in_comp += len(buf)
-    old = self.__rbuf.read()
-    self.__rbuf = StringIO(old + buf)
-    if len(old) + len(buf) == 0:
-      return False
+    if len(buf) > 0:
+      self.__rblocks.append(buf)
     return True
 
   def write(self, buf):
@@ -251,11 +302,20 @@ class TZlibTransport(TTransportBase, CReadableTransport):
     return self.__rbuf
 
   def cstringio_refill(self, partialread, reqlen):
-    '''Implement the CReadableTransport interface for refill'''
-    retstring = partialread
-    if reqlen < self.DEFAULT_BUFFSIZE:
-      retstring += self.read(self.DEFAULT_BUFFSIZE)
-    while len(retstring) < reqlen:
-      retstring += self.read(reqlen - len(retstring))
-    self.__rbuf = StringIO(retstring)
+    '''
+    Implement the CReadableTransport interface for refill, joining
+    partialread with only as many queued blocks as make reqlen
+    bytes, or at least DEFAULT_BUFFSIZE
+    '''
+    parts = [partialread]
+    have = len(partialread)
+    want = max(reqlen, self.DEFAULT_BUFFSIZE)
+    while have < want:
+      if not self._next_block(want - have):
+        break
+      parts.append(self.__rbuf.read())
+      have += len(parts[-1])
+    if have < reqlen:
+      raise EOFError()
+    self.__rbuf = StringIO(''.join(parts))
     return self.__rbuf